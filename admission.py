@@ -0,0 +1,175 @@
+'''Admission control for the query endpoints.
+
+At most ``ADMISSION_MAX_INFLIGHT`` requests run the pipeline at once; the
+rest wait in a bounded priority queue where interactive requests go ahead of
+batch ones. Every request has a deadline (per priority class, optionally
+shortened by the client with ``X-Deadline-Ms``). A moving average of the
+service time of each class is used to shed requests that would not finish
+before their deadline: when they arrive, while they wait, and when a slot
+frees up. Long batches and exports don't make short interactive requests
+look slow.
+Shedding early keeps the slots busy with work whose answer will still be
+read, so goodput stays flat under overload instead of collapsing.
+'''
+import os
+import math
+import time
+import heapq
+import asyncio
+import itertools
+from typing import Callable, Dict, List, Optional, Tuple
+
+from metrics import Counter, Gauge, Histogram
+
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", "32"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_DEADLINE_S = float(os.getenv("ADMISSION_DEADLINE_S", "25"))
+ADMISSION_BATCH_DEADLINE_S = float(os.getenv("ADMISSION_BATCH_DEADLINE_S", "120"))
+
+# lower value is served first
+PRIORITIES = {"interactive": 0, "batch": 1}
+CLASSES = {rank: name for name, rank in PRIORITIES.items()}
+DEADLINES = {"interactive": ADMISSION_DEADLINE_S, "batch": ADMISSION_BATCH_DEADLINE_S}
+# weight of the newest sample in the service time moving average
+SERVICE_TIME_ALPHA = 0.2
+
+DECISIONS = Counter("admission_decisions_total", "Admission decisions by priority and result.",
+                    labels=("priority", "result"))
+WAIT_SECONDS = Histogram("admission_wait_seconds", "Time admitted requests waited in the queue.",
+                        labels=("priority",))
+
+
+class Overloaded(Exception):
+    '''The request was refused to protect the requests already admitted.'''
+
+    def __init__(self, status: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    '''Bounded in-flight limit with a deadline-aware priority queue.
+
+    Meant to be used from a single event loop.
+    '''
+
+    def __init__(self, max_inflight: int, max_queue: int):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.inflight = 0
+        # moving average of the time a request holds a slot, per class
+        self.service_time: Dict[str, float] = {p: 0.0 for p in PRIORITIES}
+        self._waiting: Dict[str, int] = {p: 0 for p in PRIORITIES}
+        # (priority, arrival, deadline, waiter); waiters that gave up stay
+        # in the heap, done, until they are popped
+        self._queue: List[Tuple[int, int, float, asyncio.Future]] = []
+        self._arrivals = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        '''Requests currently waiting for a slot.'''
+        return sum(self._waiting.values())
+
+    def _expected(self, ahead: int, priority: str) -> float:
+        '''Seconds until a request behind `ahead` others would likely be done.'''
+        return (ahead // self.max_inflight + 1) * self.service_time[priority]
+
+    def _retry_after(self, ahead: int, priority: str) -> int:
+        return max(1, math.ceil(self._expected(ahead, priority)))
+
+    def _ahead_of(self, priority: int) -> int:
+        return sum(1 for p, _, _, fut in self._queue if p <= priority and not fut.done())
+
+    async def acquire(self, priority: str, deadline: float):
+        '''Wait for a slot, raising Overloaded if none will come in time.
+
+        `deadline` is a time.monotonic() value.
+        '''
+        loop = asyncio.get_running_loop()
+        rank = PRIORITIES[priority]
+        ahead = self._ahead_of(rank)
+        if self.inflight < self.max_inflight and not ahead:
+            self.inflight += 1
+            return
+        if self.waiting >= self.max_queue:
+            raise Overloaded(429, "too many queued requests", self._retry_after(ahead, priority))
+        if time.monotonic() + self._expected(ahead, priority) > deadline:
+            raise Overloaded(503, "request would not finish before its deadline",
+                            self._retry_after(ahead, priority))
+
+        fut = loop.create_future()
+        heapq.heappush(self._queue, (rank, next(self._arrivals), deadline, fut))
+        self._waiting[priority] += 1
+        try:
+            # give up once even an immediate start would miss the deadline
+            await asyncio.wait((fut,), timeout=max(0.0, deadline - time.monotonic()
+                                                   - self.service_time[priority]))
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                self.release(priority=priority)
+            fut.cancel()
+            raise
+        finally:
+            self._waiting[priority] -= 1
+        if not fut.done():
+            fut.cancel()
+            raise Overloaded(503, "request would not finish before its deadline",
+                            self._retry_after(self._ahead_of(rank), priority))
+        fut.result()
+
+    def release(self, elapsed: Optional[float] = None, priority: str = "interactive"):
+        '''Free a slot and hand it to the next waiter that can still finish.'''
+        if elapsed is not None:
+            self.service_time[priority] += SERVICE_TIME_ALPHA * (elapsed - self.service_time[priority])
+        self.inflight -= 1
+        while self._queue and self.inflight < self.max_inflight:
+            rank, _, deadline, fut = heapq.heappop(self._queue)
+            if fut.done():
+                continue
+            if time.monotonic() + self.service_time[CLASSES[rank]] > deadline:
+                fut.set_exception(Overloaded(503, "request would not finish before its deadline",
+                                            self._retry_after(self.waiting, CLASSES[rank])))
+                continue
+            self.inflight += 1
+            fut.set_result(None)
+
+    async def admit(self, priority: str = "interactive",
+                    deadline_s: Optional[float] = None) -> Callable[[], None]:
+        '''Wait for a slot and return the function that frees it.
+
+        The deadline defaults to the one of the priority class and can only
+        be shortened. The returned function may be called more than once,
+        from the event loop.
+        '''
+        start = time.monotonic()
+        limit = DEADLINES[priority]
+        if deadline_s is not None:
+            limit = min(limit, deadline_s)
+        try:
+            await self.acquire(priority, start + limit)
+        except Overloaded as e:
+            DECISIONS.inc(priority=priority, result=str(e.status))
+            raise
+        admitted = time.monotonic()
+        DECISIONS.inc(priority=priority, result="admitted")
+        WAIT_SECONDS.observe(admitted - start, priority=priority)
+
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.release(time.monotonic() - admitted, priority)
+        return release
+
+
+controller = AdmissionController(ADMISSION_MAX_INFLIGHT, ADMISSION_MAX_QUEUE)
+
+Gauge("admission_inflight", "Requests running the pipeline.", lambda: controller.inflight)
+Gauge("admission_queue_depth", "Requests waiting for admission by priority.",
+    lambda: {(p,): n for p, n in controller._waiting.items()},  # pylint: disable=protected-access
+    labels=("priority",))
+Gauge("admission_service_seconds", "Moving average of the time admitted requests hold a slot.",
+    lambda: {(p,): t for p, t in controller.service_time.items()}, labels=("priority",))
@@ -1,13 +1,29 @@
 '''api.py - FastAPI application for Text-to-SQL service'''
 
+import io
+import csv
+import json
+import os
+import time
+import asyncio
+import weakref
 import logging
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Literal, Optional, Union
 
-from fastapi import FastAPI
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
 
 from query_service import QueryRequest as ServiceQueryRequest
-from query_service import query
+from query_service import aquery, aquery_batch, aquery_events, query_next_page, agenerate_sql, stream_rows
+from query_service import InvalidSQL, export_rows
+from worker_pools import IO_POOL, run_in
+from metrics import HTTP_SECONDS, REGISTRY, request_timings, server_timing, span
+import admission
+import databases
+import profiler
+import retriever_node
+import vector_generations
 
 app = FastAPI(title="Text-to-SQL API", version="1.0.0")
 
@@ -15,19 +31,141 @@ app = FastAPI(title="Text-to-SQL API", version="1.0.0")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# send per-stage timings on every response, not only when asked with X-Timing
+TIMING_HEADERS = os.getenv("TIMING_HEADERS", "false").lower() in ("1", "true", "yes")
+
+# endpoints that run the pipeline go through admission control, with the
+# priority class used when the client doesn't send X-Priority
+ADMITTED_PATHS = {
+    "/query": "interactive",
+    "/query/stream": "interactive",
+    "/query/events": "interactive",
+    "/query/batch": "batch",
+    "/query/export": "batch",
+}
+
 # models for request/response
 class QueryRequest(BaseModel):
     '''Query request'''
     question: str
     show_sql: bool = True
+    format: Literal["records", "columnar"] = "records"
+    page_size: Optional[int] = None
+    database: Optional[str] = None
+
+class PageRequest(BaseModel):
+    '''Request for the next page of a paginated query'''
+    page_token: str
+    format: Literal["records", "columnar"] = "records"
 
 class QueryResponse(BaseModel):
     '''Query response'''
     success: bool
     sql: Optional[str] = None
     cols: Optional[List[str]] = None
-    rows: Optional[List[Dict]] = None
+    rows: Optional[Union[List[Dict], List[List[Any]]]] = None
     error: Optional[str] = None
+    next_page_token: Optional[str] = None
+    export_token: Optional[str] = None
+
+class ActivateRequest(BaseModel):
+    '''Collection to serve retrieval from'''
+    collection: str
+
+class BatchQueryRequest(BaseModel):
+    '''Batch of query requests'''
+    queries: List[QueryRequest] = Field(max_length=int(os.getenv("BATCH_MAX_QUERIES", "500")))
+
+class BatchQueryResponse(BaseModel):
+    '''Batch query response, one result per query in request order'''
+    results: List[QueryResponse]
+
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    '''Queue pipeline requests for a slot, shedding those that can't finish in time.
+
+    Streamed responses hold their slot until the body has been sent.
+    '''
+    priority = ADMITTED_PATHS.get(request.url.path)
+    if priority is None:
+        return await call_next(request)
+    if request.headers.get("X-Priority") in admission.PRIORITIES:
+        priority = request.headers["X-Priority"]
+    try:
+        deadline_ms = request.headers.get("X-Deadline-Ms")
+        deadline_s = float(deadline_ms) / 1000 if deadline_ms else None
+    except ValueError:
+        deadline_s = None
+
+    try:
+        with span("admission"):
+            release = await admission.controller.admit(priority, deadline_s)
+    except admission.Overloaded as e:
+        logger.warning("Requisição recusada (%d): %s", e.status, e)
+        return JSONResponse(status_code=e.status, content={"success": False, "error": str(e)},
+                            headers={"Retry-After": str(e.retry_after)})
+    try:
+        response = await call_next(request)
+    except BaseException:
+        release()
+        raise
+
+    body = response.body_iterator
+
+    async def release_after_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            release()
+
+    response.body_iterator = release_after_body()
+    # a body that is never iterated (client gone before the first chunk)
+    # releases the slot when it is collected; that can happen on any thread,
+    # and the controller belongs to the event loop
+    weakref.finalize(response.body_iterator, _release_on_loop,
+                     asyncio.get_running_loop(), release)
+    return response
+
+
+def _release_on_loop(loop: asyncio.AbstractEventLoop, release):
+    try:
+        loop.call_soon_threadsafe(release)
+    except RuntimeError:
+        # the loop is closed, there's nothing left to admit
+        pass
+
+
+@app.middleware("http")
+async def record_timings(request: Request, call_next):
+    '''Record request latency and add per-stage timings when asked to.'''
+    timings = {} if TIMING_HEADERS or request.headers.get("X-Timing") else None
+    token = request_timings.set(timings)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        request_timings.reset(token)
+    elapsed = time.perf_counter() - start
+    route = request.scope.get("route")
+    HTTP_SECONDS.observe(elapsed, path=getattr(route, "path", "unmatched"),
+                        status=response.status_code)
+    if timings is not None:
+        timings["total"] = elapsed
+        response.headers["Server-Timing"] = server_timing(timings)
+    return response
+
+
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    '''Profile the request when asked with X-Profile or picked by sampling.'''
+    if not profiler.should_profile(bool(request.headers.get("X-Profile"))):
+        return await call_next(request)
+    with profiler.profiling(request.url.path, attach_caller=False) as profile:
+        response = await call_next(request)
+    response.headers["X-Profile-Id"] = profile.id
+    return response
 
 
 @app.get("/")
@@ -36,6 +174,86 @@ async def root():
     return {"message": "Text-to-SQL API", "docs": "/docs"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    '''Metrics in Prometheus text format'''
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/admin/profiles")
+async def list_profiles():
+    '''List the most recent request profiles'''
+    return {"profiles": profiler.list_profiles()}
+
+
+@app.get("/admin/profiles/{name}", response_class=PlainTextResponse)
+async def get_profile(name: str):
+    '''Return a profile as collapsed stacks, ready for flamegraph tools'''
+    content = profiler.read_profile(name)
+    if content is None:
+        raise HTTPException(status_code=404, detail="profile not found")
+    return PlainTextResponse(content)
+
+
+def _collection_status():
+    return {
+        "active": retriever_node.default_store.collection,
+        "pointer": vector_generations.read_pointer(),
+        "generations": vector_generations.list_generations(),
+    }
+
+
+@app.get("/admin/collection")
+async def collection_status():
+    '''Show the collection served by this process and the available generations'''
+    return await run_in(IO_POOL, _collection_status)
+
+
+@app.post("/admin/collection/reload")
+async def reload_collection():
+    '''Switch to the collection named by the pointer file now'''
+    try:
+        await run_in(IO_POOL, retriever_node.reload_collection)
+    except vector_generations.MissingCollection as e:
+        raise HTTPException(status_code=404, detail=str(e)) from e
+    return await run_in(IO_POOL, _collection_status)
+
+
+@app.post("/admin/collection/activate")
+async def activate_collection(request: ActivateRequest):
+    '''Point every process at another collection generation, e.g. to roll back'''
+    count = await run_in(IO_POOL, vector_generations.collection_count, request.collection)
+    if not count:
+        raise HTTPException(status_code=404, detail="collection not found or empty")
+    await run_in(IO_POOL, vector_generations.write_pointer, request.collection, count=count)
+    await run_in(IO_POOL, retriever_node.reload_collection)
+    return await run_in(IO_POOL, _collection_status)
+
+
+@app.get("/admin/databases")
+async def database_status():
+    '''Show the configured databases and the ones loaded in this process'''
+    return databases.registry.status()
+
+
+@app.post("/admin/databases/{name}/unload")
+async def unload_database(name: str):
+    '''Unload an idle database now; it is loaded again by its next request'''
+    try:
+        unloaded = await run_in(IO_POOL, databases.registry.unload, name)
+    except databases.UnknownDatabase as e:
+        raise HTTPException(status_code=404, detail=str(e)) from e
+    if not unloaded:
+        raise HTTPException(status_code=409, detail="database is not loaded or is in use")
+    return databases.registry.status()
+
+
+def _rejected(e: InvalidSQL) -> JSONResponse:
+    '''Answer 400 for generated SQL that was refused and never executed.'''
+    logger.error("Erro: %s", str(e))
+    return JSONResponse(status_code=400, content={"success": False, "error": str(e)})
+
+
 @app.post("/query", response_model=QueryResponse)
 async def process_query(request: QueryRequest):
     '''Process a query request'''
@@ -45,18 +263,25 @@ async def process_query(request: QueryRequest):
         # Usar o query service
         service_request = ServiceQueryRequest(
             question=request.question,
-            show_sql=request.show_sql
+            show_sql=request.show_sql,
+            format=request.format,
+            page_size=request.page_size,
+            database=request.database
         )
 
-        result = query(service_request)
+        result = await aquery(service_request)
 
         return QueryResponse(
             success=True,
             sql=result["sql"],
             cols=result["cols"],
-            rows=result["rows"]
+            rows=result["rows"],
+            next_page_token=result["next_page_token"],
+            export_token=result["export_token"]
         )
 
+    except InvalidSQL as e:
+        return _rejected(e)
     except (ValueError, RuntimeError, ConnectionError, KeyError) as e:
         logger.error("Erro: %s", str(e))
         return QueryResponse(
@@ -64,6 +289,138 @@ async def process_query(request: QueryRequest):
             error=str(e)
         )
 
+
+@app.post("/query/batch", response_model=BatchQueryResponse)
+async def process_batch(request: BatchQueryRequest):
+    '''Process a batch of query requests'''
+    results = await aquery_batch([
+        ServiceQueryRequest(question=q.question, show_sql=q.show_sql,
+                            format=q.format, page_size=q.page_size, database=q.database)
+        for q in request.queries
+    ])
+    return BatchQueryResponse(results=[
+        QueryResponse(success=False, error=r["error"]) if "error" in r
+        else QueryResponse(success=True, **r)
+        for r in results
+    ])
+
+
+@app.post("/query/next", response_model=QueryResponse)
+async def process_next_page(request: PageRequest):
+    '''Fetch the next page of a paginated query'''
+    try:
+        result = await run_in(IO_POOL, query_next_page, request.page_token, request.format)
+        return QueryResponse(success=True, **result)
+    except (ValueError, RuntimeError, KeyError) as e:
+        logger.error("Erro: %s", str(e))
+        return QueryResponse(success=False, error=str(e))
+
+
+def _ndjson_lines(sql: Optional[str], rows, batch: int = 500):
+    '''Encode the streamed result as newline-delimited JSON.
+
+    Lines are sent in batches; the generator runs in a worker thread and
+    every item it yields is a hop back to the event loop.
+    '''
+    count = 0
+    lines = []
+    try:
+        for item in rows:
+            if isinstance(item, dict):
+                item = {"sql": sql, **item}
+            else:
+                count += 1
+            lines.append(json.dumps(item, default=str) + "\n")
+            if len(lines) >= batch or count == 0:
+                yield "".join(lines)
+                lines = []
+        lines.append(json.dumps({"row_count": count}) + "\n")
+    except Exception as e:  # pylint: disable=broad-except
+        logger.error("Erro: %s", str(e))
+        lines.append(json.dumps({"error": str(e), "row_count": count}) + "\n")
+    yield "".join(lines)
+
+
+@app.post("/query/stream", response_model=None)
+async def stream_query(request: QueryRequest):
+    '''Process a query request and stream the rows as NDJSON.
+
+    The first line holds the SQL and the column names, each following line is
+    one row as a JSON array and the last line holds the row count.
+    '''
+    try:
+        logger.info("Pergunta: %s", request.question)
+        sql = await agenerate_sql(ServiceQueryRequest(question=request.question,
+                                                    show_sql=request.show_sql,
+                                                    database=request.database))
+    except InvalidSQL as e:
+        return _rejected(e)
+    except (ValueError, RuntimeError, ConnectionError, KeyError) as e:
+        logger.error("Erro: %s", str(e))
+        return QueryResponse(success=False, error=str(e))
+
+    db_path = databases.registry.database_path(request.database)
+    return StreamingResponse(
+        _ndjson_lines(sql if request.show_sql else None, stream_rows(sql, db_path=db_path)),
+        media_type="application/x-ndjson"
+    )
+
+def _csv_lines(rows, batch: int = 500):
+    '''Encode the streamed result as CSV, a header line and one line per row.'''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    count = 0
+    try:
+        for item in rows:
+            writer.writerow(item["cols"] if isinstance(item, dict) else item)
+            count += 1
+            if count % batch == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    except Exception as e:  # pylint: disable=broad-except
+        # the status line is already sent, the download ends short
+        logger.error("Erro: %s", str(e))
+    yield buffer.getvalue()
+
+
+@app.get("/query/export", response_model=None)
+async def export_query(token: str):
+    '''Stream the full result of a previous query as CSV.
+
+    ``token`` is the ``export_token`` of a ``/query`` response.
+    '''
+    try:
+        rows = export_rows(token)
+    except ValueError as e:
+        raise HTTPException(status_code=403, detail=str(e)) from e
+    return StreamingResponse(
+        _csv_lines(rows),
+        media_type="text/csv",
+        headers={"Content-Disposition": 'attachment; filename="query_results.csv"'}
+    )
+
+
+@app.post("/query/events", response_model=None)
+async def query_events(request: QueryRequest):
+    '''Process a query request, streaming each pipeline stage as server-sent events.
+
+    Events are sent as retrieval, SQL generation, validation and execution
+    complete: ``retrieved``, ``sql``, ``validation``, ``columns``, ``rows``
+    (one per chunk) and ``done``, or ``error``. Disconnecting cancels the
+    remaining stages.
+    '''
+    logger.info("Pergunta: %s", request.question)
+    service_request = ServiceQueryRequest(question=request.question, show_sql=request.show_sql,
+                                        format=request.format, database=request.database)
+
+    async def events():
+        async for event, data in aquery_events(service_request):
+            yield f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("api:app", host="127.0.0.1", port=8000, reload=True)
@@ -0,0 +1,220 @@
+'''Ranking agreement of an inference backend with the full precision models.
+
+Loads the embedding and rerank models with the ``torch`` backend and with the
+backend under test (see ``inference_backends.py``) and runs the labelled
+questions against a sample of the documents of the served collection through
+both. For the embedding model the document sample is ranked by similarity to
+each question; for the rerank model both score the candidates the full
+precision embeddings retrieve. Agreement is reported as top-k overlap, top-1
+agreement and Spearman rank correlation, next to the p50/p95 latency of the
+model calls and the memory each model added. The exit status is 1 when the
+mean top-k overlap of either model is below ``--min-agreement``.
+
+Usage:
+    uv run benchmarks/backend_parity.py --backend int8
+    uv run benchmarks/backend_parity.py --backend onnx --documents 2000 --output parity.json
+'''
+import os
+import gc
+import sys
+import json
+import time
+import logging
+import argparse
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+from benchmarks.eval_retrieval import DEFAULT_LABELS, current_rss_mb, load_labels  # noqa: E402
+from benchmarks.run_benchmark import percentiles  # noqa: E402
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("backend_parity")
+logger.setLevel(logging.INFO)
+
+REFERENCE = "torch"
+
+
+def ranking_agreement(reference: Sequence[float], candidate: Sequence[float],
+                      k: int) -> Dict[str, float]:
+    '''Compare two scorings of the same items.
+
+    Returns the share of the reference top k in the candidate top k, whether
+    both put the same item first and the Spearman correlation of the ranks.
+    '''
+    n = len(reference)
+    ref = sorted(range(n), key=lambda i: -reference[i])
+    cand = sorted(range(n), key=lambda i: -candidate[i])
+    k = min(k, n)
+    rank = {item: r for r, item in enumerate(ref)}
+    d2 = sum((r - rank[item]) ** 2 for r, item in enumerate(cand))
+    return {
+        "overlap": len(set(ref[:k]) & set(cand[:k])) / k,
+        "top1": float(ref[0] == cand[0]),
+        "spearman": 1 - 6 * d2 / (n * (n * n - 1)) if n > 1 else 1.0,
+    }
+
+
+def mean_agreement(results: List[Dict[str, float]]) -> Dict[str, float]:
+    '''Average the agreement measures over the questions.'''
+    return {key: round(sum(r[key] for r in results) / len(results), 4) for key in results[0]}
+
+
+def load_documents(limit: int) -> List[str]:
+    '''First documents of the served collection.'''
+    import chromadb  # pylint: disable=import-outside-toplevel
+    import vector_generations  # pylint: disable=import-outside-toplevel
+
+    client = chromadb.PersistentClient(path=os.getenv("VECTOR_STORE_DIR"))
+    collection = client.get_collection(vector_generations.active_collection())
+    documents = collection.get(limit=limit, include=["documents"])["documents"]
+    if not documents:
+        raise SystemExit("The served collection is empty, run ingest_pipeline.py first")
+    return documents
+
+
+def loaded(load: Callable[[], Any]) -> Tuple[Any, float]:
+    '''Load a model and return it with the memory it added in MiB.'''
+    gc.collect()
+    before = current_rss_mb()
+    model = load()
+    return model, round(current_rss_mb() - before, 1)
+
+
+def timed_each(fn: Callable, items: Sequence) -> Tuple[List[Any], List[float]]:
+    '''Call fn on each item, returning the results and the seconds of each call.'''
+    results, seconds = [], []
+    for item in items:
+        start = time.perf_counter()
+        results.append(fn(item))
+        seconds.append(time.perf_counter() - start)
+    return results, seconds
+
+
+def _normalized(vectors) -> np.ndarray:
+    matrix = np.asarray(vectors, dtype=np.float32)
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=-1, keepdims=True), 1e-12)
+
+
+def compare_embeddings(backend: str, questions: List[str], documents: List[str],
+                       k: int) -> Tuple[Dict[str, Any], np.ndarray]:
+    '''Compare the embedding rankings of the backend with the reference.
+
+    Also returns the reference similarity of every question to every document.
+    '''
+    from inference_backends import load_embeddings  # pylint: disable=import-outside-toplevel
+
+    model_name = os.getenv("EMBED_MODEL")
+    report: Dict[str, Any] = {"model": model_name, "latency_ms": {}, "model_rss_mb": {}}
+    scores = {}
+    for name in (REFERENCE, backend):
+        model, rss = loaded(lambda name=name: load_embeddings(model_name, backend=name))
+        report["model_rss_mb"][name] = rss
+        docs = _normalized(model.embed_documents(documents))
+        vectors, seconds = timed_each(model.embed_query, questions)
+        report["latency_ms"][name] = percentiles(seconds)
+        scores[name] = (_normalized(vectors), docs)
+        del model
+
+    (ref_q, ref_docs), (cand_q, cand_docs) = scores[REFERENCE], scores[backend]
+    ref_scores, cand_scores = ref_q @ ref_docs.T, cand_q @ cand_docs.T
+    report["agreement"] = mean_agreement([ranking_agreement(r, c, k)
+                                          for r, c in zip(ref_scores, cand_scores)])
+    # how far the backend moves the vectors themselves
+    report["question_cosine"] = round(float(np.mean(np.sum(ref_q * cand_q, axis=1))), 4)
+    report["document_cosine"] = round(float(np.mean(np.sum(ref_docs * cand_docs, axis=1))), 4)
+    return report, ref_scores
+
+
+def compare_rerank(backend: str, questions: List[str], candidates: List[List[str]],
+                   k: int) -> Dict[str, Any]:
+    '''Compare the rerank orderings of the backend with the reference.'''
+    from inference_backends import load_cross_encoder  # pylint: disable=import-outside-toplevel
+
+    model_name = os.getenv("RERANK_MODEL")
+    report: Dict[str, Any] = {"model": model_name, "latency_ms": {}, "model_rss_mb": {}}
+    pairs = [[(q, doc) for doc in docs] for q, docs in zip(questions, candidates)]
+    scores = {}
+    for name in (REFERENCE, backend):
+        model, rss = loaded(lambda name=name: load_cross_encoder(model_name, backend=name))
+        report["model_rss_mb"][name] = rss
+        scores[name], seconds = timed_each(model.predict, pairs)
+        report["latency_ms"][name] = percentiles(seconds)
+        del model
+
+    report["agreement"] = mean_agreement([ranking_agreement(list(r), list(c), k)
+                                          for r, c in zip(scores[REFERENCE], scores[backend])])
+    return report
+
+
+def main():
+    '''Command line entry point.'''
+    load_dotenv(os.path.join(ROOT, ".env"))
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", 1)[0])
+    parser.add_argument("--backend", choices=("int8", "onnx", "torch"), required=True,
+                        help="backend compared with the full precision torch models")
+    parser.add_argument("--labels", default=DEFAULT_LABELS,
+                        help="questions to rank for (JSON list or JSON lines)")
+    parser.add_argument("--documents", type=int, default=1000,
+                        help="documents of the served collection ranked by the embeddings")
+    parser.add_argument("--k", type=int, default=int(os.getenv("TOP_K", "5")),
+                        help="top k compared")
+    parser.add_argument("--candidates", type=int,
+                        default=int(os.getenv("TOP_K", "5"))
+                        * int(os.getenv("RERANK_CANDIDATE_MULTIPLIER", "3")),
+                        help="documents scored by the rerank models per question")
+    parser.add_argument("--min-agreement", type=float, default=0.9,
+                        help="lowest accepted mean top-k overlap")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    questions = [item["question"] for item in load_labels(args.labels)]
+    documents = load_documents(args.documents)
+    logger.info("Comparing %s with %s on %d questions and %d documents", args.backend,
+                REFERENCE, len(questions), len(documents))
+
+    embed, ref_scores = compare_embeddings(args.backend, questions, documents, args.k)
+    candidates = [[documents[i] for i in np.argsort(-row)[:args.candidates]] for row in ref_scores]
+    rerank = compare_rerank(args.backend, questions, candidates, args.k)
+
+    report = {
+        "meta": {
+            "backend": args.backend,
+            "reference": REFERENCE,
+            "questions": len(questions),
+            "documents": len(documents),
+            "k": args.k,
+            "candidates": args.candidates,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "embed": embed,
+        "rerank": rerank,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    failed = False
+    for stage, result in (("embed", embed), ("rerank", rerank)):
+        latency = {name: stats.get("p50") for name, stats in result["latency_ms"].items()}
+        logger.info("%s: top-%d overlap %.3f, top-1 %.3f, spearman %.3f, p50 %s ms",
+                    stage, args.k, result["agreement"]["overlap"], result["agreement"]["top1"],
+                    result["agreement"]["spearman"], latency)
+        if result["agreement"]["overlap"] < args.min_agreement:
+            logger.warning("%s agreement %.3f is below %.3f", stage,
+                           result["agreement"]["overlap"], args.min_agreement)
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
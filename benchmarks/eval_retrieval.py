@@ -0,0 +1,304 @@
+'''Retrieval recall versus latency sweep.
+
+Runs labelled questions (a question and the ``table:pk`` of the rows that
+answer it) through the retrieval stages of ``retriever_node`` for every
+combination of k, candidate multiplier and rerank model, where ``none`` ranks
+by vector distance alone, as the service does with RERANK_MODEL=none. Each configuration gets its recall@k and MRR next
+to the p50/p95 latency of the embed, vector_search and rerank stages (from
+the same spans that feed ``/metrics``) and the resident memory the rerank
+model adds (left empty for the RERANK_MODEL retriever_node already loaded,
+which is reused rather than loaded twice). The results are written as CSV and JSON, and the cheapest
+configuration reaching ``--target-recall`` is logged with the settings that
+select it (TOP_K, RERANK_CANDIDATE_MULTIPLIER, RERANK_MODEL, RERANK_BACKEND).
+
+The collection served from ``VECTOR_STORE_DIR`` is evaluated, so ingest the
+data the labels refer to first. The default labels refer to the sample rows
+of ``scripts/create_xpto_db.py``, which every scale of it contains.
+
+Usage:
+    uv run benchmarks/eval_retrieval.py
+    uv run benchmarks/eval_retrieval.py --k 1,3,5,10 --multipliers 1,2,3,5 \\
+        --rerank-models none,cross-encoder/ms-marco-MiniLM-L-6-v2 --repeat 3
+    uv run benchmarks/eval_retrieval.py \\
+        --rerank-models cross-encoder/ms-marco-MiniLM-L-6-v2@torch,cross-encoder/ms-marco-MiniLM-L-6-v2@int8
+'''
+import os
+import gc
+import csv
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.run_benchmark import peak_rss_mb, percentiles  # noqa: E402 pylint: disable=wrong-import-position
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("eval_retrieval")
+logger.setLevel(logging.INFO)
+
+DEFAULT_LABELS = os.path.join(ROOT, "benchmarks", "retrieval_labels.json")
+# retriever_node.NO_RERANK, without loading the models to read it
+NO_RERANK = "none"
+
+Key = Tuple[str, str]
+
+
+def parse_key(entry) -> Key:
+    '''Return the (table, pk) of a relevant row, given as "table:pk" or a dict.'''
+    if isinstance(entry, dict):
+        return entry["table"], str(entry["pk"])
+    table, _, pk = str(entry).partition(":")
+    return table, pk
+
+
+def load_labels(path: str) -> List[Dict[str, Any]]:
+    '''Read the labelled questions from a JSON list or JSON lines file.'''
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    items = json.loads(text) if text.lstrip().startswith("[") else \
+        [json.loads(line) for line in text.splitlines() if line.strip()]
+    labels = [{"question": item["question"], "relevant": {parse_key(e) for e in item["relevant"]}}
+              for item in items]
+    if not labels:
+        raise SystemExit(f"No labelled questions in {path}")
+    return labels
+
+
+def doc_key(doc) -> Key:
+    '''The (table, pk) a retrieved document was built from.'''
+    return doc.metadata.get("table"), str(doc.metadata.get("pk"))
+
+
+def rank_metrics(ranked: List[Key], relevant: Set[Key], k: int) -> Tuple[float, float]:
+    '''Recall and reciprocal rank of the first relevant row within the top k.'''
+    top = ranked[:k]
+    recall = len(relevant.intersection(top)) / len(relevant)
+    rr = next((1 / (i + 1) for i, key in enumerate(top) if key in relevant), 0.0)
+    return recall, rr
+
+
+def current_rss_mb() -> float:
+    '''Resident set size of the process in MiB, or the peak where it isn't available.'''
+    try:
+        with open("/proc/self/statm", encoding="ascii") as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+
+def timed(fn, *args, **kwargs):
+    '''Call fn and return its result with the stage timings its spans recorded.'''
+    from metrics import request_timings  # pylint: disable=import-outside-toplevel
+
+    timings: Dict[str, float] = {}
+    token = request_timings.set(timings)
+    try:
+        return fn(*args, **kwargs), timings
+    finally:
+        request_timings.reset(token)
+
+
+def load_reranker(spec: str) -> Tuple[Any, Optional[float]]:
+    '''Load a CrossEncoder and return it with the memory it added in MiB.
+
+    `spec` is a model name, optionally followed by @ and an inference
+    backend, e.g. cross-encoder/ms-marco-MiniLM-L-6-v2@int8. The model
+    retriever_node serves with is returned as is, with no memory figure.
+    '''
+    # pylint: disable=import-outside-toplevel
+    import retriever_node
+    from inference_backends import RERANK_BACKEND, load_cross_encoder
+
+    name, _, backend = spec.partition("@")
+    if (name, backend or RERANK_BACKEND) == (os.getenv("RERANK_MODEL"), RERANK_BACKEND):
+        return retriever_node.rerank_model, None
+    gc.collect()
+    before = current_rss_mb()
+    model = load_cross_encoder(name, backend=backend or None)
+    return model, round(current_rss_mb() - before, 1)
+
+
+def sweep(labels: List[Dict[str, Any]], ks: List[int], multipliers: List[int],
+          rerank_models: List[str], repeat: int) -> List[Dict[str, Any]]:
+    '''Evaluate every configuration and return one result row per configuration.'''
+    import retriever_node  # pylint: disable=import-outside-toplevel
+
+    questions = [item["question"] for item in labels]
+
+    # embed[q] and search[depth][q] hold one timing per repetition
+    embed: List[List[float]] = [[] for _ in questions]
+    vectors: List[List[float]] = []
+    for i, question in enumerate(questions):
+        for _ in range(repeat):
+            vector, timings = timed(retriever_node.embed_question, question)
+            embed[i].append(timings.get("embed", 0.0))
+        vectors.append(vector)
+
+    depths = sorted({k * m for k in ks for m in multipliers} | set(ks))
+    candidates: Dict[int, List[List]] = {}
+    search: Dict[int, List[List[float]]] = {}
+    for depth in depths:
+        candidates[depth], search[depth] = [], []
+        for vector in vectors:
+            samples = []
+            for _ in range(repeat):
+                docs, timings = timed(retriever_node.search_candidates, vector, k=depth)
+                samples.append(timings.get("vector_search", 0.0))
+            candidates[depth].append(docs)
+            search[depth].append(samples)
+
+    def row(model: str, k: int, multiplier: int, ranked: List[List[Key]],
+            rerank: Optional[List[List[float]]], model_rss: Optional[float]) -> Dict[str, Any]:
+        depth = k * multiplier
+        recalls, rrs = zip(*(rank_metrics(r, item["relevant"], k) for r, item in zip(ranked, labels)))
+        stage_samples = {
+            "embed": [t for ts in embed for t in ts],
+            "vector_search": [t for ts in search[depth] for t in ts],
+            "rerank": [t for ts in rerank for t in ts] if rerank else [],
+        }
+        totals = [e + s + (rerank[q][r] if rerank else 0.0)
+                  for q in range(len(questions))
+                  for r, (e, s) in enumerate(zip(embed[q], search[depth][q]))]
+        result = {
+            "rerank_model": model,
+            "k": k,
+            "multiplier": multiplier,
+            "candidates": depth,
+            "recall": round(sum(recalls) / len(recalls), 4),
+            "mrr": round(sum(rrs) / len(rrs), 4),
+        }
+        for stage, values in (*stage_samples.items(), ("total", totals)):
+            stats = percentiles(values)
+            for p in ("p50", "p95"):
+                result[f"{stage}_{p}_ms"] = stats.get(p)
+        result["model_rss_mb"] = model_rss
+        result["rss_mb"] = current_rss_mb()
+        return result
+
+    rows = []
+    for k in ks if NO_RERANK in rerank_models else ():
+        ranked = [[doc_key(d) for d in docs] for docs in candidates[k]]
+        rows.append(row(NO_RERANK, k, 1, ranked, None, None))
+
+    for name in (m for m in rerank_models if m != NO_RERANK):
+        logger.info("Evaluating rerank model %s", name)
+        model, model_rss = load_reranker(name)
+        for depth in sorted({k * m for k in ks for m in multipliers}):
+            ranked, rerank = [], []
+            for question, docs in zip(questions, candidates[depth]):
+                samples = []
+                for _ in range(repeat):
+                    reranked, timings = timed(retriever_node.rerank_documents, question, docs,
+                                              top_k=len(docs), model=model)
+                    samples.append(timings.get("rerank", 0.0))
+                ranked.append([doc_key(d) for d in reranked])
+                rerank.append(samples)
+            for k in ks:
+                for multiplier in multipliers:
+                    if k * multiplier == depth:
+                        rows.append(row(name, k, multiplier, ranked, rerank, model_rss))
+        del model
+        gc.collect()
+    return rows
+
+
+def best_configuration(rows: List[Dict[str, Any]], target: float) -> Optional[Dict[str, Any]]:
+    '''The configuration with the lowest total p95 among those reaching the target recall.'''
+    passing = [r for r in rows if r["recall"] >= target]
+    return min(passing, key=lambda r: (r["total_p95_ms"], -r["recall"])) if passing else None
+
+
+def write_results(prefix: str, rows: List[Dict[str, Any]], meta: Dict[str, Any]):
+    '''Write the rows to <prefix>.csv and the rows with the metadata to <prefix>.json.'''
+    directory = os.path.dirname(prefix)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(f"{prefix}.csv", "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(f"{prefix}.json", "w", encoding="utf-8") as f:
+        json.dump({"meta": meta, "results": rows}, f, indent=2)
+        f.write("\n")
+    logger.info("Wrote %s.csv and %s.json", prefix, prefix)
+
+
+def _int_list(value: str) -> List[int]:
+    return sorted({int(v) for v in value.split(",") if v.strip()})
+
+
+def main():
+    '''Command line entry point.'''
+    load_dotenv(os.path.join(ROOT, ".env"))
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", 1)[0])
+    parser.add_argument("--labels", default=DEFAULT_LABELS,
+                        help="labelled questions (JSON list or JSON lines)")
+    parser.add_argument("--k", type=_int_list, default=[1, 3, 5, 10],
+                        help="comma separated numbers of documents kept")
+    parser.add_argument("--multipliers", type=_int_list, default=[1, 2, 3, 5],
+                        help="comma separated candidate multipliers (candidates = k * multiplier)")
+    parser.add_argument("--rerank-models", default=f"{NO_RERANK},{os.getenv('RERANK_MODEL', '')}",
+                        help=f"comma separated CrossEncoder models, each optionally with @backend, "
+                             f"'{NO_RERANK}' for no rerank")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="timed repetitions of each stage per question")
+    parser.add_argument("--target-recall", type=float, default=0.9,
+                        help="recall the suggested configuration must reach")
+    parser.add_argument("--output", default=os.path.join("data", "retrieval_sweep"),
+                        help="path prefix of the CSV and JSON results")
+    args = parser.parse_args()
+
+    labels = load_labels(args.labels)
+    rerank_models = [m.strip() for m in args.rerank_models.split(",") if m.strip()]
+    logger.info("Sweeping %d questions, k=%s, multipliers=%s, rerank=%s", len(labels),
+                args.k, args.multipliers, rerank_models)
+
+    # the pipeline logs every rerank call
+    logging.getLogger().setLevel(logging.WARNING)
+    start = time.perf_counter()
+    rows = sweep(labels, args.k, args.multipliers, rerank_models, max(1, args.repeat))
+
+    meta = {
+        "labels": os.path.relpath(args.labels, ROOT),
+        "questions": len(labels),
+        "repeat": args.repeat,
+        "embed_model": os.getenv("EMBED_MODEL"),
+        "vector_store": os.getenv("VECTOR_STORE_DIR"),
+        "seconds": round(time.perf_counter() - start, 3),
+        "peak_rss_mb": peak_rss_mb(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    write_results(args.output, rows, meta)
+
+    for r in rows:
+        logger.info("%-40s k=%-3d x%-2d recall %.3f  mrr %.3f  total p95 %8.2f ms",
+                    r["rerank_model"], r["k"], r["multiplier"], r["recall"], r["mrr"],
+                    r["total_p95_ms"])
+    best = best_configuration(rows, args.target_recall)
+    if best is None:
+        logger.warning("No configuration reaches recall %.2f", args.target_recall)
+        return
+    # with a multiplier of 1 the rerank only reorders the documents the
+    # vector search kept, so recall is the same as without it
+    name, _, backend = best["rerank_model"].partition("@")
+    settings = (f"TOP_K={best['k']} RERANK_CANDIDATE_MULTIPLIER={best['multiplier']} "
+                f"RERANK_MODEL={name}")
+    if backend:
+        settings += f" RERANK_BACKEND={backend}"
+    logger.info("Cheapest configuration with recall >= %.2f: %s (recall %.3f, total p95 %.2f ms)",
+                args.target_recall, settings, best["recall"], best["total_p95_ms"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+'''Offline end-to-end benchmark of the query pipeline.
+
+Builds the XPTO database with synthetic data in a work directory, ingests it into
+a fresh vector store and replays a question corpus against
+``query_service.query`` and the FastAPI app at each requested concurrency.
+The LLM is replaced by a local stub that answers each corpus question with its
+reference SQL after a fixed delay, and the Hugging Face libraries run in
+offline mode, so no network is used: the embedding and rerank models must
+already be in the local model cache.
+
+The report has p50/p95/p99 latency per pipeline stage (from the same spans
+that feed ``/metrics``), throughput, error count and peak RSS, and is written
+as JSON. Given a stored baseline, stages and throughput that got worse than
+the tolerance are listed and the exit status is 1.
+
+Usage:
+    uv run benchmarks/run_benchmark.py --output bench.json
+    uv run benchmarks/run_benchmark.py --baseline benchmarks/baseline.json
+    uv run benchmarks/run_benchmark.py --baseline benchmarks/baseline.json --save-baseline
+'''
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import shutil
+import sqlite3
+import statistics
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from dotenv import load_dotenv
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("benchmark")
+logger.setLevel(logging.INFO)
+
+DEFAULT_QUESTIONS = os.path.join(ROOT, "benchmarks", "questions.json")
+PERCENTILES = (50, 95, 99)
+
+
+def configure_environment(workdir: str, cache: bool):
+    '''Point the pipeline at the benchmark database and keep it offline.
+
+    Must run before any pipeline module is imported, since they read their
+    settings at import time.
+    '''
+    load_dotenv(os.path.join(ROOT, ".env"))
+    os.environ.update({
+        "DATABASE_PATH": os.path.join(workdir, "xpto_empresa.db"),
+        "VECTOR_STORE_DIR": os.path.join(workdir, "vector_store"),
+        "VECTOR_COLLECTION": "benchmark",
+        "SQL_LOG_PATH": "",
+        "MATERIALIZED_DB_PATH": "",
+        "PROFILE_SAMPLE_RATE": "0",
+        "RESULT_CACHE_MAX_BYTES": os.environ.get("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024))
+                                  if cache else "0",
+        "HF_HUB_OFFLINE": "1",
+        "TRANSFORMERS_OFFLINE": "1",
+        "ANONYMIZED_TELEMETRY": "False",
+    })
+    os.environ.setdefault("TOP_K", "5")
+    os.environ.setdefault("LLM_MODEL", "stub")
+    os.environ.setdefault("LLM_API_KEY", "offline")
+    for name in ("EMBED_MODEL", "RERANK_MODEL"):
+        if not os.getenv(name):
+            raise SystemExit(f"{name} is not set; it must name a model in the local cache")
+
+
+def build_database(db_path: str, scale: float):
+    '''Create the XPTO database with synthetic data at the given scale.'''
+    from scripts.create_xpto_db import create_xpto_database  # pylint: disable=import-outside-toplevel
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    create_xpto_database(db_path, scale=scale)
+    conn = sqlite3.connect(db_path)
+    try:
+        counts = {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+                  for t in ("clientes", "produtos", "vendas", "itens_venda")}
+    finally:
+        conn.close()
+    logger.info("Built %s with %s", db_path, counts)
+
+
+class StubLLM:
+    '''Local stand-in for the chat model.
+
+    Answers each corpus question with its reference SQL after a fixed delay,
+    so the benchmark measures the pipeline rather than a remote service.
+    '''
+    _question = re.compile(r"Question:\s*(.*?)\s*Rules:", re.DOTALL)
+
+    def __init__(self, answers: Dict[str, str], latency: float):
+        self.answers = answers
+        self.latency = latency
+
+    def _answer(self, prompt: str):
+        from langchain_core.messages import AIMessage  # pylint: disable=import-outside-toplevel
+
+        match = self._question.search(str(prompt))
+        question = match.group(1) if match else ""
+        return AIMessage(content=self.answers.get(question, "SELECT 1"))
+
+    def invoke(self, prompt):
+        '''Answer after the configured delay, blocking the caller.'''
+        time.sleep(self.latency)
+        return self._answer(prompt)
+
+    async def ainvoke(self, prompt):
+        '''Answer after the configured delay without blocking the event loop.'''
+        await asyncio.sleep(self.latency)
+        return self._answer(prompt)
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    '''Return the p50/p95/p99 of the values in milliseconds.'''
+    if not values:
+        return {}
+    if len(values) == 1:
+        cuts = [values[0]] * 99
+    else:
+        cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {f"p{p}": round(cuts[p - 1] * 1000, 3) for p in PERCENTILES}
+
+
+def peak_rss_mb() -> float:
+    '''Peak resident set size of the process in MiB.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def summarize(mode: str, concurrency: int, samples: List[Dict[str, float]],
+              errors: int, elapsed: float) -> Dict[str, Any]:
+    '''Aggregate the per-request timings of one run.'''
+    stages: Dict[str, List[float]] = {}
+    for timings in samples:
+        for stage, seconds in timings.items():
+            stages.setdefault(stage, []).append(seconds)
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "requests": len(samples) + errors,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(samples) / elapsed, 3) if elapsed else 0.0,
+        "latency_ms": {stage: percentiles(values) for stage, values in sorted(stages.items())},
+    }
+
+
+def replay_service(questions: List[str], concurrency: int) -> Dict[str, Any]:
+    '''Replay the questions through query_service.query from a thread pool.'''
+    from metrics import request_timings  # pylint: disable=import-outside-toplevel
+    from query_service import QueryRequest, query  # pylint: disable=import-outside-toplevel
+
+    samples: List[Dict[str, float]] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def run_one(question: str):
+        nonlocal errors
+        timings: Dict[str, float] = {}
+        token = request_timings.set(timings)
+        start = time.perf_counter()
+        try:
+            query(QueryRequest(question=question))
+        except Exception as e:  # pylint: disable=broad-except
+            logger.debug("Request failed: %s", e)
+            with lock:
+                errors += 1
+            return
+        finally:
+            request_timings.reset(token)
+        timings["total"] = time.perf_counter() - start
+        with lock:
+            samples.append(timings)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run_one, questions))
+    return summarize("service", concurrency, samples, errors, time.perf_counter() - start)
+
+
+def _parse_server_timing(header: str) -> Dict[str, float]:
+    timings = {}
+    for entry in filter(None, (e.strip() for e in header.split(","))):
+        name, _, dur = entry.partition(";dur=")
+        if dur:
+            timings[name] = float(dur) / 1000
+    return timings
+
+
+def replay_api(questions: List[str], concurrency: int) -> Dict[str, Any]:
+    '''Replay the questions through POST /query of the in-process FastAPI app.'''
+    import httpx  # pylint: disable=import-outside-toplevel
+    from api import app  # pylint: disable=import-outside-toplevel
+
+    samples: List[Dict[str, float]] = []
+    errors = 0
+
+    async def run():
+        nonlocal errors
+        pending = iter(questions)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark",
+                                     timeout=None) as client:
+            async def worker():
+                nonlocal errors
+                for question in pending:
+                    start = time.perf_counter()
+                    resp = await client.post("/query", json={"question": question},
+                                             headers={"X-Timing": "1"})
+                    elapsed = time.perf_counter() - start
+                    if resp.status_code != 200 or not resp.json().get("success"):
+                        errors += 1
+                        continue
+                    timings = _parse_server_timing(resp.headers.get("Server-Timing", ""))
+                    timings["total"] = elapsed
+                    samples.append(timings)
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    return summarize("api", concurrency, samples, errors, time.perf_counter() - start)
+
+
+REPLAYS = {"service": replay_service, "api": replay_api}
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float,
+            min_delta_ms: float) -> List[str]:
+    '''List the measurements of the report that regressed against the baseline.'''
+    regressions = []
+    for key, run in report["runs"].items():
+        base = baseline.get("runs", {}).get(key)
+        if base is None:
+            continue
+        for stage, stats in run["latency_ms"].items():
+            before = base["latency_ms"].get(stage, {}).get("p95")
+            after = stats.get("p95")
+            if before is None or after is None:
+                continue
+            if after > before * (1 + tolerance) and after - before > min_delta_ms:
+                regressions.append(f"{key} {stage} p95 {before:.1f} ms -> {after:.1f} ms")
+        if run["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{key} throughput {base['throughput_rps']:.2f} -> "
+                               f"{run['throughput_rps']:.2f} req/s")
+        if run["errors"] > base["errors"]:
+            regressions.append(f"{key} errors {base['errors']} -> {run['errors']}")
+    before_rss, after_rss = baseline.get("peak_rss_mb"), report["peak_rss_mb"]
+    if before_rss and after_rss > before_rss * (1 + tolerance):
+        regressions.append(f"peak RSS {before_rss:.1f} MiB -> {after_rss:.1f} MiB")
+    return regressions
+
+
+def main():
+    '''Command line entry point.'''
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", 1)[0])
+    parser.add_argument("--workdir", default=os.path.join(ROOT, "data", "benchmark"),
+                        help="directory for the scaled database and vector store")
+    parser.add_argument("--reuse", action="store_true",
+                        help="reuse the database and vector store of a previous run")
+    parser.add_argument("--scale", type=float, default=0.05,
+                        help="synthetic data scale of create_xpto_db.py (1 = 20k sales)")
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS, help="question corpus (JSON)")
+    parser.add_argument("--requests", type=int, default=200, help="requests per run")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests before the runs")
+    parser.add_argument("--concurrency", default="1,4,16",
+                        help="comma separated concurrency levels")
+    parser.add_argument("--mode", choices=("service", "api", "both"), default="both")
+    parser.add_argument("--llm-latency-ms", type=float, default=50.0,
+                        help="delay of the stub LLM per call")
+    parser.add_argument("--cache", action="store_true", help="keep the SQL result cache enabled")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="stored report to compare against")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="write the report to --baseline instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative slowdown reported as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="ignore latency changes smaller than this")
+    args = parser.parse_args()
+    if args.save_baseline and not args.baseline:
+        parser.error("--save-baseline needs --baseline")
+
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+    configure_environment(workdir, args.cache)
+    with open(args.questions, encoding="utf-8") as f:
+        corpus = json.load(f)
+
+    ingest_seconds = None
+    if not (args.reuse and os.path.exists(os.environ["DATABASE_PATH"])):
+        build_database(os.environ["DATABASE_PATH"], args.scale)
+        shutil.rmtree(os.environ["VECTOR_STORE_DIR"], ignore_errors=True)
+        import ingest_pipeline  # pylint: disable=import-outside-toplevel
+
+        start = time.perf_counter()
+        ingest_pipeline.main()
+        ingest_seconds = round(time.perf_counter() - start, 3)
+
+    import sql_node  # pylint: disable=import-outside-toplevel
+
+    sql_node.LLM = StubLLM({q["question"]: q["sql"] for q in corpus}, args.llm_latency_ms / 1000)
+    # per-request logs of the pipeline would dominate the replay
+    logging.getLogger().setLevel(logging.WARNING)
+    for name in ("query_service", "api", "httpx"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    questions = [corpus[i % len(corpus)]["question"] for i in range(args.requests)]
+    modes = ("service", "api") if args.mode == "both" else (args.mode,)
+    runs: Dict[str, Any] = {}
+    for mode in modes:
+        REPLAYS[mode](questions[:args.warmup], 1)
+        for concurrency in (int(c) for c in args.concurrency.split(",")):
+            logger.info("Running %s with concurrency %d", mode, concurrency)
+            run = REPLAYS[mode](questions, concurrency)
+            runs[f"{mode}@{concurrency}"] = run
+            logger.info("%s@%d: %.2f req/s, total p95 %s ms, %d errors", mode, concurrency,
+                        run["throughput_rps"], run["latency_ms"].get("total", {}).get("p95"),
+                        run["errors"])
+
+    report = {
+        "meta": {
+            "scale": args.scale,
+            "requests": args.requests,
+            "llm_latency_ms": args.llm_latency_ms,
+            "cache": args.cache,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "ingest_seconds": ingest_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        "runs": runs,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        logger.info("Saved baseline to %s", args.baseline)
+    elif args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance, args.min_delta_ms)
+        for line in regressions:
+            logger.warning("Regression: %s", line)
+        if regressions:
+            sys.exit(1)
+        logger.info("No regressions against %s", args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+'''Registry of the databases the service answers questions about.
+
+``DATABASES_CONFIG`` names a JSON file mapping a database id to its settings::
+
+    {
+        "xpto": {"path": "data/xpto_empresa.db", "vector_store_dir": "data/vector_store",
+                 "collection": "xpto_database_embeddings"},
+        "acme": {"path": "data/acme.db", "allowed_tables": ["pedidos", "clientes"]}
+    }
+
+``vector_store_dir`` defaults to ``<VECTOR_STORE_DIR>/<id>`` and
+``collection`` to the id, so each database has its own pointer file and
+generations (ingest it with the environment printed by
+``python databases.py --env <id>``). Databases can't share a
+``vector_store_dir``, as unloading one releases the whole directory; only
+the database served by ``VECTOR_STORE_DIR`` and ``VECTOR_COLLECTION`` may
+use ``VECTOR_STORE_DIR`` itself. ``allowed_tables`` restricts the tables
+its SQL may read, by default every table of the database. Requests without a
+database use ``DEFAULT_DATABASE``, or the first one configured. Without a
+config file the only database is the one of ``DATABASE_PATH``,
+``VECTOR_STORE_DIR`` and ``VECTOR_COLLECTION``, as before.
+
+A database is loaded on its first request: its schema catalog is read and its
+vector collection opened, while the embedding, rerank and LLM models are
+shared by all of them. Loaded databases are kept in LRU order and, when their
+estimated memory goes over ``DATABASES_MEMORY_BUDGET_MB``, the least recently
+used ones that no request is using are unloaded.
+'''
+import os
+import json
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+from dotenv import load_dotenv
+
+from metrics import Counter, Gauge
+from result_cache import result_cache
+from sql_validator import allowed_tables_from_db
+from vector_generations import MissingCollection
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+DATABASES_CONFIG = os.getenv("DATABASES_CONFIG", "")
+DEFAULT_DATABASE = os.getenv("DEFAULT_DATABASE", "")
+DATABASES_MEMORY_BUDGET_MB = float(os.getenv("DATABASES_MEMORY_BUDGET_MB", "1024"))
+# memory of one indexed document besides its vector: the links of the HNSW
+# graph (M=16) and bookkeeping
+INDEX_BYTES_PER_DOCUMENT = 256
+
+LOADS = Counter("database_loads_total", "Databases loaded on demand.")
+EVICTIONS = Counter("database_evictions_total", "Databases unloaded to stay within the memory budget.")
+
+
+class UnknownDatabase(ValueError):
+    '''The request names a database that isn't configured.'''
+
+
+@dataclass
+class DatabaseConfig:
+    '''Settings of one database.'''
+    id: str
+    path: str
+    vector_store_dir: str
+    collection: str
+    allowed_tables: Optional[List[str]] = None
+
+
+class DatabaseContext:
+    '''Resources of a loaded database: its schema catalog and vector collection.'''
+
+    def __init__(self, config: DatabaseConfig, store, pinned: bool = False):
+        self.config = config
+        self.store = store
+        # the store of the configured database is shared with retriever_node
+        # and stays loaded
+        self.pinned = pinned
+        if not os.path.exists(config.path):
+            # connecting would create an empty database
+            logger.error("Database %s has no file at %s", config.id, config.path)
+            raise UnknownDatabase(f"database {config.id} is not available")
+        try:
+            store.reload()
+        except MissingCollection:
+            # opening it would serve SQL generated without any schema context
+            logger.error("Database %s has no collection %s in %s, ingest it with the "
+                         "environment of `databases.py --env %s`", config.id,
+                         config.collection, config.vector_store_dir, config.id)
+            raise UnknownDatabase(f"database {config.id} is not available") from None
+        tables = allowed_tables_from_db(config.path)
+        if config.allowed_tables is not None:
+            tables &= set(config.allowed_tables)
+        self.allowed_tables: Set[str] = tables
+        self.leases = 0
+        self.resident_bytes = self._estimate_bytes()
+
+    def _estimate_bytes(self) -> int:
+        '''Memory held by the vector index of the collection once it is searched.'''
+        import retriever_node  # pylint: disable=import-outside-toplevel
+
+        per_document = retriever_node.embedding_dimension() * 4 + INDEX_BYTES_PER_DOCUMENT
+        return self.store.count() * per_document
+
+    def close(self):
+        '''Release the vector store and the cached results of the database.'''
+        if not self.pinned:
+            self.store.close()
+        result_cache.forget(self.config.path)
+
+
+def _config_from_env() -> Dict[str, DatabaseConfig]:
+    '''The single database of DATABASE_PATH, VECTOR_STORE_DIR and VECTOR_COLLECTION.'''
+    name = DEFAULT_DATABASE or "default"
+    return {name: DatabaseConfig(id=name, path=os.getenv("DATABASE_PATH"),
+                                 vector_store_dir=os.getenv("VECTOR_STORE_DIR"),
+                                 collection=os.getenv("VECTOR_COLLECTION"))}
+
+
+def load_config(path: str = DATABASES_CONFIG) -> Dict[str, DatabaseConfig]:
+    '''Read the database settings, or derive them from the environment without a file.'''
+    if not path:
+        return _config_from_env()
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+    if not raw:
+        raise ValueError(f"No databases configured in {path}")
+    store_root = os.getenv("VECTOR_STORE_DIR") or "data/vector_store"
+    configs = {name: DatabaseConfig(
+        id=name,
+        path=settings["path"],
+        vector_store_dir=settings.get("vector_store_dir") or os.path.join(store_root, name),
+        collection=settings.get("collection") or name,
+        allowed_tables=settings.get("allowed_tables"),
+    ) for name, settings in raw.items()}
+
+    # the default store of retriever_node is always open on VECTOR_STORE_DIR
+    owners = {os.path.abspath(store_root): None}
+    for config in configs.values():
+        store_dir = os.path.abspath(config.vector_store_dir)
+        if store_dir == os.path.abspath(store_root):
+            if config.collection != os.getenv("VECTOR_COLLECTION"):
+                raise ValueError(f"Database {config.id} uses VECTOR_STORE_DIR with another "
+                                 "collection than VECTOR_COLLECTION, give it its own vector_store_dir")
+        elif store_dir in owners:
+            raise ValueError(f"Databases {owners[store_dir]} and {config.id} share the "
+                             f"vector store {config.vector_store_dir}")
+        owners[store_dir] = config.id
+    return configs
+
+
+class DatabaseRegistry:
+    '''Loads databases on demand and unloads idle ones over the memory budget.'''
+
+    def __init__(self, configs: Dict[str, DatabaseConfig], default: str, budget_bytes: int):
+        if default not in configs:
+            raise ValueError(f"Default database {default!r} is not configured")
+        self.configs = configs
+        self.default = default
+        self.budget_bytes = budget_bytes
+        self._loaded: "OrderedDict[str, DatabaseContext]" = OrderedDict()
+        self._loading: Dict[str, threading.Lock] = {}
+        # unloaded databases still being closed; they are loaded again once
+        # their vector store is released
+        self._closing: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def config(self, database: Optional[str] = None) -> DatabaseConfig:
+        '''Settings of a database, the default one when none is given.'''
+        try:
+            return self.configs[database or self.default]
+        except KeyError:
+            raise UnknownDatabase(f"unknown database: {database}") from None
+
+    def database_path(self, database: Optional[str] = None) -> str:
+        '''Path of the SQLite file of a database.'''
+        return self.config(database).path
+
+    def _lease(self, name: str) -> Optional[DatabaseContext]:
+        '''Take a loaded context, marking it most recently used. Call with the lock held.'''
+        ctx = self._loaded.get(name)
+        if ctx is not None:
+            self._loaded.move_to_end(name)
+            ctx.leases += 1
+        return ctx
+
+    def acquire(self, database: Optional[str] = None) -> DatabaseContext:
+        '''Return the loaded database, loading it if needed.
+
+        Blocks on I/O the first time. The context can't be unloaded until it
+        is given back with release().
+        '''
+        config = self.config(database)
+        with self._lock:
+            ctx = self._lease(config.id)
+            if ctx is not None:
+                return ctx
+            loading = self._loading.setdefault(config.id, threading.Lock())
+        with loading:
+            with self._lock:
+                # loaded by another request while this one waited
+                ctx = self._lease(config.id)
+                closing = self._closing.get(config.id)
+            if ctx is not None:
+                return ctx
+            if closing is not None:
+                closing.wait()
+            ctx = self._load(config)
+            with self._lock:
+                ctx.leases += 1
+                self._loaded[config.id] = ctx
+                evicted = self._evict()
+        LOADS.inc()
+        for old in evicted:
+            self._close(old)
+        logger.info("Loaded database %s (%d tables, ~%.1f MiB)", config.id,
+                    len(ctx.allowed_tables), ctx.resident_bytes / (1024 * 1024))
+        return ctx
+
+    def release(self, ctx: DatabaseContext):
+        '''Give back a context taken with acquire().'''
+        with self._lock:
+            ctx.leases -= 1
+
+    def _unload(self, name: str) -> DatabaseContext:
+        '''Take a database out of the loaded ones. Call with the lock held, then _close it.'''
+        self._closing[name] = threading.Event()
+        return self._loaded.pop(name)
+
+    def _close(self, ctx: DatabaseContext):
+        try:
+            ctx.close()
+        finally:
+            with self._lock:
+                done = self._closing.pop(ctx.config.id)
+            done.set()
+
+    @contextmanager
+    def leased(self, database: Optional[str] = None) -> Iterator[DatabaseContext]:
+        '''Use a database for the duration of the block.'''
+        ctx = self.acquire(database)
+        try:
+            yield ctx
+        finally:
+            self.release(ctx)
+
+    @staticmethod
+    def _load(config: DatabaseConfig) -> DatabaseContext:
+        import retriever_node  # pylint: disable=import-outside-toplevel
+
+        shared = retriever_node.default_store
+        if (config.vector_store_dir, config.collection) == (shared.store_dir, shared.base_collection):
+            return DatabaseContext(config, shared, pinned=True)
+        store = retriever_node.CollectionStore(config.vector_store_dir, config.collection)
+        return DatabaseContext(config, store)
+
+    @property
+    def loaded(self) -> int:
+        '''Number of loaded databases.'''
+        return len(self._loaded)
+
+    def resident_bytes(self) -> int:
+        '''Estimated memory of the loaded databases.'''
+        with self._lock:
+            return sum(ctx.resident_bytes for ctx in self._loaded.values())
+
+    def _evict(self) -> List[DatabaseContext]:
+        '''Unload idle databases, oldest first, until the budget is met. Call with the lock held.'''
+        total = sum(ctx.resident_bytes for ctx in self._loaded.values())
+        evicted = []
+        for name, ctx in list(self._loaded.items()):
+            if total <= self.budget_bytes:
+                break
+            if ctx.leases or ctx.pinned:
+                continue
+            evicted.append(self._unload(name))
+            total -= ctx.resident_bytes
+            EVICTIONS.inc()
+            logger.info("Unloaded database %s to stay within the memory budget", name)
+        if total > self.budget_bytes:
+            logger.warning("Loaded databases use ~%.1f MiB, over the %.1f MiB budget, "
+                           "but the rest are in use", total / (1024 * 1024),
+                           self.budget_bytes / (1024 * 1024))
+        return evicted
+
+    def unload(self, database: str) -> bool:
+        '''Unload an idle database now. Returns False if it isn't loaded or is in use.'''
+        name = self.config(database).id
+        with self._lock:
+            ctx = self._loaded.get(name)
+            if ctx is None or ctx.leases or ctx.pinned:
+                return False
+            self._unload(name)
+        self._close(ctx)
+        return True
+
+    def status(self) -> Dict[str, Any]:
+        '''Configured and loaded databases, most recently used last.'''
+        with self._lock:
+            loaded = {name: {"tables": sorted(ctx.allowed_tables),
+                             "collection": ctx.store.collection,
+                             "resident_mb": round(ctx.resident_bytes / (1024 * 1024), 3),
+                             "in_use": ctx.leases, "pinned": ctx.pinned}
+                      for name, ctx in self._loaded.items()}
+        return {"default": self.default, "configured": sorted(self.configs),
+                "budget_mb": round(self.budget_bytes / (1024 * 1024), 3), "loaded": loaded}
+
+
+def _registry_from_env() -> DatabaseRegistry:
+    configs = load_config()
+    return DatabaseRegistry(configs, DEFAULT_DATABASE or next(iter(configs)),
+                            int(DATABASES_MEMORY_BUDGET_MB * 1024 * 1024))
+
+
+registry = _registry_from_env()
+
+Gauge("databases_loaded", "Databases with their resources loaded.", lambda: registry.loaded)
+Gauge("databases_resident_bytes", "Estimated memory of the loaded databases.",
+    registry.resident_bytes)
+
+
+def main():
+    '''Command line entry point.'''
+    parser = argparse.ArgumentParser(description="List the configured databases.")
+    parser.add_argument("--env", metavar="ID",
+                        help="print the environment that points ingest_pipeline.py at a database")
+    args = parser.parse_args()
+
+    if args.env:
+        config = registry.config(args.env)
+        print(f"DATABASE_PATH={config.path}\nVECTOR_STORE_DIR={config.vector_store_dir}\n"
+              f"VECTOR_COLLECTION={config.collection}")
+        return
+    for name, config in registry.configs.items():
+        marker = "*" if name == registry.default else " "
+        print(f"{marker} {name}: {config.path} -> {config.vector_store_dir} ({config.collection})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+'''Workload-driven index advisor for the target SQLite database.
+
+Reads the executed SQL log (see ``query_log``), mines the filter, join and
+ordering columns of every query from its sqlglot AST and derives candidate
+indexes. Each candidate is created on a scratch copy of the database, where
+the affected queries are re-planned with ``EXPLAIN QUERY PLAN`` and timed
+before and after, and the candidates are ranked by the total time they save
+weighted by how often the queries run.
+
+Usage:
+    uv run index_advisor.py                 # print the ranked report
+    uv run index_advisor.py --json          # machine-readable report
+    uv run index_advisor.py --apply --top 3 # create the best indexes
+'''
+import os
+import json
+import time
+import shutil
+import sqlite3
+import logging
+import argparse
+import tempfile
+import statistics
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+import sqlglot
+from sqlglot import exp
+from sqlglot.optimizer.qualify import qualify
+from dotenv import load_dotenv
+
+from query_log import read_log
+from result_cache import canonical_sql
+from sql_executor import enforce_limit
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RANGE_OPS = (exp.GT, exp.GTE, exp.LT, exp.LTE, exp.Between, exp.Like)
+
+
+@dataclass
+class Candidate:
+    '''A candidate index and the queries that may benefit from it.'''
+    table: str
+    columns: Tuple[str, ...]
+    queries: Set[str] = field(default_factory=set)
+    gain_ms: float = 0.0
+    plans_changed: int = 0
+
+    @property
+    def name(self) -> str:
+        '''Index name used when the candidate is created.'''
+        return f"idx_{self.table}_{'_'.join(self.columns)}"
+
+    @property
+    def ddl(self) -> str:
+        '''CREATE INDEX statement for the candidate.'''
+        cols = ", ".join(f'"{c}"' for c in self.columns)
+        return f'CREATE INDEX IF NOT EXISTS "{self.name}" ON "{self.table}" ({cols})'
+
+
+def load_schema(conn: sqlite3.Connection) -> Dict[str, Dict[str, str]]:
+    '''Return {table: {column: type}} for the user tables of the database.'''
+    tables = [t[0] for t in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")]
+    return {t: {c[1]: c[2] or "TEXT" for c in conn.execute(f'PRAGMA table_info("{t}")')}
+            for t in tables}
+
+
+def indexed_prefixes(conn: sqlite3.Connection, schema: Dict[str, Dict[str, str]]) -> Set[Tuple]:
+    '''Return the (table, leading columns) already served by an index.'''
+    covered = set()
+    for table in schema:
+        for col in conn.execute(f'PRAGMA table_info("{table}")'):
+            # INTEGER PRIMARY KEY columns are the rowid itself
+            if col[5] == 1 and (col[2] or "").upper() == "INTEGER":
+                covered.add((table, (col[1],)))
+        for idx in conn.execute(f'PRAGMA index_list("{table}")'):
+            cols = tuple(c[2] for c in conn.execute(f'PRAGMA index_info("{idx[1]}")'))
+            for i in range(1, len(cols) + 1):
+                covered.add((table, cols[:i]))
+    return covered
+
+
+def _column_ref(node: exp.Expression, aliases: Dict[str, str]) -> Optional[Tuple[str, str]]:
+    '''Return (table, column) when the node is a plain column of a base table.'''
+    if isinstance(node, exp.Column) and node.table in aliases:
+        return aliases[node.table], node.name
+    return None
+
+
+def mine_query(sql: str, schema: Dict[str, Dict[str, str]]) -> Dict[str, Dict[str, List[str]]]:
+    '''Extract the equality, range, join and ordering columns used per table.'''
+    try:
+        parsed = qualify(sqlglot.parse_one(sql, read="sqlite"), schema=schema,
+                        dialect="sqlite", validate_qualify_columns=False)
+    except Exception as e:  # pylint: disable=broad-except
+        logger.debug("Skipping unparseable query %s: %s", sql, e)
+        return {}
+    aliases = {t.alias_or_name: t.name for t in parsed.find_all(exp.Table) if t.name in schema}
+    usage: Dict[str, Dict[str, List[str]]] = defaultdict(lambda: defaultdict(list))
+
+    for join in parsed.find_all(exp.Join):
+        for eq in (join.args.get("on") or exp.true()).find_all(exp.EQ):
+            for side in (eq.left, eq.right):
+                ref = _column_ref(side, aliases)
+                if ref:
+                    usage[ref[0]]["join"].append(ref[1])
+
+    for where in parsed.find_all(exp.Where):
+        for node in where.find_all(exp.EQ, exp.In, *RANGE_OPS):
+            kind = "range" if isinstance(node, RANGE_OPS) else "eq"
+            left, right = node.this, node.expression if not isinstance(node, exp.In) else None
+            for side, other in ((left, right), (right, left)):
+                ref = _column_ref(side, aliases) if side is not None else None
+                if ref and _column_ref(other, aliases) is None:
+                    usage[ref[0]][kind].append(ref[1])
+
+    for clause in ("group", "order"):
+        for node in parsed.find_all(exp.Group if clause == "group" else exp.Order):
+            for item in node.expressions:
+                ref = _column_ref(item.this if isinstance(item, exp.Ordered) else item, aliases)
+                if ref:
+                    usage[ref[0]]["sort"].append(ref[1])
+    return usage
+
+
+def candidates_for(usage: Dict[str, Dict[str, List[str]]]) -> List[Tuple[str, Tuple[str, ...]]]:
+    '''Derive candidate indexes from the columns one query uses.'''
+    found = []
+    for table, kinds in usage.items():
+        eq = list(dict.fromkeys(kinds["eq"]))
+        for col in dict.fromkeys(kinds["join"] + eq + kinds["range"] + kinds["sort"]):
+            found.append((table, (col,)))
+        # equality columns first, then a single range or sort column
+        tail = next(iter(kinds["range"] + kinds["sort"]), None)
+        composite = tuple(eq + ([tail] if tail and tail not in eq else []))
+        if len(composite) > 1:
+            found.append((table, composite))
+    return found
+
+
+class Scratch:
+    '''A scratch copy of the database where candidate indexes are tried.'''
+
+    def __init__(self, db_path: str):
+        self.dir = tempfile.mkdtemp(prefix="index_advisor_")
+        self.path = os.path.join(self.dir, "scratch.db")
+        src = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        self.conn = sqlite3.connect(self.path)
+        src.backup(self.conn)
+        src.close()
+        self.conn.execute("ANALYZE")
+
+    def plan(self, sql: str) -> str:
+        '''Return the EXPLAIN QUERY PLAN output as one string.'''
+        return "\n".join(r[-1] for r in self.conn.execute(f"EXPLAIN QUERY PLAN {sql}"))
+
+    def time(self, sql: str, repeat: int) -> float:
+        '''Median execution time of the query in milliseconds.'''
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            self.conn.execute(sql).fetchall()
+            samples.append((time.perf_counter() - start) * 1000)
+        return statistics.median(samples)
+
+    def close(self):
+        '''Drop the scratch copy.'''
+        self.conn.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def advise(db_path: str, log_path: Optional[str] = None, repeat: int = 5) -> List[Candidate]:
+    '''Evaluate candidate indexes for the logged workload, best first.'''
+    workload: Counter = Counter()
+    for entry in read_log(log_path):
+        if entry.get("db") in (None, db_path):
+            workload[canonical_sql(entry["sql"])] += 1
+    logger.info("Loaded %d distinct queries from the SQL log.", len(workload))
+
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    schema = load_schema(conn)
+    covered = indexed_prefixes(conn, schema)
+    conn.close()
+
+    candidates: Dict[Tuple, Candidate] = {}
+    for sql in workload:
+        for table, cols in candidates_for(mine_query(sql, schema)):
+            if (table, cols) in covered:
+                continue
+            candidates.setdefault((table, cols), Candidate(table, cols)).queries.add(sql)
+    logger.info("Evaluating %d candidate indexes.", len(candidates))
+
+    scratch = Scratch(db_path)
+    try:
+        baseline = {}
+        for sql in workload:
+            try:
+                baseline[sql] = (scratch.plan(sql), scratch.time(enforce_limit(sql), repeat))
+            except sqlite3.Error as e:
+                logger.debug("Skipping query that fails to run %s: %s", sql, e)
+
+        for cand in candidates.values():
+            scratch.conn.execute(cand.ddl)
+            for sql in cand.queries & baseline.keys():
+                plan_before, ms_before = baseline[sql]
+                plan_after = scratch.plan(sql)
+                if plan_after == plan_before or cand.name not in plan_after:
+                    continue
+                cand.plans_changed += 1
+                ms_after = scratch.time(enforce_limit(sql), repeat)
+                cand.gain_ms += workload[sql] * (ms_before - ms_after)
+            scratch.conn.execute(f'DROP INDEX "{cand.name}"')
+    finally:
+        scratch.close()
+
+    ranked = [c for c in candidates.values() if c.plans_changed]
+    ranked.sort(key=lambda c: c.gain_ms, reverse=True)
+    return ranked
+
+
+def apply_indexes(db_path: str, candidates: List[Candidate]):
+    '''Create the given indexes on the real database.'''
+    conn = sqlite3.connect(db_path)
+    try:
+        for cand in candidates:
+            logger.info("Creating index: %s", cand.ddl)
+            conn.execute(cand.ddl)
+        conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def main():
+    '''Command line entry point.'''
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", 1)[0])
+    parser.add_argument("--db", default=os.getenv("DATABASE_PATH"), help="SQLite database")
+    parser.add_argument("--log", default=os.getenv("SQL_LOG_PATH"), help="executed SQL log")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs per query")
+    parser.add_argument("--top", type=int, default=5, help="indexes to report or apply")
+    parser.add_argument("--min-gain-ms", type=float, default=0.0,
+                        help="only apply indexes saving more than this in total")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--apply", action="store_true", help="create the chosen indexes")
+    args = parser.parse_args()
+
+    if not args.log:
+        parser.error("no SQL log given, set SQL_LOG_PATH or pass --log")
+    ranked = advise(args.db, args.log, args.repeat)[:args.top]
+
+    if args.json:
+        print(json.dumps([{"table": c.table, "columns": list(c.columns), "ddl": c.ddl,
+                        "gain_ms": round(c.gain_ms, 3), "queries": len(c.queries),
+                        "plans_changed": c.plans_changed} for c in ranked], indent=2))
+    elif not ranked:
+        print("No index would change the plan of the logged queries.")
+    else:
+        for i, c in enumerate(ranked, 1):
+            print(f"{i}. {c.ddl};")
+            print(f"   saves {c.gain_ms:.2f} ms over the workload, "
+                f"changes the plan of {c.plans_changed}/{len(c.queries)} queries")
+
+    if args.apply:
+        chosen = [c for c in ranked if c.gain_ms > args.min_gain_ms]
+        apply_indexes(args.db, chosen)
+        logger.info("Created %d indexes.", len(chosen))
+
+
+if __name__ == "__main__":
+    main()
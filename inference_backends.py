@@ -0,0 +1,127 @@
+'''Inference backends of the embedding and rerank models.
+
+``torch`` runs the models as downloaded, in full precision. ``int8`` applies
+dynamic int8 quantisation to their linear layers, which on CPU cuts the time
+of query embedding and rerank and the memory of the weights for a small loss
+of accuracy. ``onnx`` runs them with ONNX Runtime through the ONNX backend of
+sentence-transformers (``pip install "sentence-transformers[onnx]"``). It
+loads ``onnx/model.onnx`` from the model directory, or the graph named by
+``EMBED_ONNX_FILE``/``RERANK_ONNX_FILE`` such as a quantised one written by
+``python inference_backends.py --export-onnx``; a model without an exported
+graph is converted when loaded.
+
+``INFERENCE_BACKEND`` selects the backend of both models, ``EMBED_BACKEND``
+and ``RERANK_BACKEND`` override it per model. Questions are compared with
+documents embedded at ingest, so ingest again after changing the embedding
+backend. ``benchmarks/backend_parity.py`` measures what a backend costs in
+ranking agreement with the full precision models.
+'''
+import os
+import logging
+import argparse
+from typing import Any, Dict, Optional
+
+from dotenv import load_dotenv
+from langchain_huggingface import HuggingFaceEmbeddings
+from sentence_transformers import CrossEncoder
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("torch", "int8", "onnx")
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")
+EMBED_BACKEND = os.getenv("EMBED_BACKEND") or INFERENCE_BACKEND
+RERANK_BACKEND = os.getenv("RERANK_BACKEND") or INFERENCE_BACKEND
+EMBED_ONNX_FILE = os.getenv("EMBED_ONNX_FILE", "")
+RERANK_ONNX_FILE = os.getenv("RERANK_ONNX_FILE", "")
+
+
+def _model_kwargs(backend: str, device: Optional[str], onnx_file: str) -> Dict[str, Any]:
+    '''Constructor arguments of the sentence-transformers model for a backend.'''
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+    if backend == "int8":
+        # dynamically quantised layers only have CPU kernels
+        if device not in (None, "cpu"):
+            logger.warning("The int8 backend runs on CPU, ignoring device %s", device)
+        device = "cpu"
+    kwargs: Dict[str, Any] = {"device": device} if device else {}
+    if backend == "onnx":
+        kwargs["backend"] = "onnx"
+        if onnx_file:
+            kwargs["model_kwargs"] = {"file_name": onnx_file}
+    return kwargs
+
+
+def quantize_int8(module):
+    '''Replace the linear layers of a torch module with dynamically quantised int8 ones.'''
+    import torch  # pylint: disable=import-outside-toplevel
+
+    return torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear},
+                                                  dtype=torch.qint8, inplace=True)
+
+
+def load_embeddings(model_name: str, backend: str = None,
+                    device: str = None) -> HuggingFaceEmbeddings:
+    '''Load the embedding model with the given backend (default: EMBED_BACKEND).'''
+    backend = backend or EMBED_BACKEND
+    embeddings = HuggingFaceEmbeddings(model_name=model_name,
+                                       model_kwargs=_model_kwargs(backend, device, EMBED_ONNX_FILE))
+    if backend == "int8":
+        quantize_int8(embeddings._client)  # pylint: disable=protected-access
+    logger.info("Loaded embedding model %s with the %s backend", model_name, backend)
+    return embeddings
+
+
+def load_cross_encoder(model_name: str, backend: str = None, device: str = None) -> CrossEncoder:
+    '''Load the rerank model with the given backend (default: RERANK_BACKEND).'''
+    backend = backend or RERANK_BACKEND
+    model = CrossEncoder(model_name, **_model_kwargs(backend, device, RERANK_ONNX_FILE))
+    if backend == "int8":
+        quantize_int8(model.model)
+    logger.info("Loaded rerank model %s with the %s backend", model_name, backend)
+    return model
+
+
+def export_onnx(model_name: str, output_dir: str, kind: str = "embed",
+                quantize: Optional[str] = None) -> str:
+    '''Export a model as an ONNX graph into output_dir.
+
+    With `quantize` (arm64, avx2, avx512 or avx512_vnni) a dynamically
+    quantised graph for that instruction set is written too. Returns the
+    file to set as EMBED_ONNX_FILE or RERANK_ONNX_FILE, with output_dir as
+    the model name.
+    '''
+    # pylint: disable=import-outside-toplevel
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    cls = SentenceTransformer if kind == "embed" else CrossEncoder
+    model = cls(model_name, backend="onnx", device="cpu")
+    model.save_pretrained(output_dir)
+    if not quantize:
+        return "onnx/model.onnx"
+    export_dynamic_quantized_onnx_model(model, quantize, output_dir)
+    return f"onnx/model_qint8_{quantize}.onnx"
+
+
+def main():
+    '''Command line entry point.'''
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Export a model as an ONNX graph.")
+    parser.add_argument("--export-onnx", metavar="DIR", required=True,
+                        help="directory the exported model is written to")
+    parser.add_argument("--kind", choices=("embed", "rerank"), default="embed",
+                        help="export EMBED_MODEL or RERANK_MODEL")
+    parser.add_argument("--model", help="model to export instead of the configured one")
+    parser.add_argument("--quantize", choices=("arm64", "avx2", "avx512", "avx512_vnni"),
+                        help="also write an int8 graph for this instruction set")
+    args = parser.parse_args()
+
+    model_name = args.model or os.getenv("EMBED_MODEL" if args.kind == "embed" else "RERANK_MODEL")
+    file_name = export_onnx(model_name, args.export_onnx, args.kind, args.quantize)
+    prefix = "EMBED" if args.kind == "embed" else "RERANK"
+    print(f"{prefix}_MODEL={args.export_onnx}\n{prefix}_BACKEND=onnx\n{prefix}_ONNX_FILE={file_name}")
+
+
+if __name__ == "__main__":
+    main()
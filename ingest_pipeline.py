@@ -1,17 +1,23 @@
 '''Main module for the Text-to-SQL Chatbot with RAG application.
 '''
 import os
+import re
+import json
+import random
 import sqlite3
 import hashlib
 import logging
+import argparse
 import torch
 
 
 from tqdm import tqdm
 from dotenv import load_dotenv
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
 
+import vector_generations
+from inference_backends import load_embeddings
+
 # Load environment variables from .env file first
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
@@ -21,63 +27,227 @@ logging.basicConfig(level=logging.INFO)
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 logging.info("Using device: %s", DEVICE)
 
-model = HuggingFaceEmbeddings(model_name=os.getenv("EMBED_MODEL"), model_kwargs={"device": DEVICE})
-
-
-vectorstore = Chroma(
-    collection_name=os.getenv("VECTOR_COLLECTION"),
-    embedding_function=model,
-    persist_directory=os.getenv("VECTOR_STORE_DIR")
-)
+model = load_embeddings(os.getenv("EMBED_MODEL"), device=DEVICE)
 
 logging.info("Embedding function initialized.")
 
+# A new collection is only activated if it holds at least this fraction of
+# the documents of the active one and finds most sampled rows by their own text
+INGEST_MIN_COUNT_RATIO = float(os.getenv("INGEST_MIN_COUNT_RATIO", "0.5"))
+INGEST_MIN_RECALL = float(os.getenv("INGEST_MIN_RECALL", "0.9"))
+INGEST_VALIDATION_SAMPLES = int(os.getenv("INGEST_VALIDATION_SAMPLES", "50"))
+
+
+def open_collection(name):
+    """Open a collection of the vector store."""
+    return Chroma(
+        collection_name=name,
+        embedding_function=model,
+        persist_directory=os.getenv("VECTOR_STORE_DIR")
+    )
+
+# Ingest profiles: which columns of each table are embedded and which are only
+# stored as metadata. They are derived from column_comments and can be
+# overridden per table with a JSON file, e.g.
+# {"clientes": {"embed": ["nome", "cidade"], "metadata": ["email"]}, "fornecedores": {"skip": true}}
+INGEST_PROFILES_PATH = os.getenv("INGEST_PROFILES_PATH", "")
+# longer values are cut before embedding, the model truncates its input anyway
+INGEST_MAX_VALUE_CHARS = int(os.getenv("INGEST_MAX_VALUE_CHARS", "200"))
+
+# tables describing the schema rather than the business
+METADATA_TABLES = {"table_comments", "column_comments"}
+# contact data and documents identify a row but say nothing a question would
+# be matched on, so their values are kept out of the embedded text. Their
+# names and the keys stay in it: the retrieved text is also all the LLM sees
+# of the schema, so it must name every column and show how tables join.
+METADATA_COLUMN_NAMES = re.compile(r"^(email|telefone|endereco|cep|cnpj|cpf|inscricao_estadual)$")
+METADATA_COLUMN_DESCRIPTIONS = re.compile(
+    r"formato (email|telefone|cep|documento)|endereço|inscrição", re.IGNORECASE)
+# stands for the value of a metadata column in the row text
+METADATA_PLACEHOLDER = "<metadata>"
+
+
+def _has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name = ?",
+                        (name,)).fetchone() is not None
+
+def derive_profiles(conn, tables):
+    """Derive the ingest profile of each table from the comment tables."""
+    descriptions, skipped = {}, set(METADATA_TABLES)
+    if _has_table(conn, "column_comments"):
+        for table, column, comment, kind in conn.execute(
+                "SELECT table_name, column_name, comment, data_type_description FROM column_comments"):
+            descriptions[(table, column)] = f"{comment or ''} {kind or ''}"
+    if _has_table(conn, "table_comments"):
+        skipped.update(t for t, c in conn.execute("SELECT table_name, comment FROM table_comments")
+                       if (c or "").startswith("Metadados"))
+
+    profiles = {}
+    for table in tables:
+        cols = [c[1] for c in conn.execute(f"PRAGMA table_xinfo({table});")]
+        metadata = [c for c in cols if METADATA_COLUMN_NAMES.match(c)
+                    or METADATA_COLUMN_DESCRIPTIONS.search(descriptions.get((table, c), ""))]
+        profiles[table] = {
+            "skip": table in skipped,
+            "embed": [c for c in cols if c not in metadata],
+            "metadata": metadata,
+        }
+    return profiles
+
+def load_profiles(conn, tables, path=INGEST_PROFILES_PATH):
+    """Return the derived ingest profiles with the overrides of the config file applied."""
+    profiles = derive_profiles(conn, tables)
+    if path:
+        with open(path, encoding="utf-8") as f:
+            overrides = json.load(f)
+        for table, override in overrides.items():
+            if table in profiles:
+                profiles[table].update(override)
+    return profiles
+
 def row_hash(values):
     """Generate unique hash for a row."""
     return hashlib.sha256("|".join(map(str, values)).encode()).hexdigest()
 
-def row_to_text(table, cols, row):
-    """Convert SQLite row into a readable text chunk."""
-    return f"Table: {table}\n" + "\n".join([f"{c}: {v}" for c, v in zip(cols, row)])
+def truncate(value, max_chars=INGEST_MAX_VALUE_CHARS):
+    """Cut long values so they don't dominate the embedded text."""
+    text = str(value)
+    return text if len(text) <= max_chars else text[:max_chars].rstrip() + "…"
+
+def row_to_text(table, cols, row, metadata_cols=()):
+    """Convert SQLite row into a readable text chunk, leaving out empty values.
 
-def index_table(conn, table):
-    """Index a single table into the vector store."""
+    Columns in ``metadata_cols`` are listed by name only.
+    """
+    return f"Table: {table}\n" + "\n".join(
+        [f"{c}: {truncate(v)}" for c, v in zip(cols, row) if v is not None]
+        + [f"{c}: {METADATA_PLACEHOLDER}" for c in metadata_cols])
+
+def index_table(conn, table, profile, vectorstore):
+    """Index a single table into the vector store and return its (document, metadata) pairs."""
     cur = conn.cursor()
     cur.execute(f"PRAGMA table_xinfo({table});")
     cols = [c[1] for c in cur.fetchall()]
     cur.execute(f"SELECT {', '.join(cols)} FROM {table}")
     rows = cur.fetchall()
 
+    embed = [cols.index(c) for c in profile["embed"] if c in cols]
+    metadata = [cols.index(c) for c in profile["metadata"] if c in cols]
     docs, ids, metas = [], [], []
     for r in rows:
-        txt = row_to_text(table, cols, r)
+        txt = row_to_text(table, [cols[i] for i in embed], [r[i] for i in embed],
+                          [cols[i] for i in metadata])
         pk = str(r[0])
         hid = row_hash(r)
         ids.append(f"{table}:{pk}")
         docs.append(txt)
-        metas.append({"table": table, "pk": pk, "hash": hid})
+        meta = {cols[i]: truncate(r[i]) if isinstance(r[i], str) else r[i]
+                for i in metadata if r[i] is not None}
+        metas.append({**meta, "table": table, "pk": pk, "hash": hid})
 
     # Add to Chroma vector store
     vectorstore.add_texts(texts=docs, metadatas=metas, ids=ids)
-
-def main():
-    """Main indexing pipeline."""
+    return list(zip(docs, metas))
+
+def validate_collection(vectorstore, expected, samples):
+    """Check a freshly built collection before it is activated.
+
+    The collection must hold every document that was added, not be much
+    smaller than the active one, and return most sampled rows among the
+    top results when searched with their own text.
+    """
+    count = vectorstore._collection.count()  # pylint: disable=protected-access
+    if count != expected:
+        return False, f"collection has {count} documents, {expected} were added"
+    active = vector_generations.collection_count(vector_generations.active_collection())
+    if active and count < active * INGEST_MIN_COUNT_RATIO:
+        return False, f"collection has {count} documents, the active one {active}"
+    if samples:
+        k = int(os.getenv("TOP_K", "5"))
+        found = sum(
+            any((d.metadata.get("table"), d.metadata.get("pk")) == (meta["table"], meta["pk"])
+                for d in vectorstore.similarity_search(doc, k=k))
+            for doc, meta in samples)
+        recall = found / len(samples)
+        logging.info("Sample recall@%d of the new collection: %.2f", k, recall)
+        if recall < INGEST_MIN_RECALL:
+            return False, f"sample recall {recall:.2f} is below {INGEST_MIN_RECALL}"
+    return True, ""
+
+def main(activate=True):
+    """Main indexing pipeline.
+
+    Builds a new generation of the collection while the active one keeps
+    serving, validates it and, if asked to, makes it the active collection.
+    Returns the name of the new collection, or None if validation failed.
+    """
     logging.info("index_tables: Starting indexing process.")
+    name = vector_generations.new_generation_name()
+    vectorstore = open_collection(name)
+    logging.info("Building collection %s.", name)
 
     conn = sqlite3.connect(os.getenv("DATABASE_PATH"))
     cur = conn.cursor()
     cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")
 
-    # Get table names
+    # Get table names and their ingest profiles
     tables = [t[0] for t in cur.fetchall()]
+    profiles = load_profiles(conn, tables)
+    tables = [t for t in tables if not profiles[t]["skip"]]
     logging.info("Indexing %d tables.", len(tables))
 
+    rng = random.Random(0)
+    expected, samples = 0, []
     for table in tqdm(tables, desc="Indexing tables"):
-        index_table(conn, table)
+        pairs = index_table(conn, table, profiles[table], vectorstore)
+        expected += len(pairs)
+        samples.extend(rng.sample(pairs, min(len(pairs), INGEST_VALIDATION_SAMPLES)))
 
     conn.close()
     logging.info("Indexing complete and persisted in Chroma.")
 
+    ok, reason = validate_collection(
+        vectorstore, expected, rng.sample(samples, min(len(samples), INGEST_VALIDATION_SAMPLES)))
+    if not ok:
+        logging.error("Collection %s failed validation, not activated: %s", name, reason)
+        vector_generations.drop_collection(name)
+        return None
+    if activate:
+        vector_generations.write_pointer(name, count=expected)
+        vector_generations.gc_generations()
+    return name
+
+def show_profiles():
+    """Print the ingest profiles as JSON, a starting point for INGEST_PROFILES_PATH."""
+    conn = sqlite3.connect(os.getenv("DATABASE_PATH"))
+    tables = [t[0] for t in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")]
+    print(json.dumps(load_profiles(conn, tables), indent=2, ensure_ascii=False))
+    conn.close()
+
 if __name__ == "__main__":
-    main()
-    logging.info("index_tables: Exiting.")
+    parser = argparse.ArgumentParser(description="Index the database tables into the vector store.")
+    parser.add_argument("--show-profiles", action="store_true",
+                        help="print the ingest profile of each table and exit")
+    parser.add_argument("--no-activate", action="store_true",
+                        help="build and validate a new collection without serving it")
+    parser.add_argument("--activate", metavar="COLLECTION",
+                        help="serve an existing collection instead of building one")
+    parser.add_argument("--list", action="store_true", help="list the collection generations")
+    args = parser.parse_args()
+    if args.show_profiles:
+        show_profiles()
+    elif args.list:
+        active = vector_generations.active_collection()
+        for generation in vector_generations.list_generations():
+            print(f"{'*' if generation == active else ' '} {generation}  "
+                  f"{vector_generations.collection_count(generation)} documents")
+    elif args.activate:
+        if not vector_generations.collection_count(args.activate):
+            raise SystemExit(f"Collection {args.activate} doesn't exist or is empty")
+        vector_generations.write_pointer(args.activate,
+                                         count=vector_generations.collection_count(args.activate))
+    else:
+        if main(activate=not args.no_activate) is None:
+            raise SystemExit(1)
+        logging.info("index_tables: Exiting.")
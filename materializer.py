@@ -0,0 +1,508 @@
+'''Precomputed aggregate tables for hot analytical questions.
+
+Aggregate queries seen often in the executed SQL log are turned into summary
+tables kept in a side database (``MATERIALIZED_DB_PATH``). A summary holds
+one row per group of the query with the partial aggregates needed to answer
+it (SUM, COUNT, MIN and MAX, with AVG stored as SUM and COUNT), so generated
+SQL with the same shape is rewritten to read the summary instead of the base
+rows.
+
+Two queries share a summary when they join the same tables, group by the
+same keys and only differ in filters on those keys, in HAVING, ORDER BY or
+LIMIT; key filters are applied to the summary at query time.
+
+Summaries are refreshed off the request path, by ``--refresh`` or by a
+background thread of the serving process every ``MATERIALIZE_REFRESH_S``
+seconds. Each refresh stores a stamp of the source database file (mtime and
+size of the database and its WAL); a query is only rewritten while the
+source still has that stamp, otherwise it runs on the base tables until the
+next refresh.
+
+Refreshes are incremental: when exactly one source table grew, only its new
+rows (by rowid) are aggregated and merged. Any other change rebuilds the
+summary. In-place UPDATEs and DELETEs of old rows can't be seen from the
+rowid watermarks and need ``--rebuild``; the fact tables this is meant for
+(vendas, itens_venda) are append-only. Outer joins are not materialised, as
+new rows on one side can change rows already counted from the other.
+
+Usage:
+    uv run materializer.py --detect   # create summaries for hot query shapes
+    uv run materializer.py --refresh  # refresh summaries incrementally
+    uv run materializer.py --rebuild  # recompute summaries from scratch
+    uv run materializer.py --list     # show the existing summaries
+'''
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import sqlglot
+from sqlglot import exp
+from sqlglot.optimizer.qualify import qualify
+from dotenv import load_dotenv
+
+from index_advisor import load_schema
+from query_log import read_log
+from sql_executor import open_ro_conn, output_names
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MATERIALIZED_DB_PATH = os.getenv("MATERIALIZED_DB_PATH", "")
+MATERIALIZE_MIN_COUNT = int(os.getenv("MATERIALIZE_MIN_COUNT", "3"))
+MATERIALIZE_REFRESH_S = float(os.getenv("MATERIALIZE_REFRESH_S", "60"))
+
+AGGREGATES = (exp.Sum, exp.Count, exp.Min, exp.Max, exp.Avg)
+
+
+class NotMaterializable(Exception):
+    '''The query can't be answered from a summary table.'''
+
+
+@dataclass
+class Shape:
+    '''The parts of an aggregate query that define its summary table.'''
+    core: exp.Select
+    tables: Dict[str, str]
+    keys: List[str]
+    comps: List[Tuple[str, str]]
+    outer: exp.Select
+
+    @property
+    def view_id(self) -> str:
+        '''Stable identifier of the summary table for this shape.'''
+        digest = hashlib.sha1(self.core.sql("sqlite").encode()).hexdigest()[:12]
+        return f"mv_{digest}"
+
+
+def source_stamp(db_path: str) -> List[List[int]]:
+    '''Mtime and size of a SQLite database and its WAL, changed by any write.'''
+    stamp = []
+    for path in (db_path, f"{db_path}-wal"):
+        try:
+            st = os.stat(path)
+            stamp.append([st.st_mtime_ns, st.st_size])
+        except OSError:
+            stamp.append([0, 0])
+    return stamp
+
+
+def _conjuncts(node: Optional[exp.Expression]) -> List[exp.Expression]:
+    if node is None:
+        return []
+    if isinstance(node, exp.Paren):
+        return _conjuncts(node.this)
+    if isinstance(node, exp.And):
+        return _conjuncts(node.left) + _conjuncts(node.right)
+    return [node]
+
+
+class _ShapeBuilder:
+    '''Splits a qualified aggregate query into summary and outer query.'''
+
+    def __init__(self, keys: List[exp.Expression]):
+        self.keys = keys
+        self.key_sql = [k.sql("sqlite") for k in keys]
+        self.comps: List[Tuple[str, str]] = []
+
+    def _comp(self, kind: str, arg: exp.Expression) -> exp.Column:
+        entry = (kind, arg.sql("sqlite"))
+        if entry not in self.comps:
+            self.comps.append(entry)
+        return exp.column(f"c{self.comps.index(entry)}")
+
+    def _replace(self, node: exp.Expression, aggregates: bool) -> exp.Expression:
+        if node.sql("sqlite") in self.key_sql:
+            return exp.column(f"g{self.key_sql.index(node.sql('sqlite'))}")
+        if isinstance(node, exp.AggFunc):
+            if not aggregates or not isinstance(node, AGGREGATES):
+                raise NotMaterializable(f"unsupported aggregate {node.key}")
+            arg = node.this
+            if isinstance(arg, exp.Distinct) or arg.find(exp.AggFunc):
+                raise NotMaterializable("DISTINCT or nested aggregate")
+            if isinstance(node, exp.Avg):
+                total, count = self._comp("sum", arg), self._comp("count", arg)
+                return exp.Div(this=exp.cast(total, "REAL"), expression=count)
+            return self._comp(node.key, arg)
+        return node
+
+    def rewrite(self, node: exp.Expression, aggregates: bool = True) -> exp.Expression:
+        '''Express the node over the summary columns.'''
+        out = node.copy().transform(lambda n: self._replace(n, aggregates), copy=False)
+        for col in out.find_all(exp.Column):
+            if col.table or not (col.name[:1] in "gc" and col.name[1:].isdigit()):
+                raise NotMaterializable(f"column {col.sql('sqlite')} is not a group key")
+        if out.find(exp.Subquery, exp.Window):
+            raise NotMaterializable("subquery or window function")
+        return out
+
+
+def analyze(sql: str, schema: Dict[str, Dict[str, str]]) -> Shape:
+    '''Split an aggregate query into its summary definition and outer query.'''
+    try:
+        parsed = qualify(sqlglot.parse_one(sql, read="sqlite"), schema=schema,
+                        dialect="sqlite", validate_qualify_columns=False)
+    except Exception as e:
+        raise NotMaterializable(f"unparseable: {e}") from e
+    if not isinstance(parsed, exp.Select) or parsed.args.get("with") or parsed.args.get("distinct"):
+        raise NotMaterializable("not a plain SELECT")
+    tables = {}
+    for source in [parsed.args.get("from_")] + (parsed.args.get("joins") or []):
+        if source is None or not isinstance(source.this, exp.Table) or source.this.name not in schema:
+            raise NotMaterializable("FROM must only reference base tables")
+        if source.args.get("side"):
+            # rows of the other side already counted with NULLs would have to
+            # be retracted when a match arrives, which a merge can't do
+            raise NotMaterializable("outer join")
+        tables[source.this.alias_or_name] = source.this.name
+    if not any(e.find(exp.AggFunc) for e in parsed.expressions):
+        raise NotMaterializable("no aggregates")
+
+    group = parsed.args.get("group")
+    keys = []
+    for key in (group.expressions if group else []):
+        if isinstance(key, exp.Literal):
+            if not key.is_int:
+                raise NotMaterializable("constant GROUP BY key")
+            position = int(key.name) - 1
+            if not 0 <= position < len(parsed.expressions):
+                raise NotMaterializable("bad GROUP BY position")
+            key = parsed.expressions[position]
+        keys.append((key.this if isinstance(key, exp.Alias) else key).copy())
+    builder = _ShapeBuilder(keys)
+
+    residual, pushed = [], []
+    for cond in _conjuncts(parsed.args["where"].this if parsed.args.get("where") else None):
+        try:
+            pushed.append(builder.rewrite(cond, aggregates=False))
+        except NotMaterializable:
+            if cond.find(exp.Subquery):
+                raise
+            residual.append(cond.copy())
+
+    outer = exp.select(*[
+        exp.alias_(builder.rewrite(e.this if isinstance(e, exp.Alias) else e), e.alias_or_name)
+        for e in parsed.expressions]).from_("__summary__")
+    if parsed.args.get("having"):
+        pushed.append(builder.rewrite(parsed.args["having"].this))
+    if pushed:
+        outer = outer.where(*pushed, copy=False)
+    order = parsed.args.get("order")
+    if order:
+        aliases = {e.alias for e in parsed.expressions if isinstance(e, exp.Alias)}
+        ordered = []
+        for o in order.expressions:
+            if isinstance(o.this, exp.Literal) or (
+                    isinstance(o.this, exp.Column) and o.this.name in aliases and not o.this.table):
+                ordered.append(o.copy())
+            else:
+                ordered.append(exp.Ordered(this=builder.rewrite(o.this), desc=o.args.get("desc"),
+                                        nulls_first=o.args.get("nulls_first")))
+        outer = outer.order_by(*ordered, copy=False)
+    for arg in ("limit", "offset"):
+        if parsed.args.get(arg):
+            outer.set(arg, parsed.args[arg].copy())
+
+    core = exp.select(*[exp.alias_(k.copy(), f"g{i}") for i, k in enumerate(keys)],
+                    *[exp.alias_(sqlglot.parse_one(f"{kind.upper()}({arg})", read="sqlite"), f"c{i}")
+                        for i, (kind, arg) in enumerate(builder.comps)])
+    core.set("from_", parsed.args["from_"].copy())
+    if parsed.args.get("joins"):
+        core.set("joins", [j.copy() for j in parsed.args["joins"]])
+    if residual:
+        core = core.where(*residual, copy=False)
+    if keys:
+        core = core.group_by(*[k.copy() for k in keys], copy=False)
+    return Shape(core=core, tables=tables, keys=builder.key_sql, comps=builder.comps, outer=outer)
+
+
+def _merge(kind: str, old, new):
+    '''Merge two partial aggregates of the same kind.'''
+    if old is None:
+        return new
+    if new is None:
+        return old
+    if kind in ("sum", "count"):
+        return old + new
+    return min(old, new) if kind == "min" else max(old, new)
+
+
+class Materializer:
+    '''Maintains summary tables in the side database and rewrites queries.'''
+
+    def __init__(self, source_db: str, side_db: str):
+        self.source_db = source_db
+        self.side_db = side_db
+        self._schema: Optional[Dict[str, Dict[str, str]]] = None
+        self._views: Optional[Dict[str, Dict[str, Any]]] = None
+        self._views_stamp: Optional[int] = None
+        self._lock = threading.RLock()
+        # serialises refreshes without blocking the rewrites
+        self._refresh_lock = threading.Lock()
+        self._refresher: Optional[threading.Thread] = None
+
+    @property
+    def schema(self) -> Dict[str, Dict[str, str]]:
+        '''Schema of the source database.'''
+        if self._schema is None:
+            conn = open_ro_conn(self.source_db)
+            self._schema = load_schema(conn)
+            conn.close()
+        return self._schema
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.side_db, check_same_thread=False)
+        conn.execute("""CREATE TABLE IF NOT EXISTS _mv_views (
+            name TEXT PRIMARY KEY, source_db TEXT NOT NULL, definition TEXT NOT NULL,
+            watermarks TEXT, source_stamp TEXT, refreshed_at DATETIME)""")
+        if "source_stamp" not in {row[1] for row in conn.execute("PRAGMA table_info(_mv_views)")}:
+            # side database created before refreshes were stamped
+            conn.execute("ALTER TABLE _mv_views ADD COLUMN source_stamp TEXT")
+        return conn
+
+    def views(self) -> Dict[str, Dict[str, Any]]:
+        '''Summary definitions of the source database, by name.'''
+        with self._lock:
+            # summaries created by another process (e.g. --detect) are picked
+            # up when the side database changes
+            try:
+                stamp = os.stat(self.side_db).st_mtime_ns
+            except OSError:
+                stamp = None
+            if self._views is None or stamp != self._views_stamp:
+                self._views_stamp = stamp
+                conn = self._connect()
+                rows = conn.execute("SELECT name, definition, watermarks, source_stamp FROM _mv_views "
+                                    "WHERE source_db = ?", (self.source_db,)).fetchall()
+                conn.close()
+                self._views = {name: {**json.loads(d), "watermarks": json.loads(w or "null"),
+                                      "stamp": json.loads(st or "null")}
+                            for name, d, w, st in rows}
+            return self._views
+
+    def create(self, shape: Shape):
+        '''Register and build the summary table for a shape.'''
+        name = shape.view_id
+        if name in self.views():
+            return
+        keys = [f"g{i}" for i in range(len(shape.keys))]
+        cols = keys + [f"c{i}" for i in range(len(shape.comps))]
+        conn = self._connect()
+        with conn:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS "{name}" ({", ".join(cols)})')
+            if keys:
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}_keys" ON "{name}" ({", ".join(keys)})')
+            definition = {"core": shape.core.sql("sqlite"), "tables": shape.tables,
+                        "keys": len(keys), "comps": [k for k, _ in shape.comps]}
+            conn.execute("INSERT INTO _mv_views (name, source_db, definition) VALUES (?, ?, ?)",
+                        (name, self.source_db, json.dumps(definition)))
+        conn.close()
+        self._views = None
+        logger.info("Created summary %s: %s", name, definition["core"])
+        self.refresh(name, full=True)
+
+    def _watermarks(self, tables: Dict[str, str]) -> Dict[str, Optional[int]]:
+        conn = open_ro_conn(self.source_db)
+        try:
+            return {t: conn.execute(f'SELECT MAX(rowid) FROM "{t}"').fetchone()[0]
+                    for t in set(tables.values())}
+        finally:
+            conn.close()
+
+    def stale(self, name: str) -> bool:
+        '''Whether the source database changed since the summary was refreshed.'''
+        return self.views()[name]["stamp"] != source_stamp(self.source_db)
+
+    def refresh(self, name: str, full: bool = False):
+        '''Bring one summary up to date with the source database.'''
+        with self._refresh_lock:
+            view = self.views()[name]
+            # taken before reading the source: a write made during the
+            # refresh leaves the summary stale rather than wrongly fresh
+            stamp = source_stamp(self.source_db)
+            current = self._watermarks(view["tables"])
+            old = view["watermarks"]
+            if not full and old == current:
+                conn = self._connect()
+                with conn:
+                    conn.execute("UPDATE _mv_views SET source_stamp = ? WHERE name = ?",
+                                (json.dumps(stamp), name))
+                conn.close()
+                view["stamp"] = stamp
+                return
+
+            grown = [t for t in current if old and (current[t] or 0) > (old.get(t) or 0)]
+            shrunk = [t for t in current if old and (current[t] or 0) < (old.get(t) or 0)]
+            aliases = [a for a, t in view["tables"].items() if grown and t == grown[0]]
+            core = sqlglot.parse_one(view["core"], read="sqlite")
+            incremental = not full and old and len(grown) == 1 and not shrunk and len(aliases) == 1
+            params: List[Any] = []
+            if incremental:
+                core = core.where(f'"{aliases[0]}".rowid > ? AND "{aliases[0]}".rowid <= ?',
+                                dialect="sqlite", copy=False)
+                params = [old[grown[0]] or 0, current[grown[0]]]
+
+            src = open_ro_conn(self.source_db)
+            try:
+                delta = src.execute(core.sql("sqlite"), params).fetchall()
+            finally:
+                src.close()
+
+            conn = self._connect()
+            with conn:
+                if incremental:
+                    self._merge_rows(conn, name, view, delta)
+                else:
+                    conn.execute(f'DELETE FROM "{name}"')
+                    if delta:
+                        marks = ", ".join("?" * len(delta[0]))
+                        conn.executemany(f'INSERT INTO "{name}" VALUES ({marks})', delta)
+                conn.execute("UPDATE _mv_views SET watermarks = ?, source_stamp = ?, "
+                            "refreshed_at = CURRENT_TIMESTAMP WHERE name = ?",
+                            (json.dumps(current), json.dumps(stamp), name))
+            conn.close()
+            view["watermarks"], view["stamp"] = current, stamp
+            logger.info("%s summary %s with %d rows",
+                        "Merged into" if incremental else "Rebuilt", name, len(delta))
+
+    def refresh_stale(self):
+        '''Refresh every summary whose source changed.'''
+        for name in list(self.views()):
+            if self.stale(name):
+                self.refresh(name)
+
+    def start_refresher(self, interval: float):
+        '''Refresh stale summaries every ``interval`` seconds in a background thread.'''
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop, args=(interval,),
+                                               name="materializer", daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self, interval: float):
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh_stale()
+            except (sqlite3.Error, KeyError) as e:
+                logger.warning("Could not refresh summaries: %s", e)
+
+    @staticmethod
+    def _merge_rows(conn: sqlite3.Connection, name: str, view: Dict[str, Any], delta: List[Tuple]):
+        nkeys = view["keys"]
+        where = " AND ".join(f"g{i} IS ?" for i in range(nkeys)) or "1"
+        comps = [f"c{i}" for i in range(len(view["comps"]))]
+        for row in delta:
+            keys, values = row[:nkeys], row[nkeys:]
+            existing = conn.execute(f'SELECT rowid, {", ".join(comps)} FROM "{name}" WHERE {where}',
+                                    keys).fetchone()
+            if existing is None:
+                conn.execute(f'INSERT INTO "{name}" VALUES ({", ".join("?" * len(row))})', row)
+                continue
+            merged = [_merge(k, o, n) for k, o, n in zip(view["comps"], existing[1:], values)]
+            conn.execute(f'UPDATE "{name}" SET {", ".join(f"{c} = ?" for c in comps)} WHERE rowid = ?',
+                        merged + [existing[0]])
+
+    def rewrite(self, sql: str) -> Optional[str]:
+        '''Return SQL answering the query from a summary table, or None.'''
+        try:
+            shape = analyze(sql, self.schema)
+        except NotMaterializable:
+            return None
+        name = shape.view_id
+        if name not in self.views():
+            return None
+        if self.stale(name):
+            logger.debug("Summary %s is stale, using base tables", name)
+            return None
+
+        outer = shape.outer.copy()
+        outer.set("from_", exp.From(this=exp.to_table(name)))
+        names = output_names(self.source_db, sql)
+        for projection, col_name in zip(outer.expressions, names):
+            projection.set("alias", exp.to_identifier(col_name, quoted=True))
+        return outer.sql("sqlite")
+
+
+_materializer: Optional[Materializer] = None
+
+
+def get_materializer() -> Optional[Materializer]:
+    '''Materializer for DATABASE_PATH, or None when summaries are disabled.'''
+    global _materializer  # pylint: disable=global-statement
+    if _materializer is None and MATERIALIZED_DB_PATH:
+        _materializer = Materializer(os.getenv("DATABASE_PATH"), MATERIALIZED_DB_PATH)
+        if MATERIALIZE_REFRESH_S > 0:
+            _materializer.start_refresher(MATERIALIZE_REFRESH_S)
+    return _materializer
+
+
+def rewrite(sql: str) -> Optional[str]:
+    '''Rewrite the query to read a summary table when one matches.'''
+    mat = get_materializer()
+    if mat is None:
+        return None
+    try:
+        return mat.rewrite(sql)
+    except (sqlite3.Error, KeyError) as e:
+        logger.warning("Could not answer from summary, using base tables: %s", e)
+        return None
+
+
+def detect(mat: Materializer, log_path: Optional[str], min_count: int) -> List[Shape]:
+    '''Find aggregate shapes run at least ``min_count`` times in the SQL log.'''
+    counts: Counter = Counter()
+    shapes: Dict[str, Shape] = {}
+    for entry in read_log(log_path):
+        if entry.get("db") not in (None, mat.source_db):
+            continue
+        try:
+            shape = analyze(entry["sql"], mat.schema)
+        except NotMaterializable:
+            continue
+        counts[shape.view_id] += 1
+        shapes.setdefault(shape.view_id, shape)
+    return [shapes[name] for name, n in counts.most_common() if n >= min_count]
+
+
+def main():
+    '''Command line entry point.'''
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", 1)[0])
+    parser.add_argument("--db", default=os.getenv("DATABASE_PATH"), help="source database")
+    parser.add_argument("--side-db", default=MATERIALIZED_DB_PATH, help="summary database")
+    parser.add_argument("--log", default=os.getenv("SQL_LOG_PATH"), help="executed SQL log")
+    parser.add_argument("--min-count", type=int, default=MATERIALIZE_MIN_COUNT,
+                        help="executions needed before a shape is materialised")
+    parser.add_argument("--detect", action="store_true", help="create summaries for hot shapes")
+    parser.add_argument("--refresh", action="store_true", help="refresh summaries incrementally")
+    parser.add_argument("--rebuild", action="store_true", help="recompute all summaries")
+    parser.add_argument("--list", action="store_true", help="list the summaries")
+    args = parser.parse_args()
+
+    if not args.side_db:
+        parser.error("no summary database given, set MATERIALIZED_DB_PATH or pass --side-db")
+    mat = Materializer(args.db, args.side_db)
+    if args.detect:
+        if not args.log:
+            parser.error("no SQL log given, set SQL_LOG_PATH or pass --log")
+        for shape in detect(mat, args.log, args.min_count):
+            mat.create(shape)
+    if args.refresh or args.rebuild:
+        for name in mat.views():
+            mat.refresh(name, full=args.rebuild)
+    if args.list:
+        for name, view in mat.views().items():
+            print(f"{name}: {view['core']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+'''Pipeline metrics exposed in Prometheus text format.
+
+A small in-process registry of counters, gauges and histograms. Pipeline
+stages are timed with ``span()``, which records the duration in the
+``pipeline_stage_seconds`` histogram, counts failures by exception type and,
+when per-request timing is active, adds the duration to the request's
+timings so the API can return them in a ``Server-Timing`` header.
+'''
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# timings of the stages run for the current request, when requested
+request_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = \
+    contextvars.ContextVar("request_timings", default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class _Metric:
+    '''Base class of the registry metrics.'''
+    kind = ""
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple:
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def samples(self) -> Iterator[str]:
+        '''Yield the sample lines of the metric.'''
+        raise NotImplementedError
+
+    def render(self) -> str:
+        '''Render the metric in Prometheus text format.'''
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    '''A monotonically increasing counter.'''
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        '''Increment the counter for the given labels.'''
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield f"{self.name}{_labels(self.label_names, key)} {value}"
+
+
+class Gauge(_Metric):
+    '''A value read from a callback each time the metrics are collected.
+
+    The callback returns a number, or a dict of number by label values tuple.
+    '''
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, fn: Callable, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self.fn = fn
+
+    def samples(self) -> Iterator[str]:
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            yield f"{self.name}{_labels(self.label_names, key)} {value}"
+
+
+class Histogram(_Metric):
+    '''A histogram of observed values with cumulative buckets.'''
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        self._values: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        '''Record one observation for the given labels.'''
+        key = self._key(labels)
+        with self._lock:
+            # one count per bucket, then +Inf count and sum
+            entry = self._values.setdefault(key, [0.0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += 1
+            entry[-1] += value
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = {k: list(v) for k, v in self._values.items()}
+        names = self.label_names + ("le",)
+        for key, entry in values.items():
+            for bound, count in zip(self.buckets, entry):
+                yield f"{self.name}_bucket{_labels(names, key + (bound,))} {count}"
+            yield f"{self.name}_bucket{_labels(names, key + ('+Inf',))} {entry[-2]}"
+            yield f"{self.name}_count{_labels(self.label_names, key)} {entry[-2]}"
+            yield f"{self.name}_sum{_labels(self.label_names, key)} {entry[-1]}"
+
+
+class Registry:
+    '''Collection of the metrics of the process.'''
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric):
+        '''Add a metric to the registry.'''
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        '''Render every metric in Prometheus text format.'''
+        return "\n".join(m.render() for m in self._metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = Histogram("pipeline_stage_seconds", "Duration of each query pipeline stage.",
+                        labels=("stage",))
+STAGE_ERRORS = Counter("pipeline_errors_total", "Pipeline stage failures by exception type.",
+                    labels=("stage", "type"))
+CACHE_REQUESTS = Counter("cache_requests_total", "Cache lookups by cache and result.",
+                        labels=("cache", "result"))
+HTTP_SECONDS = Histogram("http_request_duration_seconds", "Duration of API requests.",
+                        labels=("path", "status"))
+
+
+@contextmanager
+def span(stage: str):
+    '''Time a pipeline stage and record it in the stage metrics.'''
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        STAGE_ERRORS.inc(stage=stage, type=type(e).__name__)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        timings = request_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    '''Format request timings as a Server-Timing header value.'''
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
@@ -0,0 +1,203 @@
+'''On-demand sampling profiler for the query pipeline.
+
+A profile is started for a request (``X-Profile`` header, or at random with
+``PROFILE_SAMPLE_RATE``) and stored in a context variable. Work submitted to
+the worker pools while it is active attaches its thread to the profile, and a
+background thread samples the stacks of attached threads every
+``PROFILE_INTERVAL_MS``. When the request finishes the samples are written
+to ``PROFILE_DIR`` as collapsed stacks (``frame;frame;frame count``), the
+input format of flamegraph.pl, speedscope and similar tools.
+
+When no profile is active the sampler thread is idle and the only cost is a
+context variable lookup per pool task.
+'''
+import os
+import sys
+import time
+import random
+import secrets
+import logging
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "data/profiles")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "10"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+
+current_profile: contextvars.ContextVar[Optional["Profile"]] = \
+    contextvars.ContextVar("current_profile", default=None)
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Profile:
+    '''Stack samples collected for one request.'''
+
+    def __init__(self, label: str):
+        self.id = secrets.token_hex(6)
+        self.label = label
+        self.started = time.time()
+        self.stacks: Counter = Counter()
+        self.threads: Set[int] = set()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def attached(self):
+        '''Sample the current thread while the block runs.'''
+        ident = threading.get_ident()
+        with self._lock:
+            self.threads.add(ident)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.threads.discard(ident)
+
+    def sample(self, frames: Dict[int, Any]):
+        '''Record the current stack of every attached thread.'''
+        with self._lock:
+            threads = list(self.threads)
+        for ident in threads:
+            frame = frames.get(ident)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, directory: str = PROFILE_DIR) -> str:
+        '''Write the collapsed stacks and return the file path.'''
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+        path = os.path.join(directory, f"{stamp}-{self.id}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        _prune(directory)
+        return path
+
+
+class _Sampler:
+    '''Background thread sampling the active profiles.'''
+
+    def __init__(self):
+        self.active: List[Profile] = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, profile: Profile):
+        '''Start sampling a profile.'''
+        with self._lock:
+            self.active.append(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def remove(self, profile: Profile):
+        '''Stop sampling a profile.'''
+        with self._lock:
+            if profile in self.active:
+                self.active.remove(profile)
+
+    def _run(self):
+        interval = PROFILE_INTERVAL_MS / 1000
+        while True:
+            with self._lock:
+                profiles = list(self.active)
+                if not profiles:
+                    self._wake.clear()
+            if not profiles:
+                self._wake.wait()
+                continue
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            for profile in profiles:
+                profile.sample(frames)
+            del frames
+            time.sleep(interval)
+
+
+_sampler = _Sampler()
+
+
+def should_profile(requested: bool) -> bool:
+    '''Whether a request should be profiled.'''
+    return requested or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE)
+
+
+@contextmanager
+def profiling(label: str, attach_caller: bool = True):
+    '''Profile the pipeline work done inside the block.
+
+    Yields the profile; its collapsed stacks are written when the block exits.
+    The calling thread is sampled too unless ``attach_caller`` is false, which
+    the API uses since its event loop thread is shared by every request.
+    '''
+    profile = Profile(label)
+    token = current_profile.set(profile)
+    _sampler.add(profile)
+    try:
+        if attach_caller:
+            with profile.attached():
+                yield profile
+        else:
+            yield profile
+    finally:
+        _sampler.remove(profile)
+        current_profile.reset(token)
+        try:
+            path = profile.write()
+            logger.info("Wrote profile of %s to %s", label, path)
+        except OSError as e:
+            logger.warning("Could not write profile: %s", e)
+
+
+def run_attached(fn: Callable, *args, **kwargs) -> Any:
+    '''Call fn, sampling the thread if the caller is being profiled.'''
+    profile = current_profile.get()
+    if profile is None:
+        return fn(*args, **kwargs)
+    with profile.attached():
+        return fn(*args, **kwargs)
+
+
+def _prune(directory: str):
+    '''Keep only the newest PROFILE_KEEP profiles.'''
+    for entry in list_profiles(directory)[PROFILE_KEEP:]:
+        try:
+            os.remove(os.path.join(directory, entry["name"]))
+        except OSError:
+            pass
+
+
+def list_profiles(directory: str = PROFILE_DIR) -> List[Dict[str, Any]]:
+    '''List the written profiles, newest first.'''
+    if not os.path.isdir(directory):
+        return []
+    entries = []
+    for name in os.listdir(directory):
+        if not name.endswith(".folded"):
+            continue
+        st = os.stat(os.path.join(directory, name))
+        entries.append({"name": name, "size": st.st_size, "created": st.st_mtime})
+    entries.sort(key=lambda e: e["created"], reverse=True)
+    return entries
+
+
+def read_profile(name: str, directory: str = PROFILE_DIR) -> Optional[str]:
+    '''Return the collapsed stacks of a listed profile, or None.'''
+    if name not in {e["name"] for e in list_profiles(directory)}:
+        return None
+    with open(os.path.join(directory, name), encoding="utf-8") as f:
+        return f.read()
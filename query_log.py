@@ -0,0 +1,43 @@
+'''Log of executed SQL queries.
+
+Each execution is appended as one JSON line to ``SQL_LOG_PATH``. The log is
+the workload the index advisor and other offline tools learn from; it is
+disabled when the variable is unset or empty.
+'''
+import os
+import json
+import time
+import logging
+import threading
+from typing import Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+SQL_LOG_PATH = os.getenv("SQL_LOG_PATH", "")
+
+_lock = threading.Lock()
+
+
+def record(sql: str, elapsed_ms: float, row_count: int, cached: bool = False,
+            db_path: Optional[str] = None):
+    '''Append one executed query to the log.'''
+    if not SQL_LOG_PATH:
+        return
+    line = json.dumps({"ts": time.time(), "db": db_path or os.getenv("DATABASE_PATH"), "sql": sql,
+                    "elapsed_ms": round(elapsed_ms, 3), "rows": row_count,
+                    "cached": cached})
+    try:
+        with _lock, open(SQL_LOG_PATH, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        logger.warning("Could not write SQL log: %s", e)
+
+
+def read_log(path: Optional[str] = None) -> Iterator[Dict]:
+    '''Yield the entries of the SQL log, skipping malformed lines.'''
+    with open(path or SQL_LOG_PATH, encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
@@ -1,47 +1,306 @@
 '''Query service module for the Text-to-SQL Chatbot with RAG application.
 '''
 import os
+import asyncio
 import logging
+import threading
+from typing import Any, AsyncIterator, Dict, Iterator, List, Literal, Optional, Tuple
 
 from pydantic import BaseModel
 
-from retriever_node import retriever_node
-from sql_node import sql_generator_node
-from sql_validator import validate_sql, allowed_tables_from_db
-from sql_executor import execute_sql
+from retriever_node import retriever_node, aretriever_node, aretriever_batch
+from sql_node import sql_generator_node, asql_generator_node
+from sql_validator import validate_sql
+from sql_executor import execute_sql, iter_sql
+from sql_paginator import execute_page, export_token, next_page, read_export_token
+from metrics import span
+from worker_pools import IO_POOL, run_in
+from databases import DatabaseContext, registry
+import materializer
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-ALLOWED_TABLES = allowed_tables_from_db(os.getenv("DATABASE_PATH"))
+STREAM_ROW_LIMIT = int(os.getenv("STREAM_ROW_LIMIT", "100000"))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
 
 
 class QueryRequest(BaseModel):
     """Query request"""
     question: str
     show_sql: bool = True
+    # "records": one dict per row, "columnar": cols once and one list per row
+    format: Literal["records", "columnar"] = "records"
+    # when set, only the first page is returned with a continuation token
+    page_size: Optional[int] = None
+    # id of the database to answer from (see databases.py), None for the default
+    database: Optional[str] = None
 
 
-def query(req: QueryRequest):
-    """Process a query request through the RAG pipeline."""
-    logger.info("Processing query request: %s", req.question)
-    state = {"question": req.question, "messages": []}
+def format_rows(cols: List[str], rows: List[Tuple[Any]], fmt: str) -> List:
+    """Shape result rows for the response format."""
+    if fmt == "columnar":
+        return [list(r) for r in rows]
+    return [dict(zip(cols, r)) for r in rows]
+
+
+class InvalidSQL(ValueError):
+    """The generated SQL was rejected and must not be executed."""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Generated SQL is not valid: {reason}")
+        self.reason = reason
+
 
-    # 1. retrieve
-    state = retriever_node(state)
+def _check_sql(sql: str, ctx: DatabaseContext):
+    """Validate the generated SQL against the allowed tables of the database.
 
-    # 2. generate SQL
-    state = sql_generator_node(state)
-    sql = state["generated_sql"]
-    ok, reason = validate_sql(sql, ALLOWED_TABLES)
+    Raises InvalidSQL when it is rejected, before anything executes it.
+    """
+    with span("validate"):
+        ok, reason = validate_sql(sql, ctx.allowed_tables)
     if not ok:
         logger.error("Generated SQL is not valid: %s", reason)
+        raise InvalidSQL(reason)
 
-    # 3. execute
-    cols, rows = execute_sql(sql)
+
+def generate_sql(req: QueryRequest) -> str:
+    """Run retrieval and SQL generation for the question and validate the result.
+
+    Raises InvalidSQL when the generated SQL is rejected.
+    """
+    logger.info("Processing query request: %s", req.question)
+    state = {"question": req.question, "messages": []}
+
+    with registry.leased(req.database) as ctx:
+        # 1. retrieve
+        state = retriever_node(state, store=ctx.store)
+
+        # 2. generate SQL
+        state = sql_generator_node(state)
+        sql = state["generated_sql"]
+        _check_sql(sql, ctx)
+    return sql
+
+
+async def agenerate_sql(req: QueryRequest) -> str:
+    """Async version of generate_sql that never blocks the event loop."""
+    logger.info("Processing query request: %s", req.question)
+    state = {"question": req.question, "messages": []}
+    ctx = await run_in(IO_POOL, registry.acquire, req.database)
+    try:
+        state = await aretriever_node(state, store=ctx.store)
+        state = await asql_generator_node(state)
+        sql = state["generated_sql"]
+        _check_sql(sql, ctx)
+    finally:
+        registry.release(ctx)
+    return sql
+
+
+def execution_target(sql: str, db_path: Optional[str] = None) -> Tuple[str, Optional[str]]:
+    """Return the SQL to run and its database, preferring a summary table.
+
+    Summary tables are only built for DATABASE_PATH.
+    """
+    if db_path and os.path.abspath(db_path) != os.path.abspath(os.getenv("DATABASE_PATH") or ""):
+        return sql, db_path
+    with span("summary_rewrite"):
+        rewritten = materializer.rewrite(sql)
+    if rewritten:
+        logger.info("Answering from summary table: %s", rewritten)
+        return rewritten, materializer.MATERIALIZED_DB_PATH
+    return sql, db_path
+
+
+def execute(req: QueryRequest, sql: str):
+    """Execute the generated SQL and shape the response."""
+    next_token = None
+    db_path = registry.database_path(req.database)
+    if req.page_size:
+        cols, rows, next_token = execute_page(sql, req.page_size, db_path=db_path)
+    else:
+        run_sql, run_db = execution_target(sql, db_path)
+        cols, rows = execute_sql(run_sql, db_path=run_db)
 
     # format result rows
-    result = [dict(zip(cols, r)) for r in rows]
-    return {"sql": sql if req.show_sql else None, "cols": cols, "rows": result}
+    result = format_rows(cols, rows, req.format)
+    return {"sql": sql if req.show_sql else None, "cols": cols, "rows": result,
+            "next_page_token": next_token, "export_token": export_token(sql, db_path)}
+
+
+def query(req: QueryRequest):
+    """Process a query request through the RAG pipeline."""
+    sql = generate_sql(req)
+
+    # 3. execute
+    return execute(req, sql)
+
+
+async def aquery(req: QueryRequest):
+    """Process a query request through the RAG pipeline without blocking the event loop."""
+    sql = await agenerate_sql(req)
+    return await run_in(IO_POOL, execute, req, sql)
+
+
+async def aquery_batch(reqs: List[QueryRequest]) -> List[Dict[str, Any]]:
+    """Process several query requests, batching model work across them.
+
+    Retrieval and reranking run once for all questions, LLM calls are made
+    concurrently up to LLM_CONCURRENCY. A failure in one question is returned
+    as its ``error`` and doesn't affect the others; if batched retrieval
+    fails, each question is retrieved on its own. Questions may be for
+    different databases.
+    """
+    logger.info("Processing batch of %d query requests", len(reqs))
+    contexts: Dict[Optional[str], DatabaseContext | Exception] = {}
+    try:
+        for name in dict.fromkeys(r.database for r in reqs):
+            try:
+                contexts[name] = await run_in(IO_POOL, registry.acquire, name)
+            except ValueError as e:
+                contexts[name] = e
+        states = [{"question": r.question, "messages": []} for r in reqs]
+        usable = [i for i, r in enumerate(reqs) if isinstance(contexts[r.database], DatabaseContext)]
+        retrieval_errors: Dict[int, Exception] = {}
+        try:
+            await aretriever_batch([states[i] for i in usable],
+                                   [contexts[reqs[i].database].store for i in usable])
+        except Exception as e:  # pylint: disable=broad-except
+            logger.warning("Batch retrieval failed, retrieving each question: %s", e)
+
+            async def retrieve_one(i: int):
+                try:
+                    await aretriever_node(states[i], store=contexts[reqs[i].database].store)
+                except Exception as e:  # pylint: disable=broad-except
+                    retrieval_errors[i] = e
+
+            await asyncio.gather(*[retrieve_one(i) for i in usable])
+        llm_slots = asyncio.Semaphore(LLM_CONCURRENCY)
+
+        async def run_one(i: int, req: QueryRequest, state) -> Dict[str, Any]:
+            ctx = contexts[req.database]
+            if not isinstance(ctx, DatabaseContext):
+                return {"error": str(ctx)}
+            if i in retrieval_errors:
+                logger.error("Batch question failed: %s", retrieval_errors[i])
+                return {"error": str(retrieval_errors[i])}
+            try:
+                async with llm_slots:
+                    state = await asql_generator_node(state)
+                sql = state["generated_sql"]
+                _check_sql(sql, ctx)
+                return await run_in(IO_POOL, execute, req, sql)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Batch question failed: %s", e)
+                return {"error": str(e)}
+
+        return await asyncio.gather(*[run_one(i, r, s) for i, (r, s) in enumerate(zip(reqs, states))])
+    finally:
+        for ctx in contexts.values():
+            if isinstance(ctx, DatabaseContext):
+                registry.release(ctx)
+
+
+class _SerialIterator:
+    """Iterator read and closed from pool threads one call at a time.
+
+    A cancelled await leaves its ``next`` running in the pool; closing the
+    generator meanwhile would raise "generator already executing" and leak
+    its connection, so ``close`` waits for it.
+    """
+
+    def __init__(self, iterator: Iterator):
+        self.iterator = iterator
+        self._lock = threading.Lock()
+
+    def next(self, *default):
+        """Next item, or ``default`` when exhausted if given."""
+        with self._lock:
+            return next(self.iterator, *default)
+
+    def close(self):
+        """Close the generator once no read is in progress."""
+        with self._lock:
+            self.iterator.close()
+
+
+async def aquery_events(req: QueryRequest, chunk_size: int = 200) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """Process a query request and yield an event as each stage completes.
+
+    Events are ``retrieved`` (tables of the retrieved documents), ``sql``,
+    ``validation``, ``columns``, then ``rows`` chunks and finally ``done``,
+    or ``error`` if a stage fails. Rejected SQL ends the stream with
+    ``error`` right after its ``validation``, without running it. Closing the iterator stops the pipeline and
+    closes the database cursor.
+    """
+    logger.info("Processing query request: %s", req.question)
+    results = None
+    ctx = None
+    try:
+        ctx = await run_in(IO_POOL, registry.acquire, req.database)
+        state = await aretriever_node({"question": req.question, "messages": []}, store=ctx.store)
+        tables = list(dict.fromkeys(m.get("table") for m in state.get("retrieved_meta", [])))
+        yield "retrieved", {"tables": tables, "documents": len(state["retrieved_docs"])}
+
+        state = await asql_generator_node(state)
+        sql = state["generated_sql"]
+        if req.show_sql:
+            yield "sql", {"sql": sql}
+        try:
+            _check_sql(sql, ctx)
+        except InvalidSQL as e:
+            yield "validation", {"ok": False, "reason": e.reason}
+            raise
+        yield "validation", {"ok": True, "reason": "ok"}
+        db_path = ctx.config.path
+        registry.release(ctx)
+        ctx = None
+
+        run_sql, run_db = await run_in(IO_POOL, execution_target, sql, db_path)
+        results = _SerialIterator(iter_sql(run_sql, row_limit=STREAM_ROW_LIMIT,
+                                           chunk_size=chunk_size, db_path=run_db))
+        cols = await run_in(IO_POOL, results.next)
+        yield "columns", {"cols": cols}
+        count = 0
+        while (chunk := await run_in(IO_POOL, results.next, None)) is not None:
+            count += len(chunk)
+            yield "rows", {"rows": format_rows(cols, chunk, req.format)}
+        yield "done", {"row_count": count}
+    except Exception as e:  # pylint: disable=broad-except
+        logger.error("Query failed: %s", e)
+        yield "error", {"error": str(e)}
+    finally:
+        if ctx is not None:
+            registry.release(ctx)
+        if results is not None:
+            await run_in(IO_POOL, results.close)
+
+
+def query_next_page(page_token: str, fmt: str = "records"):
+    """Fetch the page following a previous paginated query result."""
+    cols, rows, next_token = next_page(page_token)
+    return {"cols": cols, "rows": format_rows(cols, rows, fmt), "next_page_token": next_token}
+
+
+def stream_rows(sql: str, chunk_size: int = 500,
+                db_path: Optional[str] = None) -> Iterator[Dict[str, Any] | List[Any]]:
+    """Execute the SQL and yield the column header followed by rows as lists.
+
+    Rows are produced while the cursor is being read, so memory stays bounded
+    by ``chunk_size`` instead of the size of the result. ``db_path`` defaults
+    to ``DATABASE_PATH``.
+    """
+    sql, db_path = execution_target(sql, db_path)
+    results = iter_sql(sql, row_limit=STREAM_ROW_LIMIT, chunk_size=chunk_size, db_path=db_path)
+    yield {"cols": next(results)}
+    for chunk in results:
+        for r in chunk:
+            yield list(r)
+
+def export_rows(token: str) -> Iterator[Dict[str, Any] | List[Any]]:
+    """Stream the full result of the query an export token was issued for."""
+    sql, db_path = read_export_token(token)
+    return stream_rows(sql, db_path=db_path)
 
 # print(query(QueryRequest(question="quantas vendas foram feitas em 24?")))
@@ -0,0 +1,159 @@
+'''Result cache for executed SQL queries.
+
+Entries are keyed by the canonical form of the SQL (normalised with sqlglot),
+the row limit and a version stamp of the database file, so a write to the
+database makes every older entry unreachable. Spellings that share a key can
+name their result columns differently, so an entry also keeps the SQL it was
+executed as and its column names belong to that spelling only. Eviction is LRU and bounded by
+the estimated size of the cached results in bytes.
+'''
+import os
+import sys
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple
+
+import sqlglot
+
+from metrics import CACHE_REQUESTS, Gauge
+
+logger = logging.getLogger(__name__)
+
+CacheKey = Tuple[str, str, int, Tuple]
+# the SQL as executed, its column names and rows
+CachedResult = Tuple[str, List[str], List[Tuple[Any]]]
+
+
+def canonical_sql(sql: str) -> str:
+    '''Return a canonical form of the SQL so equivalent queries share a key.'''
+    try:
+        parsed = sqlglot.parse_one(sql, read="sqlite")
+        return parsed.sql(dialect="sqlite", normalize=True)
+    except Exception:
+        return " ".join(sql.split())
+
+
+def estimate_size(cols: List[str], rows: List[Tuple[Any]]) -> int:
+    '''Estimate the memory used by a result set in bytes.'''
+    size = sys.getsizeof(cols) + sum(sys.getsizeof(c) for c in cols)
+    size += sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row)
+    return size
+
+
+class DatabaseVersion:
+    '''Tracks a version stamp for a SQLite database file.
+
+    ``PRAGMA data_version`` only changes for commits made by *other*
+    connections, so it is read from a long-lived connection kept for that
+    purpose. The mtime and size of the database and WAL files are added to
+    the stamp so writes are noticed even if that connection is reopened.
+    '''
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _file_stamp(self, path: str) -> Tuple[int, int]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return (0, 0)
+        return (st.st_mtime_ns, st.st_size)
+
+    def current(self) -> Tuple:
+        '''Return the current version stamp of the database.'''
+        with self._lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(f"file:{self.db_path}?mode=ro",
+                                            uri=True, check_same_thread=False)
+            data_version = self._conn.execute("PRAGMA data_version;").fetchone()[0]
+        return (data_version, self._file_stamp(self.db_path),
+                self._file_stamp(f"{self.db_path}-wal"))
+
+    def close(self):
+        '''Close the connection used to read the version.'''
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class ResultCache:
+    '''Thread-safe LRU cache of query results bounded by size in bytes.'''
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[CacheKey, Tuple[CachedResult, int]]" = OrderedDict()
+        self._versions: dict = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        '''Whether the cache stores anything at all.'''
+        return self.max_bytes > 0
+
+    def make_key(self, db_path: str, sql: str, row_limit: int) -> CacheKey:
+        '''Build the cache key for a query against the given database.'''
+        with self._lock:
+            version = self._versions.get(db_path)
+            if version is None:
+                version = self._versions[db_path] = DatabaseVersion(db_path)
+        return (db_path, canonical_sql(sql), row_limit, version.current())
+
+    def get(self, key: CacheKey) -> Optional[CachedResult]:
+        '''Return the cached result for the key, or None.'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                CACHE_REQUESTS.inc(cache="result", result="miss")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            CACHE_REQUESTS.inc(cache="result", result="hit")
+            return entry[0]
+
+    def put(self, key: CacheKey, sql: str, cols: List[str], rows: List[Tuple[Any]]):
+        '''Store the result of ``sql``, evicting least recently used entries as needed.'''
+        size = estimate_size(cols, rows) + sys.getsizeof(sql)
+        if size > self.max_bytes:
+            logger.debug("Result of %d bytes is larger than the cache, not stored", size)
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._entries[key] = ((sql, cols, rows), size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted
+
+    def forget(self, db_path: str):
+        '''Drop the entries and the version tracking of one database.'''
+        with self._lock:
+            version = self._versions.pop(db_path, None)
+            for key in [k for k in self._entries if k[0] == db_path]:
+                _, size = self._entries.pop(key)
+                self.current_bytes -= size
+        if version is not None:
+            version.close()
+
+    def clear(self):
+        '''Drop every cached entry.'''
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+
+result_cache = ResultCache(int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024))))
+
+Gauge("result_cache_bytes", "Estimated size of the cached results.", lambda: result_cache.current_bytes)
@@ -2,14 +2,21 @@
     Retriever module for the Text-to-SQL Chatbot with RAG application.
 '''
 import os
+import asyncio
 import logging
+import functools
+import threading
 from typing import List, TypedDict
 
 from dotenv import load_dotenv
 from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
 from sentence_transformers import CrossEncoder
 
+from inference_backends import load_cross_encoder, load_embeddings
+from metrics import span
+from worker_pools import CPU_POOL, IO_POOL, run_in
+import vector_generations
+
 # Load environment variables
 load_dotenv()
 
@@ -20,46 +27,145 @@ class RAGState(TypedDict, total=False):
     """State for the RAG loop."""
     question: str
     retrieved_docs: List[str]
+    retrieved_meta: List[dict]
     generated_sql: str
     validated_sql: str
     sql_result: List[dict]
     messages: List[dict]
 
 
-embeddings = HuggingFaceEmbeddings(model_name=os.getenv("EMBED_MODEL"))
-vectordb = Chroma(persist_directory=os.getenv("VECTOR_STORE_DIR"),
-                embedding_function=embeddings, collection_name=os.getenv("VECTOR_COLLECTION"))
+embeddings = load_embeddings(os.getenv("EMBED_MODEL"))
 
 
-# Increments the number of documents retrieved for reranking,
-# to allow the rerank model to choose the best ones
-initial_k = int(os.getenv("TOP_K")) * 3
-retriever = vectordb.as_retriever(search_kwargs={"k": initial_k})
+class CollectionStore:
+    """Store of the active collection generation (see vector_generations) of
+    a vector store directory, swapped when its pointer file changes."""
+
+    def __init__(self, store_dir: str, base_collection: str):
+        self.store_dir = store_dir
+        self.base_collection = base_collection
+        self.vectordb = None
+        self.collection = None
+        self._pointer_mtime = None
+        self._lock = threading.Lock()
+
+    def _read_pointer_mtime(self):
+        try:
+            return os.stat(vector_generations.pointer_path(self.store_dir)).st_mtime_ns
+        except OSError:
+            return None
+
+    def reload(self) -> str:
+        """Switch to the collection named by the pointer file and return its name.
+
+        A collection that doesn't exist isn't opened, as that would create it
+        empty: the current one keeps being served, and MissingCollection is
+        raised if there is none.
+        """
+        with self._lock:
+            mtime = self._read_pointer_mtime()
+            name = vector_generations.active_collection(self.store_dir, self.base_collection)
+            if self.vectordb is None or name != self.collection:
+                if vector_generations.collection_count(name, self.store_dir) is None:
+                    if self.vectordb is None:
+                        raise vector_generations.MissingCollection(
+                            f"collection {name} doesn't exist in {self.store_dir}")
+                    logging.error("Collection %s named by the pointer doesn't exist, "
+                                  "still serving %s", name, self.collection)
+                    self._pointer_mtime = mtime
+                    return self.collection
+                self.vectordb = Chroma(persist_directory=self.store_dir,
+                                    embedding_function=embeddings, collection_name=name)
+                if self.collection is not None:
+                    logging.info("Switched from collection %s to %s", self.collection, name)
+                self.collection = name
+            self._pointer_mtime = mtime
+        return name
+
+    def get(self) -> Chroma:
+        """Return the store of the active collection, reloading it when the pointer changed."""
+        if self.vectordb is None or self._read_pointer_mtime() != self._pointer_mtime:
+            self.reload()
+        return self.vectordb
+
+    def count(self) -> int:
+        """Number of documents in the active collection."""
+        return vector_generations.collection_count(self.reload(), self.store_dir) or 0
+
+    def close(self):
+        """Drop the store; the next search opens it again."""
+        with self._lock:
+            self.vectordb = None
+            self.collection = None
+            self._pointer_mtime = None
+        vector_generations.release_store(self.store_dir)
+
+
+# store of the database configured with VECTOR_STORE_DIR and VECTOR_COLLECTION
+default_store = CollectionStore(os.getenv("VECTOR_STORE_DIR"), os.getenv("VECTOR_COLLECTION"))
+
+
+def reload_collection() -> str:
+    """Switch the default store to the collection named by the pointer file and return its name."""
+    return default_store.reload()
+
+
+def get_vectordb() -> Chroma:
+    """Return the default store of the active collection."""
+    return default_store.get()
+
+
+try:
+    reload_collection()
+except vector_generations.MissingCollection as e:
+    # searches fail with the same error until ingest_pipeline.py has run
+    logging.warning("%s, run ingest_pipeline.py", e)
+
+
+@functools.lru_cache(maxsize=1)
+def embedding_dimension() -> int:
+    """Length of the vectors of the embedding model."""
+    return len(embeddings.embed_query("dimension"))
+
+# RERANK_MODEL that keeps the documents in vector distance order
+NO_RERANK = "none"
 
 # Initialize the rerank model
-rerank_model = CrossEncoder(os.getenv("RERANK_MODEL"))
+rerank_model = None if os.getenv("RERANK_MODEL") == NO_RERANK else \
+    load_cross_encoder(os.getenv("RERANK_MODEL"))
+
+# Increments the number of documents retrieved for reranking,
+# to allow the rerank model to choose the best ones
+RERANK_CANDIDATE_MULTIPLIER = int(os.getenv("RERANK_CANDIDATE_MULTIPLIER", "3")) \
+    if rerank_model is not None else 1
+initial_k = int(os.getenv("TOP_K")) * RERANK_CANDIDATE_MULTIPLIER
 
 
-def rerank_documents(question: str, docs: List, top_k: int = None) -> List:
+def rerank_documents(question: str, docs: List, top_k: int = None,
+                    model: CrossEncoder = None) -> List:
     """
     Re-ranks documents using a CrossEncoder model.
     Args:
         question: The user's question
         docs: List of retrieved documents
         top_k: Number of documents to return (default: TOP_K from .env)
+        model: CrossEncoder to score with (default: the RERANK_MODEL one)
     Returns:
-        List of re-ranked documents
+        List of re-ranked documents, the first top_k as given with RERANK_MODEL=none
     """
     if not docs:
         return []
 
     if top_k is None:
         top_k = int(os.getenv("TOP_K", "5"))
+    if model is None and rerank_model is None:
+        return docs[:top_k]
 
     pairs = [(question, doc.page_content) for doc in docs]
 
     # Calc the estimated scores
-    scores = rerank_model.predict(pairs)
+    with span("rerank"):
+        scores = (model or rerank_model).predict(pairs)
     # make a combined list of docs and scores
     doc_scores = list(zip(docs, scores))
     doc_scores.sort(key=lambda x: x[1], reverse=True)
@@ -72,25 +178,115 @@ def rerank_documents(question: str, docs: List, top_k: int = None) -> List:
     return reranked_docs
 
 
-def retriever_node(state: RAGState) -> RAGState:
+def rerank_documents_batch(questions: List[str], docs_per_question: List[List],
+                            top_k: int = None) -> List[List]:
+    """
+    Re-ranks the documents of several questions with a single CrossEncoder call.
+    Args:
+        questions: The users' questions
+        docs_per_question: The retrieved documents of each question
+        top_k: Number of documents to return per question (default: TOP_K from .env)
+    Returns:
+        List of re-ranked documents for each question
+    """
+    if top_k is None:
+        top_k = int(os.getenv("TOP_K", "5"))
+    if rerank_model is None:
+        return [docs[:top_k] for docs in docs_per_question]
+
+    pairs = [(q, doc.page_content) for q, docs in zip(questions, docs_per_question) for doc in docs]
+    if not pairs:
+        return [[] for _ in questions]
+
+    with span("rerank"):
+        scores = rerank_model.predict(pairs, batch_size=int(os.getenv("RERANK_BATCH_SIZE", "64")))
+
+    reranked, start = [], 0
+    for docs in docs_per_question:
+        doc_scores = list(zip(docs, scores[start:start + len(docs)]))
+        doc_scores.sort(key=lambda x: x[1], reverse=True)
+        reranked.append([doc for doc, _ in doc_scores[:top_k]])
+        start += len(docs)
+
+    logging.info(f"Reranked {len(pairs)} documents for {len(questions)} questions")
+    return reranked
+
+
+def embed_question(question: str) -> List[float]:
+    """Embed the question with the same model used at ingest."""
+    with span("embed"):
+        return embeddings.embed_query(question)
+
+
+def embed_questions(questions: List[str]) -> List[List[float]]:
+    """Embed several questions in a single model call."""
+    with span("embed"):
+        return embeddings.embed_documents(questions)
+
+
+def search_candidates(vector: List[float], k: int = None,
+                      store: CollectionStore = None) -> List:
+    """Return the documents closest to the embedded question (default store: the configured one)."""
+    with span("vector_search"):
+        return (store or default_store).get().similarity_search_by_vector(vector, k=k or initial_k)
+
+
+def retriever_node(state: RAGState, store: CollectionStore = None) -> RAGState:
     """
     Retrieves documents based on the given state.
     Args:
         state (RAGState): The state 
         containing the question.
+        store: The vector store to search (default: the configured one)
 
     Returns:
-        RAGState: The updated state with retrieved documents.
+        RAGState: The updated state with retrieved documents and their metadata.
     """
     # Retrieve initial documents
-    docs = retriever.invoke(state["question"])
+    docs = search_candidates(embed_question(state["question"]), store=store)
 
     # Rerank the retrieved documents
     reranked_docs = rerank_documents(state["question"], docs)
 
     state["retrieved_docs"] = [d.page_content for d in reranked_docs]
-    print(len(state["retrieved_docs"]))
+    state["retrieved_meta"] = [d.metadata for d in reranked_docs]
     return state
 
 
-# print(retriever_node({"question": "Comércio ABC S/A"}))
+async def aretriever_node(state: RAGState, store: CollectionStore = None) -> RAGState:
+    """
+    Async version of retriever_node. Model inference runs in the CPU pool and
+    the vector store search in the I/O pool, so the event loop stays free.
+    """
+    vector = await run_in(CPU_POOL, embed_question, state["question"])
+    docs = await run_in(IO_POOL, search_candidates, vector, None, store)
+    reranked_docs = await run_in(CPU_POOL, rerank_documents, state["question"], docs)
+
+    state["retrieved_docs"] = [d.page_content for d in reranked_docs]
+    state["retrieved_meta"] = [d.metadata for d in reranked_docs]
+    return state
+
+
+async def aretriever_batch(states: List[RAGState],
+                           stores: List[CollectionStore] = None) -> List[RAGState]:
+    """
+    Retrieves documents for several questions at once: all questions are
+    embedded in one model call, the vector store is searched concurrently and
+    all candidates are reranked together. ``stores`` gives the store of each
+    question when they don't all use the configured one.
+    """
+    if not states:
+        return states
+    questions = [state["question"] for state in states]
+    vectors = await run_in(CPU_POOL, embed_questions, questions)
+    docs = await asyncio.gather(*[run_in(IO_POOL, search_candidates, v, None, store)
+                                  for v, store in zip(vectors, stores or [None] * len(states))])
+    reranked = await run_in(CPU_POOL, rerank_documents_batch, questions, list(docs))
+
+    for state, reranked_docs in zip(states, reranked):
+        state["retrieved_docs"] = [d.page_content for d in reranked_docs]
+        state["retrieved_meta"] = [d.metadata for d in reranked_docs]
+    return states
+
+
+# print(retriever_node({"question": "Comércio ABC S/A"}))
\ No newline at end of file
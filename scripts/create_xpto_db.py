@@ -5,16 +5,60 @@ Este script cria tabelas, dados de exemplo e metadados (comentários) para uma e
 """
 import sqlite3
 import os
+import random
+import argparse
+import itertools
+from datetime import date, timedelta
 
-def create_xpto_database():
-    """Cria o banco de dados da empresa XPTO com tabelas, dados e metadados."""
+# Volume de linhas geradas por unidade de escala
+SCALE_ROWS = {
+    'funcionarios': 200,
+    'clientes': 2000,
+    'produtos': 500,
+    'vendas': 20000,
+}
+# Quantidade de vendas gravadas por transação
+CHUNK_SIZE = 50000
+
+NOMES = ['Ana', 'Bruno', 'Carla', 'Daniel', 'Eduarda', 'Felipe', 'Gabriela', 'Henrique', 'Isabela',
+         'João', 'Larissa', 'Marcos', 'Natália', 'Otávio', 'Paula', 'Rafael', 'Sofia', 'Thiago',
+         'Vanessa', 'Wagner']
+SOBRENOMES = ['Silva', 'Santos', 'Oliveira', 'Souza', 'Lima', 'Pereira', 'Costa', 'Almeida',
+              'Ferreira', 'Rodrigues', 'Gomes', 'Martins', 'Araújo', 'Barbosa', 'Ribeiro']
+CIDADES = [('São Paulo', 'SP'), ('Rio de Janeiro', 'RJ'), ('Belo Horizonte', 'MG'),
+           ('Curitiba', 'PR'), ('Porto Alegre', 'RS'), ('Salvador', 'BA'), ('Recife', 'PE'),
+           ('Fortaleza', 'CE'), ('Brasília', 'DF'), ('Campinas', 'SP')]
+DEPARTAMENTOS = ['Tecnologia da Informação', 'Recursos Humanos', 'Vendas', 'Marketing',
+                 'Financeiro', 'Operações']
+CARGOS = ['Analista', 'Assistente', 'Coordenador', 'Consultor', 'Especialista', 'Gerente']
+SEGMENTOS = ['Tecnologia', 'Software', 'Varejo', 'Serviços', 'Consultoria', 'Indústria',
+             'Saúde', 'Educação']
+CATEGORIAS = {
+    'Software': ['ERP', 'Licenciamento', 'CRM', 'BI'],
+    'Serviços': ['Consultoria', 'Desenvolvimento', 'Suporte', 'Treinamento'],
+    'Hardware': ['Servidores', 'Notebooks', 'Redes'],
+}
+FORMAS_PAGAMENTO = ['Boleto', 'PIX', 'Cartão', 'Transferência']
+CONDICOES_PAGAMENTO = ['À vista', '30 dias', '2x sem juros', '60 dias']
+STATUS_VENDA = ['Orçamento', 'Aprovado', 'Faturado', 'Entregue', 'Pago', 'Cancelado']
+PESOS_STATUS = [5, 8, 10, 15, 57, 5]
+INICIO_VENDAS = date(2019, 1, 1)
+DIAS_VENDAS = (date(2024, 12, 31) - INICIO_VENDAS).days
+
+def create_xpto_database(db_path='data/xpto_empresa.db', scale=0, seed=42):
+    """Cria o banco de dados da empresa XPTO com tabelas, dados e metadados.
+
+    Com scale > 0, gera também dados sintéticos em volume proporcional à escala
+    (scale=1 gera 20 mil vendas).
+    """
     
-    # Criar diretório data se não existir
-    if not os.path.exists('data'):
-        os.makedirs('data')
+    # Criar diretório do banco se não existir
+    db_dir = os.path.dirname(db_path)
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir)
     
     # Conectar ao banco de dados
-    conn = sqlite3.connect('data/xpto_empresa.db')
+    conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
     
     # Criar tabelas de metadados primeiro
@@ -29,13 +73,18 @@ def create_xpto_database():
     
     # Inserir dados de exemplo
     insert_sample_data(cursor)
+    conn.commit()
+    
+    # Gerar dados sintéticos em escala
+    if scale > 0:
+        generate_scaled_data(conn, scale, seed)
     
     # Confirmar mudanças e fechar conexão
     conn.commit()
     conn.close()
     
     print("✅ Banco de dados da empresa XPTO criado com sucesso!")
-    print("📍 Localização: data/xpto_empresa.db")
+    print(f"📍 Localização: {db_path}")
     print("📋 Inclui metadados completos (comentários de tabelas e colunas)")
 
 def create_metadata_tables(cursor):
@@ -443,6 +492,172 @@ def insert_sample_data(cursor):
     
     print("✅ Dados de exemplo inseridos com sucesso!")
 
+def skewed_weights(n, exponent=1.1):
+    """Pesos acumulados de uma distribuição Zipf: poucos itens concentram a maior parte."""
+    weights = [1 / (rank ** exponent) for rank in range(1, n + 1)]
+    return list(itertools.accumulate(weights))
+
+def scaled_count(table, scale):
+    """Número de linhas geradas para a tabela na escala pedida."""
+    return max(1, round(SCALE_ROWS[table] * scale))
+
+def next_id(cursor, table):
+    """Próximo id livre da tabela."""
+    cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+    return cursor.fetchone()[0] + 1
+
+def pessoa(rng):
+    """Nome completo aleatório."""
+    return f"{rng.choice(NOMES)} {rng.choice(SOBRENOMES)} {rng.choice(SOBRENOMES)}"
+
+def generate_funcionarios(cursor, rng, count):
+    """Gera funcionários, concentrando a equipe em Vendas e TI."""
+    first = next_id(cursor, 'funcionarios')
+    # supervisores entre os primeiros funcionários gerados, que não têm supervisor
+    lideres = max(1, count // 20)
+    rows = []
+    for i in range(count):
+        fid = first + i
+        departamento = rng.choices(DEPARTAMENTOS, weights=[25, 5, 35, 10, 10, 15])[0]
+        cidade, uf = rng.choice(CIDADES)
+        admissao = date(2010, 1, 1) + timedelta(days=rng.randrange(5000))
+        supervisor = first + rng.randrange(lideres) if i >= lideres else None
+        rows.append((fid, pessoa(rng), f"func{fid}@xpto.com.br", f"{rng.choice(CARGOS)} de {departamento}",
+                     departamento, round(rng.lognormvariate(8.6, 0.4), 2), admissao.isoformat(),
+                     f"(11) 9{fid // 10000 % 10000:04d}-{fid % 10000:04d}", f"Rua {rng.choice(SOBRENOMES)}, {rng.randrange(1, 2000)}, {cidade} - {uf}",
+                     1 if rng.random() < 0.95 else 0, supervisor))
+    cursor.executemany('''
+    INSERT INTO funcionarios (id, nome, email, cargo, departamento, salario, data_admissao, telefone, endereco, ativo, supervisor_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    # vendedores são os que atendem os pedidos gerados
+    vendedores = [r[0] for r in rows if r[4] == 'Vendas'] or [r[0] for r in rows]
+    return vendedores
+
+def generate_clientes(cursor, rng, count):
+    """Gera clientes pessoa física e jurídica."""
+    first = next_id(cursor, 'clientes')
+    rows = []
+    for i in range(count):
+        cid = first + i
+        cidade, uf = rng.choices(CIDADES, weights=[30, 15, 10, 8, 7, 6, 6, 5, 8, 5])[0]
+        juridica = rng.random() < 0.7
+        nome = f"{rng.choice(SOBRENOMES)} {rng.choice(SEGMENTOS)} Ltda" if juridica else pessoa(rng)
+        documento = f"{cid:08d}/0001-{cid % 97:02d}" if juridica else f"{cid:09d}-{cid % 97:02d}"
+        cadastro = date(2015, 1, 1) + timedelta(days=rng.randrange(3650))
+        rows.append((cid, nome, f"cliente{cid}@exemplo.com.br", f"(11) 3{cid // 10000 % 1000:03d}-{cid % 10000:04d}",
+                     f"Av. {rng.choice(SOBRENOMES)}, {rng.randrange(1, 5000)}", cidade, uf,
+                     f"{rng.randrange(10000, 99999)}-{rng.randrange(1000):03d}", documento,
+                     f"{cid:012d}" if juridica else None,
+                     'Pessoa Jurídica' if juridica else 'Pessoa Física', rng.choice(SEGMENTOS),
+                     cadastro.isoformat(), round(rng.lognormvariate(10, 1), 2),
+                     1 if rng.random() < 0.9 else 0))
+    cursor.executemany('''
+    INSERT INTO clientes (id, nome, email, telefone, endereco, cidade, estado, cep, cnpj, inscricao_estadual, tipo_cliente, segmento_mercado, data_cadastro, limite_credito, ativo)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    return [r[0] for r in rows]
+
+def generate_produtos(cursor, rng, count):
+    """Gera produtos e serviços com preços de cauda longa."""
+    first = next_id(cursor, 'produtos')
+    rows = []
+    for i in range(count):
+        pid = first + i
+        categoria = rng.choices(list(CATEGORIAS), weights=[3, 5, 2])[0]
+        subcategoria = rng.choice(CATEGORIAS[categoria])
+        preco = round(rng.lognormvariate(7, 1.2), 2)
+        custo = round(preco * rng.uniform(0.4, 0.8), 2)
+        estoque = rng.randrange(500) if categoria == 'Hardware' else 0
+        rows.append((pid, f"GEN-{pid:06d}", f"{subcategoria} {rng.choice(SOBRENOMES)} {pid}",
+                     f"{categoria} - {subcategoria}", categoria, subcategoria, preco, custo,
+                     round((preco - custo) / preco * 100, 1), estoque, estoque // 5, estoque * 2,
+                     'UN' if categoria != 'Serviços' else 'HR', f"Fornecedor {rng.randrange(1, 50)}",
+                     'Estoque TI' if categoria == 'Hardware' else 'N/A',
+                     1 if rng.random() < 0.95 else 0))
+    cursor.executemany('''
+    INSERT INTO produtos (id, codigo_produto, nome, descricao, categoria, subcategoria, preco_venda, custo_unitario, margem_lucro, estoque_atual, estoque_minimo, estoque_maximo, unidade_medida, fornecedor_principal, localizacao_estoque, ativo)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    return [(r[0], r[6]) for r in rows]
+
+def generate_vendas(conn, rng, count, clientes, vendedores, produtos):
+    """Gera vendas e seus itens em transações de CHUNK_SIZE vendas.
+
+    Clientes, vendedores e produtos seguem uma distribuição Zipf, então poucos
+    clientes e produtos concentram a maior parte do faturamento, e o volume de
+    vendas cresce ao longo do período.
+    """
+    cursor = conn.cursor()
+    cum_clientes = skewed_weights(len(clientes))
+    cum_vendedores = skewed_weights(len(vendedores), 0.8)
+    cum_produtos = skewed_weights(len(produtos))
+    venda_id = next_id(cursor, 'vendas')
+    item_id = next_id(cursor, 'itens_venda')
+    generated = 0
+    while generated < count:
+        size = min(CHUNK_SIZE, count - generated)
+        cliente_ids = rng.choices(clientes, cum_weights=cum_clientes, k=size)
+        vendedor_ids = rng.choices(vendedores, cum_weights=cum_vendedores, k=size)
+        vendas, itens = [], []
+        for cliente_id, vendedor_id in zip(cliente_ids, vendedor_ids):
+            # mais vendas nos anos recentes
+            data_venda = INICIO_VENDAS + timedelta(days=int(DIAS_VENDAS * rng.random() ** 0.7))
+            n_itens = min(1 + int(rng.expovariate(0.7)), 10)
+            bruto = 0.0
+            for produto_id, preco in rng.choices(produtos, cum_weights=cum_produtos, k=n_itens):
+                quantidade = min(1 + int(rng.expovariate(0.5)), 50)
+                desconto_item = rng.choice((0.0, 0.0, 0.0, 5.0, 10.0))
+                total_item = round(quantidade * preco * (1 - desconto_item / 100), 2)
+                # o valor bruto da venda é a soma dos itens já com seus descontos
+                bruto += total_item
+                itens.append((item_id, venda_id, produto_id, quantidade, preco, desconto_item,
+                              total_item, None))
+                item_id += 1
+            desconto = rng.choice((0.0, 0.0, 2.5, 5.0, 10.0))
+            status = rng.choices(STATUS_VENDA, weights=PESOS_STATUS)[0]
+            prevista = data_venda + timedelta(days=rng.randrange(5, 45))
+            entregue = status in ('Entregue', 'Pago')
+            real = prevista + timedelta(days=rng.randrange(-5, 10)) if entregue else None
+            vendas.append((venda_id, f"PED-{data_venda.year}-{venda_id:08d}", cliente_id, vendedor_id,
+                           data_venda.isoformat(), prevista.isoformat(),
+                           real.isoformat() if real else None, round(bruto, 2), desconto,
+                           round(bruto * (1 - desconto / 100), 2), f"Pedido com {n_itens} itens",
+                           rng.choice(FORMAS_PAGAMENTO), rng.choice(CONDICOES_PAGAMENTO), status, None))
+            venda_id += 1
+        cursor.executemany('''
+        INSERT INTO vendas (id, numero_pedido, cliente_id, funcionario_id, data_venda, data_entrega_prevista, data_entrega_real, valor_bruto, desconto, valor_total, descricao, forma_pagamento, condicoes_pagamento, status, observacoes)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', vendas)
+        cursor.executemany('''
+        INSERT INTO itens_venda (id, venda_id, produto_id, quantidade, preco_unitario, desconto_item, valor_total_item, observacoes)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', itens)
+        conn.commit()
+        generated += size
+        print(f"   {generated:,}/{count:,} vendas geradas")
+
+def generate_scaled_data(conn, scale, seed=42):
+    """Gera dados sintéticos relacionados no volume definido pela escala.
+
+    A mesma escala e semente sempre geram os mesmos dados.
+    """
+    rng = random.Random(seed)
+    cursor = conn.cursor()
+    # carga em massa: WAL e sem fsync a cada transação
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=OFF")
+    cursor.execute("PRAGMA cache_size=-262144")
+
+    vendedores = generate_funcionarios(cursor, rng, scaled_count('funcionarios', scale))
+    clientes = generate_clientes(cursor, rng, scaled_count('clientes', scale))
+    produtos = generate_produtos(cursor, rng, scaled_count('produtos', scale))
+    conn.commit()
+    generate_vendas(conn, rng, scaled_count('vendas', scale), clientes, vendedores, produtos)
+    # volta ao modo padrão, que leitores somente leitura abrem sem o -wal
+    cursor.execute("PRAGMA journal_mode=DELETE")
+    print(f"✅ Dados sintéticos gerados (escala {scale})!")
+
 def get_metadata_info(db_path):
     """Função para consultar metadados do banco."""
     conn = sqlite3.connect(db_path)
@@ -474,5 +689,11 @@ def get_metadata_info(db_path):
     conn.close()
 
 if __name__ == "__main__":
-    create_xpto_database()
-    get_metadata_info('data/xpto_empresa.db')
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Cria o banco de dados SQLite da empresa XPTO.")
+    parser.add_argument("--db", default="data/xpto_empresa.db", help="caminho do banco")
+    parser.add_argument("--scale", type=float, default=0,
+                        help="gera dados sintéticos (1 = 20 mil vendas, 100 = 2 milhões)")
+    parser.add_argument("--seed", type=int, default=42, help="semente dos dados sintéticos")
+    args = parser.parse_args()
+    create_xpto_database(args.db, args.scale, args.seed)
+    get_metadata_info(args.db)
\ No newline at end of file
@@ -2,13 +2,19 @@
 import sqlite3
 import re
 import os
-from typing import Tuple, List, Any
+import time
+from functools import lru_cache
+from typing import Iterator, Tuple, List, Any, Optional, Union
 
+import query_log
+from metrics import span
+from result_cache import result_cache
 
 
-def open_ro_conn():
+def open_ro_conn(db_path: Optional[str] = None):
     '''Open a read-only connection to the SQLite database.'''
-    return sqlite3.connect(f"file:{os.getenv('DATABASE_PATH')}?mode=ro", uri=True, check_same_thread=False)
+    db_path = db_path or os.getenv('DATABASE_PATH')
+    return sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
 
 def enforce_limit(sql: str, limit: int = 1000) -> str:
     '''Ensure the SQL query has a LIMIT clause.'''
@@ -16,15 +22,114 @@ def enforce_limit(sql: str, limit: int = 1000) -> str:
         return sql
     return f"{sql} LIMIT {limit}"
 
-def execute_sql(sql: str, row_limit: int = 1000, timeout=5.0) -> Tuple[List[str], List[Tuple[Any]]]:
-    '''Execute the given SQL query with a row limit and timeout.'''
-
-    sql = enforce_limit(sql, row_limit)
-    conn = open_ro_conn()
-    conn.execute(f"PRAGMA busy_timeout = {int(timeout*1000)};")
-    cur = conn.cursor()
-    cur.execute(sql)
-    cols = [c[0] for c in cur.description] if cur.description else []
-    rows = cur.fetchmany(row_limit)
-    conn.close()
-    return cols, rows
\ No newline at end of file
+@lru_cache(maxsize=1024)
+def output_names(db_path: str, sql: str) -> Tuple[str, ...]:
+    '''Column names SQLite gives to the result of the query, without running it.
+
+    Repeated names come back renamed (``id``, ``id:1``) as for any subquery.
+    '''
+    conn = open_ro_conn(db_path)
+    try:
+        cur = conn.execute(f"SELECT * FROM ({sql}) WHERE 0")
+        return tuple(c[0] for c in cur.description)
+    finally:
+        conn.close()
+
+def _from_cache(key, sql: str, db_path: str) -> Optional[Tuple[List[str], List[Tuple[Any]]]]:
+    '''Cached result of the query, with the column names of this spelling of it.
+
+    Spellings that differ in case share the key, while SQLite names unaliased
+    result columns exactly as they are written.
+    '''
+    cached = result_cache.get(key)
+    if cached is None:
+        return None
+    cached_sql, cols, rows = cached
+    if cached_sql != sql:
+        try:
+            cols = list(output_names(db_path, sql))
+        except sqlite3.Error:
+            return None
+        if any(m and m.group(1) in cols for m in (re.fullmatch(r"(.+):\d+", c) for c in cols)):
+            # the names of repeated columns can't be told from the renamed ones
+            return None
+    return cols, rows
+
+def execute_sql(sql: str, row_limit: int = 1000, timeout=5.0, use_cache: bool = True,
+                db_path: Optional[str] = None) -> Tuple[List[str], List[Tuple[Any]]]:
+    '''Execute the given SQL query with a row limit and timeout.
+
+    Results are served from the result cache when the same query was already
+    executed against the current version of the database. ``db_path``
+    defaults to ``DATABASE_PATH``. The query is logged as given, without the
+    row limit, whether it is served from the cache or executed.
+    '''
+    db_path = db_path or os.getenv('DATABASE_PATH')
+    start = time.perf_counter()
+    key = None
+    if use_cache and result_cache.enabled:
+        key = result_cache.make_key(db_path, sql, row_limit)
+        cached = _from_cache(key, sql, db_path)
+        if cached is not None:
+            query_log.record(sql, (time.perf_counter() - start) * 1000, len(cached[1]),
+                            cached=True, db_path=db_path)
+            return cached
+
+    with span("execute"):
+        conn = open_ro_conn(db_path)
+        conn.execute(f"PRAGMA busy_timeout = {int(timeout*1000)};")
+        cur = conn.cursor()
+        cur.execute(enforce_limit(sql, row_limit))
+        cols = [c[0] for c in cur.description] if cur.description else []
+        rows = cur.fetchmany(row_limit)
+        conn.close()
+    query_log.record(sql, (time.perf_counter() - start) * 1000, len(rows), db_path=db_path)
+
+    if key is not None:
+        result_cache.put(key, sql, cols, rows)
+    return cols, rows
+
+def iter_sql(sql: str, row_limit: int = 100000, chunk_size: int = 500, timeout=5.0,
+            db_path: Optional[str] = None) -> Iterator[Union[List[str], List[Tuple[Any]]]]:
+    '''Execute the given SQL query and yield results while the cursor is read.
+
+    The first item yielded is the list of column names, every following item
+    is a chunk of at most ``chunk_size`` rows. The connection is closed and
+    the query logged when the generator is exhausted or closed.
+    '''
+    db_path = db_path or os.getenv('DATABASE_PATH')
+    start = time.perf_counter()
+    if result_cache.enabled:
+        cached = _from_cache(result_cache.make_key(db_path, sql, row_limit), sql, db_path)
+        if cached is not None:
+            query_log.record(sql, (time.perf_counter() - start) * 1000, len(cached[1]),
+                            cached=True, db_path=db_path)
+            cols, rows = cached
+            yield cols
+            for i in range(0, len(rows), chunk_size):
+                yield rows[i:i + chunk_size]
+            return
+
+    conn = open_ro_conn(db_path)
+    executed = False
+    remaining = row_limit
+    try:
+        conn.execute(f"PRAGMA busy_timeout = {int(timeout*1000)};")
+        cur = conn.cursor()
+        # only time the query itself, the rest depends on the consumer
+        with span("execute"):
+            cur.execute(enforce_limit(sql, row_limit))
+        executed = True
+        yield [c[0] for c in cur.description] if cur.description else []
+        while remaining > 0:
+            rows = cur.fetchmany(min(chunk_size, remaining))
+            if not rows:
+                break
+            remaining -= len(rows)
+            yield rows
+    finally:
+        conn.close()
+        # also when the consumer stops reading early
+        if executed:
+            query_log.record(sql, (time.perf_counter() - start) * 1000, row_limit - remaining,
+                            db_path=db_path)
@@ -6,6 +6,7 @@ import os
 from langchain_core.prompts import PromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
 
+from metrics import span
 from retriever_node import RAGState
 
 
@@ -29,29 +30,29 @@ sql_agent_prompt = PromptTemplate.from_template("""
         - Return only the SQL SELECT statement.                                                
         """)
 
-def sql_generator_node(state: RAGState) -> RAGState:
-    """
-    Generate SQL from the retrieved documents and user question.
-    Cleans LLM output, removes markdown/code fences, and ensures only SELECT statements remain.
-    """
+def build_prompt(state: RAGState) -> str:
+    """Build the SQL generation prompt from the retrieved documents and question."""
     # 1. Combine retrieved documents
     context = "\n\n".join(state.get("retrieved_docs", []))
 
     # 2. Format the prompt
-    prompt_text = sql_agent_prompt.format(context=context, question=state["question"])
+    return sql_agent_prompt.format(context=context, question=state["question"])
 
-    # 3. Call the LLM
-    out =  LLM.invoke(prompt_text)
 
-    # 4. Extract text content if output is an AIMessage or ChatResult
+def clean_sql_output(out) -> str:
+    """
+    Clean the LLM output, removing markdown/code fences and anything
+    that isn't part of the SELECT statement.
+    """
+    # 1. Extract text content if output is an AIMessage or ChatResult
     if hasattr(out, "content"):
         out = out.content
     out = str(out).strip()
 
-    # 5. Remove code fences ``` or ```sql and any leading/trailing whitespace
+    # 2. Remove code fences ``` or ```sql and any leading/trailing whitespace
     out = re.sub(r"```(?:sql)?\n?", "", out, flags=re.IGNORECASE).replace("```", "").strip()
 
-    # 6. Ensure the SQL starts with SELECT (case-insensitive)
+    # 3. Ensure the SQL starts with SELECT (case-insensitive)
     match = re.search(r"(select\b.*)", out, flags=re.IGNORECASE | re.DOTALL)
     if match:
         out = match.group(1).strip()
@@ -59,11 +60,35 @@ def sql_generator_node(state: RAGState) -> RAGState:
         # fallback if no SELECT found
         out = ""
 
-    # 7. Optional: remove trailing semicolon if present
-    out = out.rstrip(";").strip()
+    # 4. Optional: remove trailing semicolon if present
+    return out.rstrip(";").strip()
+
+
+def sql_generator_node(state: RAGState) -> RAGState:
+    """
+    Generate SQL from the retrieved documents and user question.
+    Cleans LLM output, removes markdown/code fences, and ensures only SELECT statements remain.
+    """
+    # 1. Build the prompt
+    prompt_text = build_prompt(state)
+
+    # 2. Call the LLM
+    with span("llm"):
+        out =  LLM.invoke(prompt_text)
 
-    # 8. Save cleaned SQL back to state
-    state["generated_sql"] = out
+    # 3. Save cleaned SQL back to state
+    state["generated_sql"] = clean_sql_output(out)
+    return state
+
+
+async def asql_generator_node(state: RAGState) -> RAGState:
+    """
+    Async version of sql_generator_node. The LLM is called through its async
+    client, so waiting for it doesn't hold a thread.
+    """
+    with span("llm"):
+        out = await LLM.ainvoke(build_prompt(state))
+    state["generated_sql"] = clean_sql_output(out)
     return state
 
 
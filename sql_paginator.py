@@ -0,0 +1,330 @@
+'''Paginated execution of SQL queries with opaque continuation tokens.
+
+Two strategies are used:
+
+- keyset pagination, when the query reads a single table without grouping,
+  aggregates or an explicit LIMIT. The ORDER BY keys (plus the table rowid as
+  a tie-breaker) of the last row are carried in the token and the next page
+  is read with a predicate that starts right after them, so every page costs
+  the same regardless of how deep the client is.
+- a short-lived server-side cursor otherwise. The open cursor is kept in a
+  registry for ``PAGE_CURSOR_TTL`` seconds after each page is read. Its
+  tokens carry the number of the page they continue from, so a token can only
+  be used once: replaying it or reading pages out of order is rejected
+  instead of returning a different page.
+
+Tokens are signed with HMAC so clients can't forge the SQL or the database
+they carry. The same signing backs export tokens, which let a client download
+the full result of a query it was answered with for ``EXPORT_TOKEN_TTL``
+seconds.
+'''
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import secrets
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import sqlglot
+from sqlglot import exp
+
+import query_log
+from metrics import Gauge, span
+from sql_executor import open_ro_conn
+
+logger = logging.getLogger(__name__)
+
+PAGE_TOKEN_SECRET = (os.getenv("PAGE_TOKEN_SECRET") or secrets.token_hex(32)).encode()
+PAGE_MAX_SIZE = int(os.getenv("PAGE_MAX_SIZE", "1000"))
+PAGE_CURSOR_TTL = float(os.getenv("PAGE_CURSOR_TTL", "60"))
+PAGE_MAX_OPEN_CURSORS = int(os.getenv("PAGE_MAX_OPEN_CURSORS", "32"))
+EXPORT_TOKEN_TTL = float(os.getenv("EXPORT_TOKEN_TTL", "3600"))
+
+Page = Tuple[List[str], List[Tuple[Any]], Optional[str]]
+
+
+def sign_token(payload: Dict[str, Any]) -> str:
+    '''Encode and sign a token payload.'''
+    body = base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode())
+    sig = hmac.new(PAGE_TOKEN_SECRET, body, hashlib.sha256).digest()
+    return f"{body.decode()}.{base64.urlsafe_b64encode(sig).decode()}"
+
+
+def read_token(token: str) -> Dict[str, Any]:
+    '''Verify and decode a token produced by sign_token.'''
+    try:
+        body, sig = token.encode().split(b".", 1)
+        expected = hmac.new(PAGE_TOKEN_SECRET, body, hashlib.sha256).digest()
+        if not hmac.compare_digest(base64.urlsafe_b64decode(sig), expected):
+            raise ValueError("invalid page token")
+        return json.loads(base64.urlsafe_b64decode(body))
+    except (ValueError, TypeError) as e:
+        raise ValueError("invalid page token") from e
+
+
+def export_token(sql: str, db_path: Optional[str] = None) -> str:
+    '''Token allowing the full result of the SQL to be downloaded.'''
+    return sign_token({"m": "x", "sql": sql, "db": db_path,
+                       "exp": int(time.time() + EXPORT_TOKEN_TTL)})
+
+
+def read_export_token(token: str) -> Tuple[str, Optional[str]]:
+    '''Return the SQL and database of a valid, unexpired export token.'''
+    payload = read_token(token)
+    if payload.get("m") != "x" or payload.get("exp", 0) < time.time():
+        raise ValueError("invalid or expired export token")
+    return payload["sql"], payload.get("db")
+
+
+def _encode_value(v):
+    if isinstance(v, bytes):
+        return {"$b": base64.b64encode(v).decode()}
+    return v
+
+
+def _decode_value(v):
+    if isinstance(v, dict):
+        return base64.b64decode(v["$b"])
+    return v
+
+
+@dataclass
+class KeysetPlan:
+    '''How to read one page of a query with keyset pagination.'''
+    select: exp.Select
+    keys: List[exp.Ordered]
+    hidden: int
+
+    def page_sql(self, after: Optional[List[Any]], page_size: int) -> Tuple[str, List[Any]]:
+        '''Build the SQL and parameters for the page following ``after``.'''
+        select = self.select.copy()
+        params: List[Any] = []
+        if after is not None:
+            branches = []
+            for i, key in enumerate(self.keys):
+                cond = self._after(key, after[i])
+                if cond is None:
+                    continue
+                ties = [f"{prev.this.sql('sqlite')} IS ?" for prev in self.keys[:i]]
+                branches.append(" AND ".join(ties + [cond[0]]))
+                params.extend(after[:i] + cond[1])
+            select = select.where(" OR ".join(f"({b})" for b in branches) or "0",
+                                dialect="sqlite", copy=False)
+        return select.limit(page_size + 1, copy=False).sql("sqlite"), params
+
+    @staticmethod
+    def _after(key: exp.Ordered, value) -> Optional[Tuple[str, List[Any]]]:
+        '''Predicate for rows that sort strictly after ``value`` on one key.'''
+        col = key.this.sql("sqlite")
+        nulls_first = bool(key.args.get("nulls_first"))
+        if value is None:
+            return (f"{col} IS NOT NULL", []) if nulls_first else None
+        cond = f"{col} {'<' if key.args.get('desc') else '>'} ?"
+        if not nulls_first:
+            cond = f"({cond} OR {col} IS NULL)"
+        return cond, [value]
+
+
+def keyset_plan(sql: str) -> Optional[KeysetPlan]:
+    '''Return a keyset plan for the query, or None if it doesn't support one.'''
+    try:
+        parsed = sqlglot.parse_one(sql, read="sqlite")
+    except Exception:
+        return None
+    if not isinstance(parsed, exp.Select):
+        return None
+    if any(parsed.args.get(arg) for arg in ("with", "group", "having", "distinct",
+                                            "limit", "offset", "joins", "qualify")):
+        return None
+    source = parsed.args.get("from_")
+    if source is None or not isinstance(source.this, exp.Table):
+        return None
+    order = parsed.args.get("order")
+    if any(e.find(exp.AggFunc, exp.Window)
+            for e in parsed.expressions + (order.expressions if order else [])):
+        return None
+
+    # ORDER BY may refer to output columns by position or alias, the keyset
+    # predicate needs the underlying expressions
+    aliases = {e.alias: e.this for e in parsed.expressions if isinstance(e, exp.Alias)}
+    keys = []
+    for ordered in (order.expressions if order else []):
+        key = ordered.copy()
+        if isinstance(key.this, exp.Literal) and not key.this.is_string:
+            position = int(key.this.name) - 1
+            if not 0 <= position < len(parsed.expressions):
+                return None
+            target = parsed.expressions[position]
+            key.set("this", (target.this if isinstance(target, exp.Alias) else target).copy())
+        elif isinstance(key.this, exp.Column) and not key.this.table and key.this.name in aliases:
+            key.set("this", aliases[key.this.name].copy())
+        if isinstance(key.this, exp.Star):
+            return None
+        keys.append(key)
+
+    rowid = exp.column("rowid", table=source.this.alias_or_name)
+    keys.append(exp.Ordered(this=rowid, nulls_first=True))
+    select = parsed.copy()
+    for i, key in enumerate(keys):
+        select = select.select(exp.alias_(key.this.copy(), f"__k{i}"), copy=False)
+    select = select.order_by(exp.Ordered(this=rowid.copy(), nulls_first=True), copy=False)
+    return KeysetPlan(select=select, keys=keys, hidden=len(keys))
+
+
+class _OpenCursor:
+    '''A server-side cursor kept open between pages.'''
+
+    def __init__(self, sql: str, timeout: float, db_path: Optional[str] = None):
+        self.conn = open_ro_conn(db_path)
+        try:
+            self.conn.execute(f"PRAGMA busy_timeout = {int(timeout*1000)};")
+            self.cur = self.conn.execute(sql)
+        except Exception:
+            self.conn.close()
+            raise
+        self.cols = [c[0] for c in self.cur.description] if self.cur.description else []
+        self.pending = None
+        # pages read so far, checked against the token
+        self.pages = 0
+        # requests reading from the cursor, guarded by _cursors_lock so it
+        # isn't reaped under them
+        self.users = 0
+        self.expires = time.monotonic() + PAGE_CURSOR_TTL
+        self.lock = threading.Lock()
+
+    def close(self):
+        '''Close the cursor and its connection.'''
+        self.conn.close()
+
+
+_cursors: Dict[str, _OpenCursor] = {}
+_cursors_lock = threading.Lock()
+
+
+def _reap_cursors():
+    '''Close cursors whose TTL has passed and make room for a new one.
+
+    Cursors a request is reading from are left open.
+    '''
+    now = time.monotonic()
+    with _cursors_lock:
+        idle = sorted((cid for cid, c in _cursors.items() if not c.users),
+                      key=lambda cid: _cursors[cid].expires)
+        expired = [cid for cid in idle if _cursors[cid].expires < now]
+        oldest = iter(idle[len(expired):])
+        while len(_cursors) - len(expired) >= PAGE_MAX_OPEN_CURSORS:
+            cid = next(oldest, None)
+            if cid is None:
+                break
+            expired.append(cid)
+        closing = [_cursors.pop(cid) for cid in expired]
+    for c in closing:
+        c.close()
+
+
+def open_cursor_count() -> int:
+    '''Number of server-side cursors currently open.'''
+    with _cursors_lock:
+        return len(_cursors)
+
+
+Gauge("pagination_open_cursors", "Server-side cursors kept open between pages.", open_cursor_count)
+
+
+def _keyset_page(sql: str, plan: KeysetPlan, after, page_size: int, timeout: float,
+                 db_path: Optional[str]) -> Page:
+    page_sql, params = plan.page_sql(after, page_size)
+    conn = open_ro_conn(db_path)
+    try:
+        conn.execute(f"PRAGMA busy_timeout = {int(timeout*1000)};")
+        with span("execute_page"):
+            cur = conn.execute(page_sql, params)
+            cols = [c[0] for c in cur.description][:-plan.hidden]
+            rows = cur.fetchall()
+    finally:
+        conn.close()
+
+    token = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = [_encode_value(v) for v in rows[-1][-plan.hidden:]]
+        token = sign_token({"m": "k", "sql": sql, "db": db_path, "after": last, "n": page_size})
+    return cols, [r[:-plan.hidden] for r in rows], token
+
+
+def _cursor_page(cursor_id: str, cursor: _OpenCursor, page_size: int, page: int) -> Page:
+    '''Read the page after ``page`` from a cursor whose ``users`` the caller incremented.'''
+    more = True
+    try:
+        with cursor.lock, span("execute_page"):
+            if cursor.pages != page:
+                raise ValueError("page token was already used")
+            rows = [cursor.pending] if cursor.pending is not None else []
+            rows += cursor.cur.fetchmany(page_size - len(rows))
+            cursor.pending = cursor.cur.fetchone()
+            cursor.pages += 1
+            cursor.expires = time.monotonic() + PAGE_CURSOR_TTL
+            more = cursor.pending is not None
+    finally:
+        with _cursors_lock:
+            cursor.users -= 1
+            if not more:
+                _cursors.pop(cursor_id, None)
+
+    if not more:
+        cursor.close()
+        return cursor.cols, rows, None
+    return cursor.cols, rows, sign_token({"m": "c", "id": cursor_id, "n": page_size,
+                                          "p": page + 1})
+
+
+def execute_page(sql: str, page_size: int, timeout=5.0, db_path: Optional[str] = None) -> Page:
+    '''Execute the first page of a query.
+
+    Returns the column names, the rows of the page and a continuation token,
+    which is None when there are no more rows. ``db_path`` defaults to
+    ``DATABASE_PATH``.
+    '''
+    start = time.perf_counter()
+    page_size = max(1, min(page_size, PAGE_MAX_SIZE))
+    plan = keyset_plan(sql)
+    if plan is not None:
+        page = _keyset_page(sql, plan, None, page_size, timeout, db_path)
+    else:
+        _reap_cursors()
+        cursor_id = secrets.token_urlsafe(16)
+        cursor = _OpenCursor(sql, timeout, db_path)
+        with _cursors_lock:
+            cursor.users += 1
+            _cursors[cursor_id] = cursor
+        logger.info("Opened server-side cursor for a query without keyset support")
+        page = _cursor_page(cursor_id, cursor, page_size, 0)
+    query_log.record(sql, (time.perf_counter() - start) * 1000, len(page[1]), db_path=db_path)
+    return page
+
+
+def next_page(token: str, timeout=5.0) -> Page:
+    '''Execute the page following the one that returned ``token``.'''
+    payload = read_token(token)
+    if payload.get("m") == "x":
+        raise ValueError("invalid page token")
+    if payload.get("m") == "k":
+        plan = keyset_plan(payload["sql"])
+        if plan is None:
+            raise ValueError("invalid page token")
+        after = [_decode_value(v) for v in payload["after"]]
+        return _keyset_page(payload["sql"], plan, after, payload["n"], timeout, payload.get("db"))
+
+    _reap_cursors()
+    with _cursors_lock:
+        cursor = _cursors.get(payload.get("id"))
+        if cursor is not None:
+            cursor.users += 1
+    if cursor is None:
+        raise ValueError("page token expired")
+    return _cursor_page(payload["id"], cursor, payload["n"], payload.get("p"))
@@ -0,0 +1,40 @@
+'''Columns kept out of the embedded text are still named in the SQL prompt.'''
+import sqlite3
+import unittest
+
+import ingest_pipeline
+from sql_node import build_prompt
+
+
+class _Collection:
+    '''Stands in for the Chroma collection being built.'''
+
+    def add_texts(self, texts, metadatas, ids):
+        pass
+
+
+class MetadataColumnsTest(unittest.TestCase):
+    '''Metadata-only columns reach the prompt by name, without their values.'''
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.addCleanup(self.conn.close)
+        self.conn.execute("CREATE TABLE clientes (id INTEGER PRIMARY KEY, nome TEXT, email TEXT, "
+                          "telefone TEXT, limite_credito REAL)")
+        self.conn.execute("INSERT INTO clientes VALUES (1, 'Ana', 'ana@xpto.com', NULL, 5000)")
+
+    def test_prompt_names_metadata_columns(self):
+        profile = ingest_pipeline.derive_profiles(self.conn, ["clientes"])["clientes"]
+        self.assertEqual(profile["metadata"], ["email", "telefone"])
+
+        [(doc, meta)] = ingest_pipeline.index_table(self.conn, "clientes", profile, _Collection())
+        self.assertEqual(meta["email"], "ana@xpto.com")
+        prompt = build_prompt({"question": "qual o email da Ana?", "retrieved_docs": [doc]})
+        self.assertIn("email: <metadata>", prompt)
+        self.assertIn("telefone: <metadata>", prompt)
+        self.assertIn("limite_credito: 5000", prompt)
+        self.assertNotIn("ana@xpto.com", prompt)
+
+
+if __name__ == "__main__":
+    unittest.main()
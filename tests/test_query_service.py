@@ -0,0 +1,101 @@
+'''Generated SQL must be validated before anything executes it.'''
+import unittest
+from contextlib import contextmanager
+from types import SimpleNamespace
+from unittest import mock
+
+import query_service
+from databases import DatabaseContext
+from query_service import InvalidSQL, QueryRequest
+
+
+class _Registry:
+    '''One database whose SQL may only read ``vendas``.'''
+
+    def __init__(self):
+        # loaded without a schema catalog or a vector collection
+        self.ctx = DatabaseContext.__new__(DatabaseContext)
+        self.ctx.allowed_tables = {"vendas"}
+        self.ctx.store = None
+        self.ctx.config = SimpleNamespace(path="unused.db")
+
+    def acquire(self, database=None):
+        return self.ctx
+
+    def release(self, ctx):
+        pass
+
+    @contextmanager
+    def leased(self, database=None):
+        yield self.ctx
+
+    def database_path(self, database=None):
+        return self.ctx.config.path
+
+
+def _retrieve(state, store=None):
+    return {**state, "retrieved_docs": [], "retrieved_meta": []}
+
+
+async def _aretrieve(state, store=None):
+    return _retrieve(state)
+
+
+async def _aretrieve_batch(states, stores):
+    return [_retrieve(s) for s in states]
+
+
+class AllowedTablesTest(unittest.IsolatedAsyncioTestCase):
+    '''A query on a table outside ``allowed_tables`` is refused, on every path.'''
+
+    def setUp(self):
+        sql = "SELECT email FROM clientes"
+
+        async def agenerate(state):
+            return {**state, "generated_sql": sql}
+
+        self.executed = mock.Mock(side_effect=AssertionError("rejected SQL was executed"))
+        patches = [
+            mock.patch.object(query_service, "registry", _Registry()),
+            mock.patch.object(query_service, "retriever_node", _retrieve),
+            mock.patch.object(query_service, "aretriever_node", _aretrieve),
+            mock.patch.object(query_service, "aretriever_batch", _aretrieve_batch),
+            mock.patch.object(query_service, "sql_generator_node",
+                              lambda state: {**state, "generated_sql": sql}),
+            mock.patch.object(query_service, "asql_generator_node", agenerate),
+            mock.patch.object(query_service, "execute_sql", self.executed),
+            mock.patch.object(query_service, "iter_sql", self.executed),
+            mock.patch.object(query_service, "execute_page", self.executed),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_query(self):
+        with self.assertRaisesRegex(InvalidSQL, "disallowed tables used"):
+            query_service.query(QueryRequest(question="emails"))
+        with self.assertRaises(InvalidSQL):
+            query_service.query(QueryRequest(question="emails", page_size=10))
+        self.executed.assert_not_called()
+
+    async def test_aquery(self):
+        with self.assertRaisesRegex(ValueError, "^Generated SQL is not valid: "):
+            await query_service.aquery(QueryRequest(question="emails"))
+        self.executed.assert_not_called()
+
+    async def test_batch(self):
+        results = await query_service.aquery_batch([QueryRequest(question="emails")])
+        self.assertEqual(len(results), 1)
+        self.assertRegex(results[0]["error"], "^Generated SQL is not valid: ")
+        self.executed.assert_not_called()
+
+    async def test_events(self):
+        events = [e async for e in query_service.aquery_events(QueryRequest(question="emails"))]
+        names = [name for name, _ in events]
+        self.assertEqual(names, ["retrieved", "sql", "validation", "error"])
+        self.assertFalse(events[2][1]["ok"])
+        self.executed.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+'''Cached results keep the column names of the query that asks for them.'''
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from result_cache import result_cache
+from sql_executor import execute_sql, iter_sql
+
+
+class CachedColumnNamesTest(unittest.TestCase):
+    '''Spellings of a query that share a cache entry still name their own columns.'''
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.db_path = os.path.join(tmp.name, "vendas.db")
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE clientes (id INTEGER PRIMARY KEY, estado TEXT)")
+        conn.executemany("INSERT INTO clientes (estado) VALUES (?)", [("SP",), ("SP",), ("RJ",)])
+        conn.commit()
+        conn.close()
+        self.addCleanup(result_cache.forget, self.db_path)
+
+    def run_query(self, sql, use_cache=True):
+        return execute_sql(sql, use_cache=use_cache, db_path=self.db_path)
+
+    def stream_query(self, sql):
+        # the row limit of execute_sql, to read its entries
+        results = iter_sql(sql, row_limit=1000, db_path=self.db_path)
+        cols = next(results)
+        return cols, [r for chunk in results for r in chunk]
+
+    def assert_names(self, first, second):
+        expected = self.run_query(second, use_cache=False)
+        self.run_query(first)
+        self.assertEqual(self.run_query(second), expected)
+        self.assertEqual(self.stream_query(second), (expected[0], list(expected[1])))
+        return expected[0]
+
+    def test_unaliased_expression(self):
+        hits = result_cache.hits
+        cols = self.assert_names("SELECT estado, COUNT(*) FROM clientes GROUP BY estado",
+                                 "SELECT estado, count(*) FROM clientes GROUP BY estado")
+        self.assertEqual(cols, ["estado", "count(*)"])
+        # both reads of the second spelling were answered by the entry of the first
+        self.assertEqual(result_cache.hits, hits + 2)
+
+    def test_alias(self):
+        cols = self.assert_names("SELECT estado, COUNT(*) AS Total FROM clientes GROUP BY estado",
+                                 "SELECT estado, COUNT(*) AS total FROM clientes GROUP BY estado")
+        self.assertEqual(cols, ["estado", "total"])
+
+    def test_repeated_names(self):
+        cols = self.assert_names("SELECT a.ID, b.ID FROM clientes a JOIN clientes b ON a.id = b.id",
+                                 "select a.id, b.id from clientes a join clientes b on a.id = b.id")
+        self.assertEqual(cols, ["id", "id"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,6 @@
 '''ui.py - Streamlit UI for the Text-to-SQL Chatbot with RAG application.'''
 
+import uuid
 import logging
 from typing import Any, Dict
 
@@ -8,6 +9,11 @@ import requests
 import streamlit as st
 
 API_BASE_URL = "http://127.0.0.1:8000"
+# rows fetched per page of a result
+PAGE_SIZE = 100
+# seconds query results and the API health status are reused
+RESULT_CACHE_TTL = 300
+HEALTH_CACHE_TTL = 10
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 st.set_page_config(
@@ -71,38 +77,197 @@ div[data-testid="column"]:nth-child(2) div.stButton > button:hover {
 """, unsafe_allow_html=True)
 
 
+class QueryFailed(Exception):
+    '''The API answered, but the query failed.'''
+
+
+@st.cache_resource
+def get_session() -> requests.Session:
+    '''HTTP session shared by every rerun, keeping connections to the API open'''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=10)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+@st.cache_data(ttl=RESULT_CACHE_TTL, show_spinner=False)
+def fetch_query(question: str, show_sql: bool, session_id: str) -> Dict[str, Any]:
+    '''Run a query through the API; successful results are cached per session,
+    as their page token may be a server-side cursor only one reader can use'''
+    response = get_session().post(
+        f"{API_BASE_URL}/query",
+        json={
+            "question": question,
+            "show_sql": show_sql,
+            "format": "columnar",
+            "page_size": PAGE_SIZE
+        },
+        timeout=30
+    )
+    response.raise_for_status()
+    result = response.json()
+    # failures raise so they are not cached
+    if not result.get("success"):
+        raise QueryFailed(result.get("error") or "Unknown error")
+    return result
+
+
+def fetch_page(page_token: str) -> Dict[str, Any]:
+    '''Fetch the next page of a paginated result (kept in the session, not cached)'''
+    response = get_session().post(
+        f"{API_BASE_URL}/query/next",
+        json={"page_token": page_token, "format": "columnar"},
+        timeout=30
+    )
+    response.raise_for_status()
+    result = response.json()
+    if not result.get("success"):
+        raise QueryFailed(result.get("error") or "Unknown error")
+    return result
+
+
+def fetch_export(export_token: str) -> bytes:
+    '''Download the full result of a query as CSV through the API'''
+    with get_session().get(f"{API_BASE_URL}/query/export", params={"token": export_token},
+                           stream=True, timeout=60) as response:
+        response.raise_for_status()
+        return b"".join(response.iter_content(chunk_size=64 * 1024))
+
+
 def call_api(question: str, show_sql: bool = True) -> Dict[str, Any]:
     '''Call the Text-to-SQL API'''
     try:
-        response = requests.post(
-            f"{API_BASE_URL}/query",
-            json={
-                "question": question,
-                "show_sql": show_sql
-            },
-            timeout=30
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        return fetch_query(question, show_sql, st.session_state.session_id)
+    except (requests.exceptions.RequestException, QueryFailed) as e:
         logger.error("API call error: %s", e)
         return {"success": False, "error": str(e)}
 
 
+@st.cache_data(ttl=HEALTH_CACHE_TTL, show_spinner=False)
 def check_api_health() -> bool:
     '''Check if the API is healthy'''
     try:
-        response = requests.get(f"{API_BASE_URL}/", timeout=5)
+        response = get_session().get(f"{API_BASE_URL}/", timeout=5)
         return response.status_code == 200
     except requests.exceptions.RequestException:
         return False
 
 
+def run_query(question: str, show_sql: bool):
+    '''Run a question and keep its first page as the current result'''
+    result = call_api(question, show_sql)
+    st.session_state.result = {
+        "question": question,
+        "show_sql": show_sql,
+        "response": result,
+        "pages": [result.get("rows") or []],
+        "tokens": [result.get("next_page_token")],
+        "page": 0,
+    }
+    if result.get("success"):
+        history = st.session_state.query_history
+        if question not in [q["question"] for q in history]:
+            history.append({
+                "question": question,
+                "timestamp": pd.Timestamp.now().strftime("%H:%M:%S")
+            })
+
+
+def show_page_controls(current: Dict[str, Any]):
+    '''Previous/next buttons; pages are fetched from the API as they are opened'''
+    page = current["page"]
+    has_next = page + 1 < len(current["pages"]) or current["tokens"][page] is not None
+    col_prev, col_page, col_next, _ = st.columns([1, 1, 1, 3])
+    with col_prev:
+        if st.button("◀ Previous", disabled=page == 0):
+            current["page"] -= 1
+            st.rerun()
+    with col_page:
+        st.markdown(f"Page **{page + 1}**")
+    with col_next:
+        if st.button("Next ▶", disabled=not has_next):
+            if page + 1 == len(current["pages"]):
+                try:
+                    result = fetch_page(current["tokens"][page])
+                except (requests.exceptions.RequestException, QueryFailed) as e:
+                    # the cursor expired or was used up, so the cached first
+                    # page of this question can't be continued either
+                    fetch_query.clear(current["question"], current["show_sql"],
+                                      st.session_state.session_id)
+                    st.error(f"❌ Could not load the next page: {e}. Run the query again.")
+                    return
+                current["pages"].append(result.get("rows") or [])
+                current["tokens"].append(result.get("next_page_token"))
+            current["page"] += 1
+            st.rerun()
+
+
+def show_result(current: Dict[str, Any], show_sql: bool):
+    '''Render the current result, one page at a time'''
+    result = current["response"]
+    if not result.get("success"):
+        st.error(
+            f"❌ Query error: {result.get('error', 'Unknown error')}")
+        return
+
+    st.success("✅ Query executed successfully!")
+    if show_sql and result.get("sql"):
+        st.subheader("📝 Generated SQL:")
+        st.code(result["sql"], language="sql")
+    rows = current["pages"][current["page"]]
+    if not rows:
+        st.info(
+            "ℹ️ Query executed, but no results were returned.")
+        return
+
+    st.subheader("📊 Results:")
+    df = pd.DataFrame(rows, columns=result["cols"])
+    loaded = sum(len(p) for p in current["pages"])
+    more = current["tokens"][-1] is not None
+    col_metric1, col_metric2 = st.columns(2)
+    with col_metric1:
+        st.metric("Records loaded", f"{loaded}+" if more else loaded)
+    with col_metric2:
+        st.metric("Columns", len(df.columns))
+    st.dataframe(df, width='stretch')
+    if len(current["pages"]) > 1 or more:
+        show_page_controls(current)
+    if result.get("export_token"):
+        show_export(current, result["export_token"])
+
+
+def show_export(current: Dict[str, Any], export_token: str):
+    '''Download button for the full result, fetched from the API when asked for'''
+    if "csv" not in current:
+        if st.button("📥 Prepare CSV"):
+            try:
+                with st.spinner("Exporting results..."):
+                    current["csv"] = fetch_export(export_token)
+            except requests.exceptions.RequestException as e:
+                logger.error("Export error: %s", e)
+                st.error(f"❌ Could not export the results: {e}")
+                return
+            st.rerun()
+        return
+    st.download_button(
+        label="📥 Download CSV",
+        data=current["csv"],
+        file_name="query_results.csv",
+        mime="text/csv"
+    )
+
+
 def main():
     '''Main Streamlit UI function'''
     st.title("🤖 Text-to-SQL Chatbot")
     st.markdown(
         "### Ask questions in natural language and get database results")
+    if "query_history" not in st.session_state:
+        st.session_state.query_history = []
+    if "session_id" not in st.session_state:
+        # keys the cached results of this browser session
+        st.session_state.session_id = uuid.uuid4().hex
     with st.sidebar:
         st.header("⚙️ Settings")
         if check_api_health():
@@ -111,6 +276,7 @@ def main():
             st.error("❌ API unavailable")
             st.info(
                 "Make sure the API is running on http://127.0.0.1:8000")
+            check_api_health.clear()
             return
 
         show_sql = st.checkbox("Show generated SQL", value=True)
@@ -123,11 +289,16 @@ def main():
         - List of active customers
         - Revenue by month
         """)
+    # a question picked from the history is run again, from the cache
+    selected = st.session_state.pop("selected_question", None)
+    if selected:
+        st.session_state.question = selected
     col1, _ = st.columns([2, 1])
 
     with col1:
         question = st.text_area(
             "Type your question:",
+            key="question",
             placeholder="Ex: How many sales were made in 2024?",
             height=100
         )
@@ -139,59 +310,28 @@ def main():
 
         with col_btn2:
             clear_button = st.button("🗑️ Clear", type="secondary")
-    if submit_button and question.strip():
-        with st.spinner("Processing query..."):
-            result = call_api(question, show_sql)
-
-            if result.get("success"):
-                st.success("✅ Query executed successfully!")
-                if show_sql and result.get("sql"):
-                    st.subheader("📝 Generated SQL:")
-                    st.code(result["sql"], language="sql")
-                if result.get("rows"):
-                    st.subheader("📊 Results:")
-                    df = pd.DataFrame(result["rows"])
-                    col_metric1, col_metric2 = st.columns(2)
-                    with col_metric1:
-                        st.metric("Total records", len(df))
-                    with col_metric2:
-                        st.metric("Columns", len(df.columns)
-                                if not df.empty else 0)
-                    st.dataframe(df, width='stretch')
-                    csv = df.to_csv(index=False)
-                    st.download_button(
-                        label="📥 Download CSV",
-                        data=csv,
-                        file_name="query_results.csv",
-                        mime="text/csv"
-                    )
-                else:
-                    st.info(
-                        "ℹ️ Query executed, but no results were returned.")
-
-            else:
-                st.error(
-                    f"❌ Query error: {result.get('error', 'Unknown error')}")
 
+    if clear_button:
+        st.session_state.pop("result", None)
+        st.rerun()
+    if selected:
+        with st.spinner("Processing query..."):
+            run_query(selected, show_sql)
+    elif submit_button and question.strip():
+        with st.spinner("Processing query..."):
+            run_query(question, show_sql)
     elif submit_button and not question.strip():
         st.warning("⚠️ Please type a question.")
 
-    if clear_button:
-        st.rerun()
-    if "query_history" not in st.session_state:
-        st.session_state.query_history = []
-    if submit_button and question.strip():
-        if question not in [q["question"] for q in st.session_state.query_history]:
-            st.session_state.query_history.append({
-                "question": question,
-                "timestamp": pd.Timestamp.now().strftime("%H:%M:%S")
-            })
+    if "result" in st.session_state:
+        show_result(st.session_state.result, show_sql)
+
     with st.sidebar:
         if st.session_state.query_history:
             st.markdown("---")
             st.markdown("### 📝 History")
             for i, item in enumerate(reversed(st.session_state.query_history[-5:])):
-                if st.button(f"{item['timestamp']}", key=f"hist_{i}"):
+                if st.button(f"{item['timestamp']} · {item['question'][:40]}", key=f"hist_{i}"):
                     st.session_state.selected_question = item["question"]
                     st.rerun()
 
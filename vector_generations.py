@@ -0,0 +1,146 @@
+'''Versioned generations of the vector store collection.
+
+A full ingest builds a new collection, named ``<VECTOR_COLLECTION>_g<timestamp>``,
+next to the one being served. Once it passes validation, the pointer file
+``active_collection.json`` in ``VECTOR_STORE_DIR`` is replaced atomically to
+name it, and every process serving retrieval switches to it on its next
+search. Older generations beyond ``VECTOR_KEEP_GENERATIONS`` are deleted.
+
+Without a pointer file the plain ``VECTOR_COLLECTION`` is served, as before.
+Functions reading the pointer take the store directory and base collection
+name of another database (see ``databases.py``), defaulting to the settings
+above.
+'''
+import os
+import json
+import time
+import logging
+import tempfile
+from typing import Any, Dict, List, Optional
+
+import chromadb
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+VECTOR_STORE_DIR = os.getenv("VECTOR_STORE_DIR")
+VECTOR_COLLECTION = os.getenv("VECTOR_COLLECTION")
+VECTOR_KEEP_GENERATIONS = int(os.getenv("VECTOR_KEEP_GENERATIONS", "2"))
+POINTER_FILE = "active_collection.json"
+
+
+class MissingCollection(ValueError):
+    '''The collection to serve doesn't exist in the vector store.'''
+
+
+def pointer_path(store_dir: Optional[str] = None) -> str:
+    '''Path of the pointer file naming the active collection.'''
+    return os.path.join(store_dir or VECTOR_STORE_DIR or ".", POINTER_FILE)
+
+
+def new_generation_name() -> str:
+    '''Name for a collection built now.'''
+    now = time.time()
+    stamp = time.strftime("%Y%m%d%H%M%S", time.localtime(now))
+    return f"{VECTOR_COLLECTION}_g{stamp}{int(now * 1000) % 1000:03d}"
+
+
+def read_pointer(store_dir: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    '''Return the content of the pointer file, or None if there is none.'''
+    path = pointer_path(store_dir)
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Could not read %s: %s", path, e)
+        return None
+
+
+def active_collection(store_dir: Optional[str] = None, base: Optional[str] = None) -> str:
+    '''Name of the collection retrieval should serve.'''
+    pointer = read_pointer(store_dir)
+    return pointer["collection"] if pointer else base or VECTOR_COLLECTION
+
+
+def write_pointer(collection: str, **info):
+    '''Point every process at the collection.
+
+    The file is written next to the pointer and moved over it, so readers see
+    either the old or the new content, never a partial one.
+    '''
+    directory = os.path.dirname(pointer_path())
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".active_collection.")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"collection": collection, "activated": time.time(), **info}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, pointer_path())
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    logger.info("Active collection is now %s", collection)
+
+
+def _client(store_dir: Optional[str] = None):
+    return chromadb.PersistentClient(path=store_dir or VECTOR_STORE_DIR)
+
+
+def list_generations() -> List[str]:
+    '''Names of the generation collections, oldest first.'''
+    prefix = f"{VECTOR_COLLECTION}_g"
+    names = [c if isinstance(c, str) else c.name for c in _client().list_collections()]
+    return sorted(n for n in names if n.startswith(prefix))
+
+
+def collection_count(name: str, store_dir: Optional[str] = None) -> Optional[int]:
+    '''Number of documents in the collection, or None if it doesn't exist.'''
+    try:
+        return _client(store_dir).get_collection(name).count()
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+
+def drop_collection(name: str):
+    '''Delete a collection of the vector store.'''
+    _client().delete_collection(name)
+    logger.info("Deleted collection %s", name)
+
+
+def gc_generations(keep: int = VECTOR_KEEP_GENERATIONS) -> List[str]:
+    '''Delete old generations, keeping the active one and the newest others.
+
+    `keep` counts the active generation. Keeping the previous one lets
+    processes that haven't switched yet finish the searches they started.
+    '''
+    active = active_collection()
+    others = [n for n in list_generations() if n != active]
+    stale = others[:max(0, len(others) - max(keep - 1, 0))]
+    for name in stale:
+        drop_collection(name)
+    return stale
+
+
+def release_store(store_dir: str):
+    '''Stop the chromadb system of a store directory so its indexes leave memory.
+
+    chromadb keeps one system per directory for the life of the process and
+    has no public way to close it, so this goes through its internal cache
+    and does nothing if that changed. The next client for the directory
+    starts a new system.
+    '''
+    try:
+        from chromadb.api.client import SharedSystemClient  # pylint: disable=import-outside-toplevel
+
+        systems = SharedSystemClient._identifier_to_system  # pylint: disable=protected-access
+    except (ImportError, AttributeError):
+        return
+    system = systems.pop(store_dir, None)
+    if system is not None:
+        system.stop()
+        logger.info("Released vector store %s", store_dir)
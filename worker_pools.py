@@ -0,0 +1,38 @@
+'''Thread pools for the blocking stages of the query pipeline.
+
+CPU-bound model inference (embedding, reranking) and blocking I/O (Chroma,
+SQLite) run in separate pools so a burst of one kind of work can't starve
+the other, and neither blocks the event loop.
+'''
+import os
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from metrics import Gauge
+from profiler import run_attached
+
+# Model inference already uses several threads per call through torch, so
+# only a few calls should run at the same time
+CPU_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("CPU_POOL_SIZE", "2")),
+                            thread_name_prefix="cpu")
+IO_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("IO_POOL_SIZE", "16")),
+                            thread_name_prefix="io")
+
+POOLS = {"cpu": CPU_POOL, "io": IO_POOL}
+
+Gauge("worker_pool_queue_depth", "Tasks waiting for a thread in each worker pool.",
+    lambda: {(name,): pool._work_queue.qsize() for name, pool in POOLS.items()},  # pylint: disable=protected-access
+    labels=("pool",))
+Gauge("worker_pool_threads", "Threads started by each worker pool.",
+    lambda: {(name,): len(pool._threads) for name, pool in POOLS.items()},  # pylint: disable=protected-access
+    labels=("pool",))
+
+
+async def run_in(pool: ThreadPoolExecutor, fn: Callable, *args, **kwargs) -> Any:
+    '''Run a blocking function in the given pool, keeping the caller's context.'''
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(pool, functools.partial(ctx.run, run_attached, fn, *args, **kwargs))